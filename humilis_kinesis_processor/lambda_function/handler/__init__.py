@@ -2,6 +2,11 @@
 
 # preprocessor:jinja2
 
+# Imported first so that the time spent in the other imports can be profiled
+from . import startup
+
+_profiler = startup.profile_imports()
+
 import copy
 from base64 import b64encode, b64decode
 import json
@@ -9,17 +14,47 @@ import logging
 import os
 import zlib
 
-import boto3
+from lambdautils.exception import ProcessingError
 import lambdautils.utils as utils
-from retrying import retry
-import raven
-from werkzeug.utils import import_string  # noqa
 
-from .processor import process_event
+from . import clients
+from . import columnar
+from . import deadline
+from . import failures
+from . import lazy
+from . import streaming
+from . import workers
+from .plan import build_plan, import_string, is_true  # noqa
+from .processor import get_codecs, process_batch, process_event
 
 logger = logging.getLogger()
 logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
 
+# The pipeline plan is built once per container
+_plan = []
+
+
+def get_plan():
+    """The (cached) specification of the input and output pipelines."""
+    if not _plan:
+        input, output = produce_io_stream_callables()
+        _plan.append(build_plan(input, output, get_codecs()))
+    return _plan[0]
+
+
+def _report_exception():
+    """Report the exception being handled to Sentry."""
+    dsn = utils.get_secret("sentry.dsn",
+                           environment="{{_env.name}}",
+                           stage="{{_env.stage}}")
+    if not dsn:
+        logger.error("Unable to retrieve Sentry DSN")
+    else:
+        # Only needed in the error path: not imported at cold start
+        import raven
+        client = raven.Client(dsn)
+        client.captureException()
+
 
 def produce_io_stream_callables():
     """Produces filter/mapper callables for the input and output streams."""
@@ -28,7 +63,8 @@ def produce_io_stream_callables():
             globs = dict(import_string=import_string, input=None, output=None)
             exec(
                 """
-{% set callables = ['batch_mapper', 'mapper', 'filter', 'partition_key'] %}
+{% set callables = ['batch_mapper', 'batch_filter', 'batch_flatmapper',
+                    'mapper', 'filter', 'partition_key', 'group_by'] %}
 {% if meta_input %}
 input  = {
     {% for k, v in meta_input.items() %}
@@ -111,14 +147,7 @@ output = [
             return globs["input"], globs["output"]
         except:
             logger.error("Unable to produce I/O callables")
-            dsn = utils.get_secret("sentry.dsn",
-                                   environment="{{_env.name}}",
-                                   stage="{{_env.stage}}")
-            if not dsn:
-                logger.error("Unable to retrieve Sentry DSN")
-            else:
-                client = raven.Client(dsn)
-                client.captureException()
+            _report_exception()
             # This is a critical error: must re-raise
             raise
 
@@ -130,7 +159,8 @@ def produce_error_stream_callables():
             globs = dict(import_string=import_string, error=None)
             exec(
                 """
-{% set callables = ['batch_mapper', 'mapper', 'filter', 'partition_key'] %}
+{% set callables = ['batch_mapper', 'batch_filter', 'batch_flatmapper',
+                    'mapper', 'filter', 'partition_key', 'group_by'] %}
 {% if meta_error %}
 error = {
     {% for k, v in meta_error.items() %}
@@ -146,23 +176,45 @@ error = {
             return globs["error"]
         except:
             logger.error("Unable to produce error callables")
-            dsn = utils.get_secret("sentry.dsn",
-                                   environment="{{_env.name}}",
-                                   stage="{{_env.stage}}")
-            if not dsn:
-                logger.error("Unable to retrieve Sentry DSN")
-            else:
-                client = raven.Client(dsn)
-                client.captureException()
+            _report_exception()
             # This is a critical error: must re-raise
             raise
 
 
+_error_stream = produce_error_stream_callables()
+
+
 @utils.sentry_monitor(
     environment="{{_env.name}}",
     stage="{{_env.stage}}",
     layer="{{_layer.name}}",
-    error_stream=produce_error_stream_callables())
+    error_stream=_error_stream)
+def _fail(failed, context):
+    """Fail with the errors of a batch, so that they are reported."""
+    raise ProcessingError(failed)
+
+
+def report_errors(failed, context):
+    """Report failed events without failing the invocation.
+
+    The events are sent to the error stream, if any, and to Sentry, as
+    they are when the whole batch fails.
+    """
+    if not failed:
+        return
+    try:
+        _fail(failed, context)
+    except Exception:
+        # Without an error stream the first error is raised once reported:
+        # the failed records are retried anyway
+        pass
+
+
+@utils.sentry_monitor(
+    environment="{{_env.name}}",
+    stage="{{_env.stage}}",
+    layer="{{_layer.name}}",
+    error_stream=_error_stream)
 def lambda_handler(event, context):
     """Lambda function."""
 
@@ -180,12 +232,33 @@ def lambda_handler(event, context):
             rec["kinesis"]["data"] = decompressed
 
     try:
-        input, output = produce_io_stream_callables()
+        plan = get_plan()
     except Exception as exception:
         # make sentry_monitor re-reraise after notifying sentry
         raise utils.CriticalError(exception)
 
-    return process_event(event, context, input, output)
+    # Stopping before the deadline relies on reporting unprocessed records
+    partial = failures.enabled() or deadline.enabled()
+    if streaming.enabled() or deadline.enabled():
+        # Output events are not kept around: nothing is returned
+        failed, seqnum = streaming.process_event(
+            event, context, plan.input, plan.output, partial)
+        if partial:
+            report_errors(failed, context)
+            return failures.response(seqnum)
+        if failed:
+            raise ProcessingError(failed)
+        return
+
+    if failures.enabled():
+        _, failed, response = process_batch(event, context, plan.input,
+                                            plan.output)
+        report_errors(failed, context)
+        return response
+
+    oevents = process_event(event, context, plan.input, plan.output)
+    # The response must be JSON serializable
+    return [lazy.loaded(columnar.to_rows(events)) for events in oevents]
 
 
 def invoke_self_async(event, context):
@@ -243,7 +316,28 @@ def _compress_records(event):
         rec["kinesis"]["data"] = data
 
 
-@retry(wait_exponential_multiplier=500, wait_exponential_max=5000,
-       stop_max_delay=20000)
 def invoke_with_retry(**kwargs):
-    return boto3.client("lambda").invoke(**kwargs)
+    """Invoke a Lambda function, retrying with exponential backoff."""
+    # Only needed for async invocations: not imported at cold start
+    from retrying import retry
+
+    @retry(wait_exponential_multiplier=500, wait_exponential_max=5000,
+           stop_max_delay=20000)
+    def invoke():
+        return clients.get_client("lambda").invoke(**kwargs)
+
+    return invoke()
+
+
+# Fork the worker processes while the container runs a single thread
+if utils.in_aws_lambda() and workers.enabled():
+    with startup.timed("workers"):
+        workers.get_workers()
+
+# Do the work of the first invocation during the init phase
+if utils.in_aws_lambda() and is_true(os.environ.get("PRIME_ON_INIT")):
+    startup.prime(get_plan)
+
+if _profiler is not None:
+    _profiler.stop()
+    startup.log_report(_profiler)
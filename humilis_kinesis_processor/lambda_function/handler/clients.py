@@ -0,0 +1,66 @@
+"""AWS clients shared by all the invocations served by a container.
+
+Creating a client, and the TLS handshake of its first request, take tens
+of milliseconds. Clients are thread safe, so one client per service is
+created and its connection pool is reused by every sink and invocation.
+"""
+
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+_clients = {}
+_lock = threading.Lock()
+
+# The default size of the connection pool of botocore clients
+DEFAULT_POOL_SIZE = 10
+
+
+def pool_size():
+    """The number of connections that a client keeps open.
+
+    Enough for every delivery that can be in flight at the same time to use
+    its own connection.
+    """
+    concurrency = int(os.environ.get("DELIVERY_CONCURRENCY") or 1)
+    return max(DEFAULT_POOL_SIZE, concurrency)
+
+
+def setup_default_session():
+    """Create boto3's default session before using it from several threads.
+
+    Creating the default session is not thread safe.
+    """
+    with _lock:
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+
+
+def get_client(name):
+    """Get the shared client of an AWS service."""
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = _create_client(name)
+    return client
+
+
+def _create_client(name):
+    """Create a client tuned for connection reuse."""
+    return boto3.client(name, config=Config(max_pool_connections=pool_size()))
+
+
+def register(name, client):
+    """Use a given client for an AWS service, e.g. a local stand-in."""
+    with _lock:
+        _clients[name] = client
+
+
+def reset():
+    """Forget all the clients created so far."""
+    with _lock:
+        _clients.clear()
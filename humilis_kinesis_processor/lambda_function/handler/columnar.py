@@ -0,0 +1,222 @@
+"""Columnar (Apache Arrow) batches of events.
+
+In columnar mode a batch of events is a `pyarrow.Table` with one row per
+event, decoded directly from the record payloads by Arrow's JSON reader,
+so that batch stages can work on whole columns (or hand the table to
+pandas, Polars or DuckDB without copying it). Events are only turned into
+dicts when a row-wise stage or sink needs them.
+
+Records can also carry Arrow IPC streams instead of JSON documents, which
+is how a columnar output ships its events to Kinesis: a processor reading
+from that stream decodes them without parsing any JSON.
+
+pyarrow is an optional dependency: it is imported on first use.
+"""
+
+from base64 import b64decode
+from datetime import datetime
+import io
+import sys
+import uuid
+
+from dateutil import tz
+from lambdautils.exception import CriticalError
+from lambdautils.utils import BadKinesisEventError
+
+from .kinesis import MAX_BYTES_PER_RECORD
+
+# Arrow IPC streams start with a continuation marker
+IPC_MAGIC = b"\xff\xff\xff\xff"
+
+
+def _pyarrow():
+    """Import pyarrow and the modules used to read and write tables."""
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa
+        import pyarrow.json  # noqa
+    except ImportError:
+        raise CriticalError("Columnar mode requires pyarrow to be installed "
+                            "in the Lambda package")
+    return pyarrow
+
+
+def is_table(obj):
+    """True if obj is a columnar batch of events."""
+    # If pyarrow has not been imported there cannot be any table around
+    pa = sys.modules.get("pyarrow")
+    return pa is not None and isinstance(obj, pa.Table)
+
+
+def from_rows(events):
+    """Produce a columnar batch from a list of dicts or a DataFrame."""
+    if is_table(events):
+        return events
+    pa = _pyarrow()
+    if hasattr(events, "to_dict") and not isinstance(events, dict):
+        # A pandas DataFrame
+        return pa.Table.from_pandas(events, preserve_index=False)
+    return pa.Table.from_pylist(list(events))
+
+
+def to_rows(events):
+    """The events of a batch as a list of dicts."""
+    if is_table(events):
+        return events.to_pylist()
+    return events
+
+
+def row(events, index):
+    """A single event of a batch, as a dict."""
+    if is_table(events):
+        return events.slice(index, 1).to_pylist()[0]
+    return events[index]
+
+
+def mask_values(mask):
+    """The values of a mask returned by a batch filter, as a list."""
+    pa = _pyarrow()
+    if isinstance(mask, (pa.Array, pa.ChunkedArray)):
+        return mask.to_pylist()
+    return list(mask)
+
+
+def select(table, mask):
+    """Keep the rows of a table for which a mask is true.
+
+    Returns the selected rows and their positions in the original table.
+    """
+    pa = _pyarrow()
+    mask = [bool(keep) for keep in mask_values(mask)]
+    if len(mask) != table.num_rows:
+        raise CriticalError("Batch filters must return one value per event")
+    positions = [i for i, keep in enumerate(mask) if keep]
+    return table.filter(pa.array(mask, type=pa.bool_())), positions
+
+
+def _concat(tables):
+    """Concatenate tables whose schemas may differ."""
+    pa = _pyarrow()
+    if len(tables) == 1:
+        return tables[0]
+    try:
+        return pa.concat_tables(tables, promote_options="default")
+    except TypeError:
+        # pyarrow < 14
+        return pa.concat_tables(tables, promote=True)
+
+
+def decode_payloads(payloads):
+    """Decode record payloads (JSON documents or Arrow IPC streams).
+
+    Consecutive JSON documents are parsed in one go as newline-delimited
+    JSON. Returns the table and the number of rows each payload produced.
+    """
+    pa = _pyarrow()
+    tables, counts, documents = [], [], []
+
+    def flush():
+        if documents:
+            tables.append(pa.json.read_json(io.BytesIO(b"\n".join(documents))))
+            del documents[:]
+
+    for payload in payloads:
+        if not isinstance(payload, bytes):
+            payload = payload.encode("utf-8")
+        if payload.startswith(IPC_MAGIC):
+            flush()
+            table = pa.ipc.open_stream(payload).read_all()
+            tables.append(table)
+            counts.append(table.num_rows)
+        else:
+            documents.append(payload.strip())
+            counts.append(1)
+    flush()
+    return _concat(tables), counts
+
+
+def format_timestamp(ts):
+    """Format an arrival timestamp the way lambdautils embeds it in events."""
+    if not ts:
+        return ""
+    return datetime.fromtimestamp(ts, tz=tz.tzutc()).strftime(
+        "%Y-%m-%d %H:%M:%S")
+
+
+def unpack_kinesis_event(kinesis_event, unpacker=None, embed_timestamp=None):
+    """Decode the records of a Kinesis event into a columnar batch.
+
+    The columnar counterpart of lambdautils.utils.unpack_kinesis_event.
+    """
+    table, shard_id, _ = unpack_records(kinesis_event, unpacker,
+                                        embed_timestamp)
+    return table, shard_id
+
+
+def unpack_records(kinesis_event, unpacker=None, embed_timestamp=None):
+    """Decode the records of a Kinesis event into a columnar batch.
+
+    Returns the table, the shard ID and the number of rows produced by
+    each record.
+    """
+    records = kinesis_event["Records"]
+    payloads, shard_ids = [], set()
+    for rec in records:
+        data = rec["kinesis"]["data"]
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        payload = b64decode(data)
+        if unpacker:
+            payload = unpacker(payload)
+        payloads.append(payload)
+        shard_ids.add(rec["eventID"].split(":")[0])
+
+    if len(shard_ids) > 1:
+        raise BadKinesisEventError(
+            "Kinesis event contains records from several shards: {}".format(
+                shard_ids))
+
+    table, counts = decode_payloads(payloads)
+    if embed_timestamp:
+        received = []
+        for rec, count in zip(records, counts):
+            ts = format_timestamp(
+                rec["kinesis"].get("approximateArrivalTimestamp"))
+            received += [ts] * count
+        if embed_timestamp in table.column_names:
+            table = table.drop([embed_timestamp])
+        table = table.append_column(embed_timestamp, _pyarrow().array(
+            received, type=_pyarrow().string()))
+    return table, shard_ids.pop(), counts
+
+
+def encode_table(table, max_bytes=MAX_BYTES_PER_RECORD):
+    """Encode a table as Arrow IPC streams of at most max_bytes each."""
+    pa = _pyarrow()
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    blob = sink.getvalue().to_pybytes()
+    if len(blob) <= max_bytes:
+        return [blob]
+    if table.num_rows <= 1:
+        raise CriticalError(
+            "A columnar event of {} bytes exceeds the record size limit of "
+            "{}".format(len(blob), max_bytes))
+    half = table.num_rows // 2
+    return (encode_table(table.slice(0, half), max_bytes) +
+            encode_table(table.slice(half), max_bytes))
+
+
+def make_records(table, partition_key=None, max_bytes=MAX_BYTES_PER_RECORD):
+    """Encode a table as PutRecords entries carrying Arrow IPC streams.
+
+    A record holds many events, so only a fixed partition key (a string)
+    can be honoured: otherwise every record gets a random one.
+    """
+    # Leave room for the partition key, which counts towards the limit
+    max_bytes -= 256
+    return [{"Data": blob,
+             "PartitionKey": (partition_key if isinstance(partition_key, str)
+                              else str(uuid.uuid4()))}
+            for blob in encode_table(table, max_bytes)]
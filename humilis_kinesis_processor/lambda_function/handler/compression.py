@@ -0,0 +1,249 @@
+"""Compress groups of records together, optionally with a zstd dictionary.
+
+Small events barely compress on their own, so the records sent to an
+output stream are grouped (by partition key, to keep every event in the
+shard it would have landed in) and each group is compressed as a single
+zstd frame. A dictionary trained offline on sample events helps even more,
+as it captures the field names and values shared by all events.
+
+A compressed record is made of a header and a zstd frame::
+
+    magic (3 bytes) | version (1 byte) | dictionary ID (4 bytes, 0: none)
+
+The frame holds the records of the group, each prefixed by its length as
+a 4-byte big-endian integer, and a checksum of its content. Input records
+are only taken for compressed records if the header is followed by the
+magic number of a zstd frame: any other record, even one that happens to
+start with the same magic number, is left as is.
+
+Dictionaries are read from a directory, in which every dictionary is
+stored as <dictionary ID>.zdict, so that records compressed with an older
+dictionary can still be decompressed.
+
+zstandard is an optional dependency, imported on first use.
+"""
+
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+import copy
+import hashlib
+import json
+import os
+import struct
+import time
+import uuid
+
+from lambdautils.exception import CriticalError
+
+from .kinesis import MAX_BYTES_PER_RECORD
+
+MAGIC = b"HKZ"
+# The base64 encoding of the magic number
+B64_PREFIX = "SEta"
+VERSION = 1
+HEADER = struct.Struct(">3sBI")
+# The magic number that starts every zstd frame
+FRAME_MAGIC = b"\x28\xb5\x2f\xfd"
+LENGTH = struct.Struct(">I")
+
+DEFAULT_LEVEL = 3
+DEFAULT_DICT_SIZE = 16 * 1024
+
+# The dictionaries loaded so far, by ID
+_dictionaries = {}
+
+
+def _zstandard():
+    """Import zstandard."""
+    try:
+        import zstandard
+    except ImportError:
+        raise CriticalError("Compression requires zstandard to be installed "
+                            "in the Lambda package")
+    return zstandard
+
+
+def dictionary_path():
+    """The directory that holds the compression dictionaries."""
+    return os.environ.get("COMPRESSION_DICT_PATH") or "dictionaries"
+
+
+def output_dictionary_id():
+    """The ID of the dictionary used to compress output records."""
+    return int(os.environ.get("COMPRESSION_DICT_ID") or 0)
+
+
+def compression_level():
+    """The zstd compression level for output records."""
+    return int(os.environ.get("COMPRESSION_LEVEL") or DEFAULT_LEVEL)
+
+
+def get_dictionary(dict_id, directory=None):
+    """Load a dictionary, once per container."""
+    if not dict_id:
+        return None
+    dictionary = _dictionaries.get(dict_id)
+    if dictionary is None:
+        path = os.path.join(directory or dictionary_path(),
+                            "{}.zdict".format(dict_id))
+        try:
+            with open(path, "rb") as zdict:
+                data = zdict.read()
+        except (IOError, OSError):
+            raise CriticalError("Compression dictionary {} not found".format(
+                path))
+        dictionary = _zstandard().ZstdCompressionDict(data)
+        _dictionaries[dict_id] = dictionary
+    return dictionary
+
+
+def is_compressed(payload):
+    """True if a (decoded) record payload is a group of compressed records."""
+    return (payload[:len(MAGIC)] == MAGIC and
+            payload[HEADER.size:HEADER.size + len(FRAME_MAGIC)] ==
+            FRAME_MAGIC)
+
+
+def compress(payloads, dict_id=0, level=None):
+    """Compress a group of record payloads into a single payload."""
+    zstd = _zstandard()
+    dictionary = get_dictionary(dict_id)
+    if dictionary is not None:
+        compressor = zstd.ZstdCompressor(level=level or compression_level(),
+                                         dict_data=dictionary,
+                                         write_checksum=True)
+    else:
+        compressor = zstd.ZstdCompressor(level=level or compression_level(),
+                                         write_checksum=True)
+    body = b"".join(LENGTH.pack(len(p)) + p for p in payloads)
+    return HEADER.pack(MAGIC, VERSION, dict_id) + compressor.compress(body)
+
+
+def decompress(payload):
+    """The record payloads of a compressed group."""
+    magic, version, dict_id = HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise CriticalError("Unsupported compressed record version: {}".format(
+            version))
+    dictionary = get_dictionary(dict_id)
+    zstd = _zstandard()
+    if dictionary is not None:
+        decompressor = zstd.ZstdDecompressor(dict_data=dictionary)
+    else:
+        decompressor = zstd.ZstdDecompressor()
+    body = decompressor.decompress(payload[HEADER.size:])
+    payloads, pos = [], 0
+    while pos < len(body):
+        size, = LENGTH.unpack_from(body, pos)
+        pos += LENGTH.size
+        payloads.append(body[pos:pos + size])
+        pos += size
+    return payloads
+
+
+def _to_bytes(data):
+    """Record data as bytes."""
+    if isinstance(data, bytes):
+        return data
+    return data.encode("utf-8")
+
+
+def compress_records(records, group_by_key=True, dict_id=None,
+                     max_bytes=MAX_BYTES_PER_RECORD):
+    """Compress PutRecords entries in groups.
+
+    Groups are sized on the uncompressed data, so that a compressed record
+    never exceeds the record size limit, even if the data does not
+    compress at all.
+    """
+    if dict_id is None:
+        dict_id = output_dictionary_id()
+    groups = OrderedDict()
+    for record in records:
+        key = record["PartitionKey"] if group_by_key else None
+        groups.setdefault(key, []).append(_to_bytes(record["Data"]))
+
+    compressed = []
+    for key, group in groups.items():
+        partition_key = key or str(uuid.uuid4())
+        # Room for the header, the partition key and the zstd overhead
+        budget = int(max_bytes * 0.99) - HEADER.size - 256 - \
+            len(partition_key.encode("utf-8"))
+        chunk, size = [], 0
+        for data in group:
+            if chunk and size + LENGTH.size + len(data) > budget:
+                compressed.append({"Data": compress(chunk, dict_id),
+                                   "PartitionKey": partition_key})
+                partition_key = key or str(uuid.uuid4())
+                chunk, size = [], 0
+            chunk.append(data)
+            size += LENGTH.size + len(data)
+        compressed.append({"Data": compress(chunk, dict_id),
+                           "PartitionKey": partition_key})
+    return compressed
+
+
+def decompress_records(records):
+    """Expand the compressed records of a Lambda Kinesis event.
+
+    Every record of a compressed group becomes a record of its own, with
+    the sequence number of the compressed record and the position of the
+    record in the group as its `subSequenceNumber`.
+    """
+    result = []
+    for rec in records:
+        data = rec["kinesis"]["data"]
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        if not data.startswith(B64_PREFIX):
+            result.append(rec)
+            continue
+        payload = b64decode(data)
+        if not is_compressed(payload):
+            result.append(rec)
+            continue
+        for index, subdata in enumerate(decompress(payload)):
+            subrec = copy.copy(rec)
+            subrec["kinesis"] = dict(
+                rec["kinesis"],
+                data=b64encode(subdata).decode("utf-8"),
+                subSequenceNumber=index,
+                compressed=True)
+            result.append(subrec)
+    return result
+
+
+def train_dictionary(samples, size=DEFAULT_DICT_SIZE):
+    """Train a zstd dictionary on sample record payloads."""
+    samples = [_to_bytes(sample) for sample in samples]
+    return _zstandard().train_dictionary(size, samples)
+
+
+def save_dictionary(dictionary, directory, **metadata):
+    """Store a dictionary as a new version in a dictionary directory.
+
+    The dictionary is saved as <dictionary ID>.zdict and described in the
+    manifest.json file of the directory. Returns the dictionary ID, which
+    is what compression_dict_id must be set to in order to use it.
+    """
+    dict_id = dictionary.dict_id()
+    data = dictionary.as_bytes()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, "{}.zdict".format(dict_id)),
+              "wb") as zdict:
+        zdict.write(data)
+
+    manifest_path = os.path.join(directory, "manifest.json")
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    manifest[str(dict_id)] = dict(
+        metadata,
+        size=len(data),
+        sha256=hashlib.sha256(data).hexdigest(),
+        created=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+    return dict_id
@@ -0,0 +1,89 @@
+"""Stop processing a batch before the function times out.
+
+In deadline-aware mode the records of a batch are processed in chunks
+(see the streaming module) and the time each chunk takes is measured
+against the remaining time of the invocation. Before every chunk the
+scheduler works out how many records can still be processed, using a
+moving average of the cost of a record, and leaves enough time to deliver
+what has been processed. When no more records fit, the remaining records
+are reported to Lambda as failed (see the failures module): the shard is
+checkpointed after the last fully processed record and the rest of the
+batch is retried, rather than the function timing out and the whole batch
+being retried.
+
+At least one record is processed by every invocation, even if the reserve
+leaves no time for it: a batch would otherwise be retried forever without
+any progress.
+"""
+
+import logging
+import os
+
+from .plan import is_true
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+# The number of records of the first chunk, used to estimate the cost of
+# a record before committing to larger chunks
+PROBE_SIZE = 10
+# How much more time than estimated a chunk may take
+SAFETY_FACTOR = 1.5
+# The weight of the latest chunk in the moving average of the cost
+SMOOTHING = 0.5
+
+DEFAULT_RESERVE = 3000
+
+
+def enabled():
+    """True if processing stops before the deadline of the invocation."""
+    return is_true(os.environ.get("DEADLINE_AWARE"))
+
+
+def reserve():
+    """The time (ms) kept to deliver the events once processing stops."""
+    return int(os.environ.get("DEADLINE_RESERVE") or DEFAULT_RESERVE)
+
+
+class Scheduler(object):
+
+    """Decide how many records can be processed before the deadline."""
+
+    def __init__(self, context, reserve_ms=None):
+        self.context = context
+        self.reserve = reserve() if reserve_ms is None else reserve_ms
+        # The estimated time (ms) taken to process a record
+        self.cost = None
+        self._started = None
+
+    def budget(self):
+        """The time (ms) left to process records."""
+        return self.context.get_remaining_time_in_millis() - self.reserve
+
+    def next_chunk(self, size):
+        """The number of records (at most `size`) to process next."""
+        budget = self.budget()
+        if budget <= 0:
+            if self.cost is None:
+                logger.warning("No time left before the reserve of %d ms: "
+                               "processing a single record", self.reserve)
+                return min(size, 1)
+            return 0
+        if self.cost is None:
+            return min(size, PROBE_SIZE)
+        if not self.cost:
+            return size
+        return min(size, int(budget / (self.cost * SAFETY_FACTOR)))
+
+    def start(self):
+        """Start timing a chunk."""
+        self._started = self.context.get_remaining_time_in_millis()
+
+    def done(self, nrecords):
+        """Update the cost estimate with a chunk that has been processed."""
+        elapsed = self._started - self.context.get_remaining_time_in_millis()
+        cost = max(elapsed, 0) / float(max(nrecords, 1))
+        if self.cost is None:
+            self.cost = cost
+        else:
+            self.cost = SMOOTHING * cost + (1 - SMOOTHING) * self.cost
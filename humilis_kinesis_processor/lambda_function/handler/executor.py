@@ -0,0 +1,102 @@
+"""Concurrent execution of independent processing tasks."""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import logging
+import os
+import threading
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+# Thread pools are created once per container and reused across invocations
+_pools = {}
+
+# An event loop per thread, also reused across invocations
+_local = threading.local()
+
+
+def get_pool(name, max_workers):
+    """Get the thread pool with a given name and size."""
+    key = (name, max_workers)
+    pool = _pools.get(key)
+    if pool is None:
+        logger.info("Creating thread pool '%s' with %s workers",
+                    name, max_workers)
+        pool = _pools[key] = ThreadPoolExecutor(max_workers=max_workers)
+    return pool
+
+
+def start(calls, max_workers, name="default"):
+    """Start running a list of (callable, args) pairs in a thread pool."""
+    pool = get_pool(name, max_workers)
+    return [pool.submit(func, *args) for func, args in calls]
+
+
+def wait(futures):
+    """Wait for a list of futures and return their results in order.
+
+    If any call raised an exception, the exception of the first failed call
+    (in list order) is re-raised once all the calls have completed, so that
+    no work is left running in the background.
+    """
+    errors = [f.exception() for f in futures]
+    for err in errors:
+        if err is not None:
+            raise err
+    return [f.result() for f in futures]
+
+
+def run_all(calls, max_workers, name="default"):
+    """Run a list of (callable, args) pairs with bounded concurrency."""
+    calls = list(calls)
+    if max_workers <= 1 or len(calls) <= 1:
+        return [func(*args) for func, args in calls]
+    return wait(start(calls, max_workers, name))
+
+
+def map_ordered(func, items, max_workers, name="default"):
+    """Apply a callable to a list of items using a pool of threads.
+
+    The results are returned in the same order as the items.
+    """
+    return run_all([(func, (item,)) for item in items], max_workers, name)
+
+
+def get_loop():
+    """Get the event loop of the current thread."""
+    loop = getattr(_local, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _local.loop = asyncio.new_event_loop()
+    return loop
+
+
+def resolve(value):
+    """The result of a callable that may be a coroutine function."""
+    if inspect.isawaitable(value):
+        return get_loop().run_until_complete(value)
+    return value
+
+
+def run_async(calls, max_concurrency):
+    """Run a list of (coroutine function, args) pairs on an event loop.
+
+    At most `max_concurrency` calls are awaited at the same time. Results
+    are returned in order and errors are handled as in `wait`.
+    """
+    async def bounded(semaphore, func, args):
+        async with semaphore:
+            return await func(*args)
+
+    async def gather():
+        semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+        return await asyncio.gather(
+            *[bounded(semaphore, func, args) for func, args in calls],
+            return_exceptions=True)
+
+    results = get_loop().run_until_complete(gather())
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
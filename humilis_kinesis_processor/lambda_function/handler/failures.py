@@ -0,0 +1,55 @@
+"""Report the failed records of a batch instead of failing the whole batch.
+
+With ReportBatchItemFailures enabled on the event source mapping, a
+function can respond with the sequence numbers of the records that failed.
+For a Kinesis stream Lambda checkpoints the shard at the lowest reported
+sequence number: every record before it is done for good, and the batch is
+retried starting from that record.
+
+So that no event is delivered twice, only the events produced by the
+records before the first failed record are delivered (and archived). The
+events of the failed record and of every record after it are left for the
+retry. A record that cannot be decoded fails like a record whose events
+could not be processed.
+
+Failed events are still sent to the error stream and reported to Sentry,
+every time they fail.
+"""
+
+import os
+
+from .plan import is_true
+
+
+def enabled():
+    """True if failed records are reported to Lambda."""
+    return is_true(os.environ.get("REPORT_BATCH_ITEM_FAILURES"))
+
+
+def checkpoint(failed, seqnums, whole=False):
+    """Find the first record that failed.
+
+    `failed` are the errors of a batch and `seqnums` the sequence numbers
+    of the records of its events. Returns the position of the first event
+    of the first failed record, which is the first event that must not be
+    delivered, and the sequence number of the record. Both are None if
+    there are no errors. If `whole` is set some events cannot be traced
+    back to their record, so any error fails the whole batch.
+    """
+    if not failed:
+        return None, None
+    if whole:
+        return 0, seqnums[0]
+    first = min(err.index for err in failed)
+    seqnum = seqnums[first]
+    # The events of a deaggregated record share its sequence number
+    while first > 0 and seqnums[first - 1] == seqnum:
+        first -= 1
+    return first, seqnum
+
+
+def response(seqnum=None):
+    """The response of the function that reports a failed record."""
+    if seqnum is None:
+        return {"batchItemFailures": []}
+    return {"batchItemFailures": [{"itemIdentifier": seqnum}]}
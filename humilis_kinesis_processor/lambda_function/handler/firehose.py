@@ -0,0 +1,136 @@
+"""Write records to Firehose delivery streams within the service limits."""
+
+import json
+import logging
+import os
+import time
+
+from . import clients
+from .kinesis import PutMetrics, backoff, log_metrics
+from .schemas import json_default
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+# PutRecordBatch service limits
+MAX_RECORDS_PER_CALL = 500
+MAX_BYTES_PER_CALL = 4 * 1024 * 1024
+MAX_BYTES_PER_RECORD = 1000 * 1024
+
+
+class FirehoseError(Exception):
+
+    """Firehose API Error."""
+
+    pass
+
+
+def encode_event(event):
+    """Encode an event as a newline-delimited JSON document."""
+    if not isinstance(event, str):
+        # csv events already have a newline
+        event = json.dumps(event, default=json_default) + "\n"
+    return event.encode("utf-8")
+
+
+def make_records(events, pack=False, max_bytes=MAX_BYTES_PER_RECORD,
+                 raw=None):
+    """Encode a list of events as PutRecordBatch entries.
+
+    Every event becomes one record, unless `pack` is set. Packed records
+    concatenate as many newline-delimited events as fit in `max_bytes`, which
+    greatly reduces the number of records Firehose bills for when events
+    are small. Events that have an original document in `raw` are written
+    as that document.
+    """
+    encoded = (encode_event(_original(event, raw)) for event in events)
+    if not pack:
+        return [{"Data": data} for data in encoded]
+
+    records, buf, buf_bytes = [], [], 0
+    for data in encoded:
+        if buf and buf_bytes + len(data) > max_bytes:
+            records.append({"Data": b"".join(buf)})
+            buf, buf_bytes = [], 0
+        buf.append(data)
+        buf_bytes += len(data)
+    if buf:
+        records.append({"Data": b"".join(buf)})
+    return records
+
+
+def _original(event, raw):
+    """The original document of an event, if known, or the event itself."""
+    document = raw.get(event) if raw else None
+    if document is None:
+        return event
+    return document + "\n"
+
+
+def chunk_records(records, max_records=MAX_RECORDS_PER_CALL,
+                  max_bytes=MAX_BYTES_PER_CALL):
+    """Split records into batches for one PutRecordBatch call each."""
+    chunk, chunk_bytes = [], 0
+    for record in records:
+        size = len(record["Data"])
+        if size > MAX_BYTES_PER_RECORD:
+            raise FirehoseError(
+                "Record of {} bytes exceeds the Firehose limit of {}".format(
+                    size, MAX_BYTES_PER_RECORD))
+        if chunk and (len(chunk) == max_records or
+                      chunk_bytes + size > max_bytes):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(record)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def put_record_batch(records, stream_name, client=None, max_attempts=None):
+    """Send records to a Firehose delivery stream.
+
+    Records are split in as many calls as needed to stay within the service
+    limits, and the records of a partially failed call are re-submitted
+    with jittered exponential backoff. Returns the metrics of every call.
+    """
+    if max_attempts is None:
+        max_attempts = int(os.environ.get("FIREHOSE_MAX_ATTEMPTS") or 5)
+    client = client or clients.get_client("firehose")
+    metrics = []
+    for chunk in chunk_records(records):
+        metrics += _put_chunk(client, chunk, stream_name, max_attempts)
+    return metrics
+
+
+def _put_chunk(client, chunk, stream_name, max_attempts):
+    """Send one batch of records, re-submitting the failed ones."""
+    metrics = []
+    for attempt in range(max_attempts):
+        if attempt:
+            backoff(attempt)
+        start = time.time()
+        resp = client.put_record_batch(DeliveryStreamName=stream_name,
+                                       Records=chunk)
+        duration = time.time() - start
+        if resp["ResponseMetadata"]["HTTPStatusCode"] != 200:
+            raise FirehoseError(json.dumps(resp))
+
+        failed = [rec for rec, result
+                  in zip(chunk, resp.get("RequestResponses", []))
+                  if result.get("ErrorCode")]
+        this = PutMetrics(stream_name, len(chunk),
+                          sum(len(rec["Data"]) for rec in chunk),
+                          len(failed), attempt, duration)
+        log_metrics("PutRecordBatch", this)
+        metrics.append(this)
+        if not failed:
+            return metrics
+        chunk = failed
+
+    error_codes = sorted({result["ErrorCode"]
+                          for result in resp["RequestResponses"]
+                          if result.get("ErrorCode")})
+    raise FirehoseError(
+        "{} records could not be delivered to '{}' after {} attempts: "
+        "{}".format(len(chunk), stream_name, max_attempts, error_codes))
@@ -0,0 +1,174 @@
+"""Detect hot partition keys and spread their records across shards.
+
+All the records with the same partition key go to the same shard, so a
+single heavy key can saturate one shard of an output stream while the
+others sit idle. The partition keys of the records sent to a stream are
+counted with a space-saving sketch, which takes bounded memory whatever
+the number of distinct keys: the most frequent keys are logged as
+metrics, and keys that take a large share of the records can be spread:
+
+- ``salt``: a suffix cycling through ``hot_key_spread`` values is added to
+  the partition key of the records of a hot key.
+- ``explicit-hash-key``: the partition key is kept and the records of a
+  hot key are routed with ``hot_key_spread`` explicit hash keys spaced
+  evenly over the hash key range.
+
+Either way the records of a hot key are no longer read in order by the
+consumers of the stream, so keys are never spread for outputs that are
+declared ordered.
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import os
+
+from lambdautils.exception import CriticalError
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+REPORT = "report"
+SALT = "salt"
+EXPLICIT_HASH_KEY = "explicit-hash-key"
+POLICIES = (REPORT, SALT, EXPLICIT_HASH_KEY)
+
+# The number of keys counted by the sketch, per key reported
+CAPACITY_FACTOR = 10
+
+# The share of the records of a batch above which a key is hot
+HOT_SHARE = 0.1
+
+DEFAULT_SPREAD = 8
+
+SALT_SEPARATOR = "#"
+
+HASH_KEY_RANGE = 2 ** 128
+
+
+def top_keys():
+    """The number of hot keys reported per stream, 0 if none."""
+    return int(os.environ.get("HOT_KEYS") or 0)
+
+
+def policy():
+    """What is done with the records of hot keys."""
+    value = os.environ.get("HOT_KEY_POLICY") or REPORT
+    if value not in POLICIES:
+        raise CriticalError("Unknown hot key policy '{}': must be one of "
+                            "{}".format(value, ", ".join(POLICIES)))
+    return value
+
+
+def spread():
+    """The number of partition keys or hash keys a hot key is spread to."""
+    return int(os.environ.get("HOT_KEY_SPREAD") or DEFAULT_SPREAD)
+
+
+class SpaceSaving(object):
+
+    """Count the most frequent items of a stream in bounded memory.
+
+    At most `capacity` items are counted. An item that is not counted
+    replaces the item with the lowest count, and inherits that count as
+    its maximum overestimation. Any item more frequent than 1/capacity of
+    the stream is guaranteed to be counted.
+
+    The item with the lowest count is found with a min-heap holding one
+    (count, item) entry per item. Entries are not updated when an item is
+    counted again: an entry found to be stale is pushed back with the
+    current count, so that an eviction takes O(log capacity) amortized.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        # item -> [count, maximum overestimation]
+        self.counts = {}
+        # (count when pushed, item), a lower bound of the count of the item
+        self._heap = []
+
+    def add(self, item, weight=1):
+        self.total += weight
+        counter = self.counts.get(item)
+        if counter is not None:
+            counter[0] += weight
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[item] = [weight, 0]
+            heapq.heappush(self._heap, (weight, item))
+            return
+        count = self._evict()
+        self.counts[item] = [count + weight, count]
+        heapq.heappush(self._heap, (count + weight, item))
+
+    def _evict(self):
+        """Stop counting the item with the lowest count, return its count."""
+        while True:
+            count, item = self._heap[0]
+            current = self.counts[item][0]
+            if current == count:
+                heapq.heappop(self._heap)
+                del self.counts[item]
+                return count
+            heapq.heapreplace(self._heap, (current, item))
+
+    def top(self, n):
+        """The `n` most frequent items, as (item, count, error) tuples."""
+        ranked = sorted(self.counts.items(), key=lambda kv: -kv[1][0])
+        return [(item, count, error) for item, (count, error) in ranked[:n]]
+
+
+def track(records, stream, nkeys):
+    """Count the partition keys of records and log the hottest ones.
+
+    Returns the sketch of the keys.
+    """
+    sketch = SpaceSaving(nkeys * CAPACITY_FACTOR)
+    for record in records:
+        sketch.add(record["PartitionKey"])
+    logger.info("Hot keys of '%s': %s", stream, json.dumps({
+        "records": sketch.total,
+        "keys": [{"key": key, "records": count, "error": error,
+                  "share": round(count / float(sketch.total), 3)}
+                 for key, count, error in sketch.top(nkeys)]}))
+    return sketch
+
+
+def hot(sketch, nkeys):
+    """The keys of a sketch that certainly take more than HOT_SHARE."""
+    threshold = HOT_SHARE * sketch.total
+    return {key for key, count, error in sketch.top(nkeys)
+            if count - error > threshold}
+
+
+def balance(records, keys, how, nslots):
+    """Spread the records of the `keys` that are hot over `nslots` slots.
+
+    Records are assigned to slots in turn. Returns the records, of which
+    those with a hot key have been modified.
+    """
+    if not keys or how == REPORT:
+        return records
+    slots = dict.fromkeys(keys, 0)
+    balanced = []
+    for record in records:
+        key = record["PartitionKey"]
+        if key in slots:
+            slot = slots[key]
+            slots[key] = (slot + 1) % nslots
+            if how == SALT:
+                record = dict(record, PartitionKey="{}{}{}".format(
+                    key, SALT_SEPARATOR, slot))
+            else:
+                record = dict(record, ExplicitHashKey=str(
+                    _hash_key(key, slot, nslots)))
+        balanced.append(record)
+    return balanced
+
+
+def _hash_key(key, slot, nslots):
+    """The hash key of a slot: slots are evenly spaced from the key hash."""
+    start = int(hashlib.md5(key.encode("utf-8")).hexdigest(), 16)
+    return (start + slot * (HASH_KEY_RANGE // nslots)) % HASH_KEY_RANGE
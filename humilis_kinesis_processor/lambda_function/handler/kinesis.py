@@ -0,0 +1,198 @@
+"""Write records to Kinesis streams within the PutRecords service limits."""
+
+from collections import namedtuple
+import json
+import logging
+import os
+import random
+import time
+import uuid
+
+from . import clients
+from . import ratelimit
+from .schemas import json_default
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+# PutRecords service limits
+MAX_RECORDS_PER_CALL = 500
+MAX_BYTES_PER_CALL = 5 * 1024 * 1024
+MAX_BYTES_PER_RECORD = 1024 * 1024
+
+# Backoff between attempts to re-submit failed records, in seconds
+BASE_DELAY = 0.1
+MAX_DELAY = 5.0
+
+PutMetrics = namedtuple(
+    "PutMetrics", "stream records bytes failed attempt duration")
+
+
+class KinesisError(Exception):
+
+    """Kinesis API error."""
+
+    pass
+
+
+def _to_json(event):
+    """Encode an event as a JSON document."""
+    return json.dumps(event, default=json_default)
+
+
+def make_records(events, partition_key=None, serializer=None, packer=None,
+                 raw=None):
+    """Encode a list of events as PutRecords entries.
+
+    Events that have an original document in `raw` are sent as that
+    document instead of being serialized again.
+    """
+    serializer = serializer or _to_json
+    records = []
+    for event in events:
+        if not partition_key:
+            partition_key_value = str(uuid.uuid4())
+        elif hasattr(partition_key, "__call__"):
+            partition_key_value = partition_key(event)
+        else:
+            partition_key_value = partition_key
+
+        document = raw.get(event) if raw else None
+        if document is not None:
+            event = document
+        elif not isinstance(event, str):
+            event = serializer(event)
+
+        if packer:
+            event = packer(event)
+
+        records.append({"Data": event, "PartitionKey": partition_key_value})
+    return records
+
+
+def record_size(record):
+    """The number of bytes a record counts towards the service limits."""
+    data = record["Data"]
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    return len(data) + len(record["PartitionKey"].encode("utf-8"))
+
+
+def chunk_records(records, max_records=MAX_RECORDS_PER_CALL,
+                  max_bytes=MAX_BYTES_PER_CALL):
+    """Split records into batches that can be sent in one PutRecords call."""
+    chunk, chunk_bytes = [], 0
+    for record in records:
+        size = record_size(record)
+        if size > MAX_BYTES_PER_RECORD:
+            raise KinesisError(
+                "Record of {} bytes exceeds the Kinesis limit of {}".format(
+                    size, MAX_BYTES_PER_RECORD))
+        if chunk and (len(chunk) == max_records or
+                      chunk_bytes + size > max_bytes):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(record)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def put_records(records, stream_name, client=None, max_attempts=None):
+    """Send records to a Kinesis stream.
+
+    Records are split in as many calls as needed to stay within the service
+    limits. Records that fail to be ingested (e.g. because the shard was
+    throttled) are re-submitted, with jittered exponential backoff, up to
+    `max_attempts` times. Returns a list with the metrics of every call.
+
+    If rate limiting is enabled the records are paced per shard (see the
+    ratelimit module) so that they are not throttled in the first place.
+    """
+    if max_attempts is None:
+        max_attempts = int(os.environ.get("KINESIS_MAX_ATTEMPTS") or 5)
+    client = client or clients.get_client("kinesis")
+    limiter = None
+    if ratelimit.enabled():
+        limiter = ratelimit.get_limiter(stream_name, client)
+    if limiter is None:
+        metrics = []
+        for chunk in chunk_records(records):
+            metrics += _put_chunk(client, chunk, stream_name, max_attempts)
+        return metrics
+    return _put_paced(client, records, stream_name, max_attempts, limiter)
+
+
+def _put_paced(client, records, stream_name, max_attempts, limiter):
+    """Send records as fast as the budgets of their shards allow."""
+    metrics = []
+    while records:
+        ready, records, wait = limiter.take(records, record_size)
+        for chunk in chunk_records(ready):
+            metrics += _put_chunk(client, chunk, stream_name, max_attempts,
+                                  limiter)
+        if records:
+            logger.info("Holding %d records back from hot shards for "
+                        "%.3f s", len(records), wait)
+            time.sleep(wait)
+    return metrics
+
+
+def _pace(limiter, records):
+    """Wait until the shards of records can all take them."""
+    while records:
+        _, records, wait = limiter.take(records, record_size)
+        if records:
+            time.sleep(wait)
+
+
+def _put_chunk(client, chunk, stream_name, max_attempts, limiter=None):
+    """Send one batch of records, re-submitting the failed ones.
+
+    Re-submitted records are paced like the others if a rate `limiter` is
+    given.
+    """
+    metrics = []
+    for attempt in range(max_attempts):
+        if attempt:
+            backoff(attempt)
+            if limiter is not None:
+                _pace(limiter, chunk)
+        start = time.time()
+        resp = client.put_records(StreamName=stream_name, Records=chunk)
+        duration = time.time() - start
+        if resp["ResponseMetadata"]["HTTPStatusCode"] != 200:
+            raise KinesisError(json.dumps(resp))
+
+        failed = [rec for rec, result in zip(chunk, resp.get("Records", []))
+                  if result.get("ErrorCode")]
+        if limiter is not None:
+            limiter.feedback(chunk, resp.get("Records", []))
+        this = PutMetrics(stream_name, len(chunk),
+                          sum(record_size(rec) for rec in chunk),
+                          len(failed), attempt, duration)
+        log_metrics("PutRecords", this)
+        metrics.append(this)
+        if not failed:
+            return metrics
+        chunk = failed
+
+    error_codes = sorted({result["ErrorCode"] for result in resp["Records"]
+                          if result.get("ErrorCode")})
+    raise KinesisError(
+        "{} records could not be delivered to '{}' after {} attempts: "
+        "{}".format(len(chunk), stream_name, max_attempts, error_codes))
+
+
+def backoff(attempt):
+    """Sleep before a retry, using exponential backoff with full jitter."""
+    time.sleep(random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt)))
+
+
+def log_metrics(api, metrics):
+    """Log the throughput of a call to a batch write API."""
+    duration = max(metrics.duration, 1e-6)
+    logger.info("%s metrics: %s", api, json.dumps(dict(
+        metrics._asdict(),
+        records_per_second=round(metrics.records / duration, 1),
+        bytes_per_second=round(metrics.bytes / duration, 1))))
@@ -0,0 +1,217 @@
+"""Support for the aggregated record format of the Kinesis Producer Library.
+
+An aggregated record is made of a magic number, an AggregatedRecord
+protobuf message and the MD5 digest of the message::
+
+    message AggregatedRecord {
+        repeated string partition_key_table = 1;
+        repeated string explicit_hash_key_table = 2;
+        repeated Record records = 3;
+    }
+
+    message Record {
+        required uint64 partition_key_index = 1;
+        optional uint64 explicit_hash_key_index = 2;
+        required bytes data = 3;
+        repeated Tag tags = 4;
+    }
+
+The messages are encoded and decoded here directly, so that no protobuf
+runtime is needed in the Lambda package.
+"""
+
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+import copy
+import hashlib
+import uuid
+
+from .kinesis import MAX_BYTES_PER_RECORD
+
+MAGIC = b"\xf3\x89\x9a\xc2"
+DIGEST_SIZE = 16
+# The base64 encoding of the first 3 bytes of the magic number
+B64_PREFIX = "84ma"
+
+
+def _varint(value):
+    """Encode an unsigned integer as a protobuf varint."""
+    out = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _read_varint(buf, pos):
+    """Decode a protobuf varint, returning its value and the next position."""
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf):
+    """Iterate over the (field number, value) pairs of a protobuf message."""
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 2:
+            size, pos = _read_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported wire type {}".format(wire_type))
+        yield number, value
+
+
+def _length_delimited(number, payload):
+    """Encode a length-delimited protobuf field."""
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _to_bytes(data):
+    """Record data as bytes."""
+    if isinstance(data, bytes):
+        return data
+    return data.encode("utf-8")
+
+
+def is_aggregated(payload):
+    """True if a (decoded) record payload is a KPL aggregated record."""
+    return (payload[:len(MAGIC)] == MAGIC and
+            len(payload) >= len(MAGIC) + DIGEST_SIZE and
+            hashlib.md5(payload[len(MAGIC):-DIGEST_SIZE]).digest() ==
+            payload[-DIGEST_SIZE:])
+
+
+def deaggregate(payload):
+    """Extract the (partition key, explicit hash key, data) sub-records."""
+    pkeys, ehkeys, records = [], [], []
+    for number, value in _fields(payload[len(MAGIC):-DIGEST_SIZE]):
+        if number == 1:
+            pkeys.append(value.decode("utf-8"))
+        elif number == 2:
+            ehkeys.append(value.decode("utf-8"))
+        elif number == 3:
+            records.append(value)
+
+    for record in records:
+        pkey = ehkey = data = None
+        for number, value in _fields(record):
+            if number == 1:
+                pkey = pkeys[value]
+            elif number == 2:
+                ehkey = ehkeys[value]
+            elif number == 3:
+                data = bytes(value)
+        yield pkey, ehkey, data
+
+
+def deaggregate_records(records):
+    """De-aggregate the records of a Lambda Kinesis event.
+
+    Every sub-record of an aggregated record becomes a record of its own,
+    with the sequence number of the aggregated record and the index of the
+    sub-record as its `subSequenceNumber`. Other records are left untouched.
+    """
+    result = []
+    for rec in records:
+        data = rec["kinesis"]["data"]
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        if not data.startswith(B64_PREFIX):
+            result.append(rec)
+            continue
+        payload = b64decode(data)
+        if not is_aggregated(payload):
+            result.append(rec)
+            continue
+        for index, (pkey, ehkey, subdata) in enumerate(deaggregate(payload)):
+            subrec = copy.copy(rec)
+            subrec["kinesis"] = dict(
+                rec["kinesis"],
+                data=b64encode(subdata).decode("utf-8"),
+                partitionKey=pkey,
+                subSequenceNumber=index,
+                aggregated=True)
+            if ehkey is not None:
+                subrec["kinesis"]["explicitHashKey"] = ehkey
+            result.append(subrec)
+    return result
+
+
+class Aggregator(object):
+
+    """Aggregate data blobs with the same partition key in one record."""
+
+    def __init__(self, partition_key, max_bytes=MAX_BYTES_PER_RECORD):
+        self.partition_key = partition_key
+        pkey = _to_bytes(partition_key)
+        # The partition key table has a single entry: the outer partition key
+        self.header = _length_delimited(1, pkey)
+        # The outer partition key counts towards the record size limit
+        self.max_bytes = max_bytes - len(pkey) - len(MAGIC) - DIGEST_SIZE
+        self.entries = []
+        self.size = len(self.header)
+
+    def add(self, data):
+        """Add a sub-record. Returns False if it does not fit."""
+        entry = _length_delimited(
+            3, _varint(1 << 3) + _varint(0) + _length_delimited(3, data))
+        if self.entries and self.size + len(entry) > self.max_bytes:
+            return False
+        self.entries.append(entry)
+        self.size += len(entry)
+        return True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def serialize(self):
+        """The aggregated record as a PutRecords entry."""
+        message = self.header + b"".join(self.entries)
+        return {"Data": MAGIC + message + hashlib.md5(message).digest(),
+                "PartitionKey": self.partition_key}
+
+
+def aggregate_records(records, group_by_key=True):
+    """Aggregate PutRecords entries into as few records as possible.
+
+    If `group_by_key` is set, only records with the same partition key are
+    aggregated together, so that every event lands in the same shard it
+    would have landed in without aggregation. Otherwise records are
+    aggregated regardless of their partition key, under random keys.
+    """
+    groups = OrderedDict()
+    for record in records:
+        key = record["PartitionKey"] if group_by_key else None
+        groups.setdefault(key, []).append(_to_bytes(record["Data"]))
+
+    aggregated = []
+    for key, group in groups.items():
+        agg = Aggregator(key or str(uuid.uuid4()))
+        for data in group:
+            if not agg.add(data):
+                aggregated.append(agg.serialize())
+                agg = Aggregator(key or str(uuid.uuid4()))
+                agg.add(data)
+        aggregated.append(agg.serialize())
+    return aggregated
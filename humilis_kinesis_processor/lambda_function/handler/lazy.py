@@ -0,0 +1,287 @@
+"""Events that are only decoded as far as filters need.
+
+A lazy event keeps the JSON document it comes from and answers lookups of
+top-level fields by decoding only the value of that field. The whole
+document is decoded the first time the event is modified, iterated over
+or a field that holds a container is accessed. From then on the event is
+a copy-on-write view of the decoded document.
+
+Lookups are only answered without a full decode when the document layout
+makes that safe: a flat object without arrays or escaped quotes. Anything
+else is decoded in full on first access. Fields are decoded with the JSON
+decoder of the standard library, so documents decoded with any other
+deserializer (e.g. orjson, or json.loads with an object_hook) are always
+decoded in full, so that they decode the same as eagerly decoded events.
+
+Until it is decoded, the storage of a lazy event holds a placeholder
+rather than being empty, so that code that reads the storage of a dict
+directly goes through the methods of the event when it finds it is not
+empty (e.g. json.dumps, whose C encoder skips empty dicts). Events are
+decoded under a lock, so several threads may read the same event. Still,
+only filters get lazy events: every other callable and every sink gets
+events that are fully decoded.
+"""
+
+from base64 import b64decode
+import json
+import logging
+import os
+import re
+import threading
+
+from lambdautils.utils import BadKinesisEventError
+
+from .columnar import format_timestamp
+from .passthrough import RawDocuments, embed_field
+from .views import CowDict
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+_decoder = json.JSONDecoder()
+
+# The only key of a lazy event until it is decoded
+_PENDING = object()
+_whitespace = re.compile(r"[ \t\r\n]*")
+
+
+class Document(object):
+
+    """A serialized event, shared by all the lazy views of the event."""
+
+    __slots__ = ("text", "extra", "loads", "_fields", "_parsed",
+                 "_scannable")
+
+    def __init__(self, text, loads=None, extra=None):
+        self.text = text
+        self.loads = loads or json.loads
+        # Fields added to the event when it was received
+        self.extra = extra or {}
+        # key -> (found, value) for the fields decoded so far
+        self._fields = {}
+        self._parsed = None
+        self._scannable = None
+
+    def parsed(self):
+        """The fully decoded document (shared: must not be modified)."""
+        if self._parsed is None:
+            try:
+                parsed = self.loads(self.text)
+            except ValueError:
+                try:
+                    parsed = self.loads(self.text.replace("\\'", "'"))
+                except Exception:
+                    logger.error("Invalid serialized payload: %s", self.text)
+                    raise
+            if isinstance(parsed, dict):
+                parsed.update(self.extra)
+            self._parsed = parsed
+        return self._parsed
+
+    def scannable(self):
+        """True if top-level fields can be found without decoding."""
+        if self._scannable is None:
+            text = self.text
+            self._scannable = (self.loads is json.loads and
+                               text.count("{") == 1 and "[" not in text and
+                               '\\"' not in text)
+        return self._scannable
+
+    def lookup(self, key):
+        """Find a top-level field.
+
+        Returns (True, value) or (False, None) if the field is not in the
+        document, or None if that cannot be told without a full decode.
+        """
+        if key in self.extra:
+            return True, self.extra[key]
+        if self._parsed is not None:
+            return key in self._parsed, self._parsed.get(key)
+        if key in self._fields:
+            return self._fields[key]
+        if not isinstance(key, str) or not self.scannable():
+            return None
+
+        text = self.text
+        quoted = json.dumps(key, ensure_ascii=False)
+        # Duplicate keys: the last one wins, as in json.loads
+        end = len(text)
+        result = None
+        while result is None:
+            pos = text.rfind(quoted, 0, end)
+            if pos < 0:
+                if "\\" in text:
+                    # The key may be written with escape sequences
+                    return None
+                result = (False, None)
+                break
+            end = pos
+            before = pos - 1
+            while before >= 0 and text[before] in " \t\r\n":
+                before -= 1
+            after = _whitespace.match(text, pos + len(quoted)).end()
+            if (before >= 0 and text[before] in "{," and
+                    text[after:after + 1] == ":"):
+                start = _whitespace.match(text, after + 1).end()
+                result = (True, _decoder.raw_decode(text, start)[0])
+        self._fields[key] = result
+        return result
+
+
+def _loading(method):
+    """Decode the event in full before calling a dict method."""
+    def wrapper(self, *args, **kwargs):
+        self._load()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class LazyEvent(CowDict):
+
+    """A dict that decodes the fields of a JSON document on demand."""
+
+    __slots__ = ("_document", "_loaded", "_lock")
+
+    def __init__(self, document):
+        CowDict.__init__(self)
+        dict.__setitem__(self, _PENDING, None)
+        self._document = document
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Decode the whole document into the event."""
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                parsed = self._document.parsed()
+                dict.update(self, parsed)
+                dict.__delitem__(self, _PENDING)
+                self._loaded = True
+
+    def _peek(self, key):
+        """Look up a field that can be handed out without decoding it all."""
+        if self._loaded:
+            return None
+        found = self._document.lookup(key)
+        if found is not None and isinstance(found[1], (dict, list)):
+            # Containers must become private views of the decoded event
+            return None
+        return found
+
+    def __getitem__(self, key):
+        found = self._peek(key)
+        if found is None:
+            self._load()
+            return CowDict.__getitem__(self, key)
+        if not found[0]:
+            raise KeyError(key)
+        return found[1]
+
+    def __contains__(self, key):
+        found = self._peek(key)
+        if found is None:
+            self._load()
+            return dict.__contains__(self, key)
+        return found[0]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def view(self):
+        """A lazy view of the event, for a filter."""
+        if self._loaded:
+            return CowDict(self)
+        return LazyEvent(self._document)
+
+    def copy(self):
+        return CowDict(self)
+
+    __copy__ = copy
+
+    __setitem__ = _loading(CowDict.__setitem__)
+    __delitem__ = _loading(dict.__delitem__)
+    __iter__ = _loading(CowDict.__iter__)
+    __len__ = _loading(dict.__len__)
+    __eq__ = _loading(dict.__eq__)
+    __ne__ = _loading(dict.__ne__)
+    __repr__ = _loading(dict.__repr__)
+    keys = _loading(dict.keys)
+    values = _loading(CowDict.values)
+    items = _loading(CowDict.items)
+    pop = _loading(CowDict.pop)
+    popitem = _loading(CowDict.popitem)
+    setdefault = _loading(CowDict.setdefault)
+    update = _loading(CowDict.update)
+    clear = _loading(dict.clear)
+    _materialize = _loading(CowDict._materialize)
+    __deepcopy__ = _loading(CowDict.__deepcopy__)
+    __reduce__ = _loading(CowDict.__reduce__)
+
+
+def load(event):
+    """Decode an event in full, if it is a lazy event."""
+    if isinstance(event, LazyEvent):
+        event._load()
+    return event
+
+
+def loaded(events, raw=None):
+    """Decode the lazy events of a batch, except those found in `raw`."""
+    for event in events:
+        if raw is None or raw.get(event) is None:
+            load(event)
+    return events
+
+
+def unpack_kinesis_event(kinesis_event, deserializer=None, unpacker=None,
+                         embed_timestamp=None, keep_raw=False):
+    """Extract lazy events from a Kinesis event.
+
+    Records that are not JSON objects are decoded straight away, exactly
+    like lambdautils.utils.unpack_kinesis_event does. If `keep_raw` is set
+    the documents of the events are returned too, for passthrough.
+    """
+    events, shard_ids = [], set()
+    raw = RawDocuments() if keep_raw else None
+    for rec in kinesis_event["Records"]:
+        data = rec["kinesis"]["data"]
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        payload = b64decode(data)
+        if unpacker:
+            payload = unpacker(payload)
+        shard_ids.add(rec["eventID"].split(":")[0])
+        if isinstance(payload, bytes):
+            payload = payload.decode()
+
+        extra = {}
+        if embed_timestamp:
+            extra[embed_timestamp] = format_timestamp(
+                rec["kinesis"].get("approximateArrivalTimestamp"))
+        if not deserializer or not payload.lstrip().startswith("{"):
+            event = payload
+            if deserializer:
+                event = Document(payload, deserializer, extra).parsed()
+        else:
+            event = LazyEvent(Document(payload, deserializer, extra))
+            # Documents that need fixing to be decoded cannot be forwarded
+            if raw is not None and "\\'" not in payload:
+                document = payload
+                for key, value in extra.items():
+                    document = document and embed_field(document, key, value)
+                if document is not None:
+                    raw.add(event, document)
+        events.append(event)
+
+    if len(shard_ids) > 1:
+        raise BadKinesisEventError(
+            "Kinesis event contains records from several shards: {}".format(
+                shard_ids))
+
+    return events, shard_ids.pop(), raw
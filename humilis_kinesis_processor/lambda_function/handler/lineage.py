@@ -0,0 +1,85 @@
+"""The lineage of events: the input record every event comes from.
+
+Every stage of a pipeline returns, along with the events it produces, the
+position in its input of the event that produced each of them. Deriving
+the lineage of a stage output from the lineage of its input is a single
+lookup per event, so the input event and the record sequence number of
+every event are known in constant time after any number of stages,
+whatever the number of events each event fans out to.
+
+Batch mappers may return any number of events, in which case the lineage
+of their output is lost: the events are attributed to the whole batch.
+"""
+
+from collections import namedtuple
+
+# Where an event comes from: the position of the input event in the batch
+# and the sequence number of its record
+Source = namedtuple("Source", "index seqnum")
+
+
+class Lineage(object):
+
+    """The input events a batch of events was produced from."""
+
+    __slots__ = ("indices", "seqnums", "keys", "known")
+
+    def __init__(self, seqnums, indices=None, keys=None, known=True):
+        # The sequence number of the record of every input event
+        self.seqnums = seqnums
+        # The position of the input event of every event of the batch
+        self.indices = range(len(seqnums)) if indices is None else indices
+        # The partition key of the record of every input event
+        self.keys = keys
+        # False if the input events of the batch are not known
+        self.known = known
+
+    @classmethod
+    def from_records(cls, records, counts=None):
+        """The lineage of the events decoded from Lambda Kinesis records.
+
+        `counts` is the number of events decoded from every record, if a
+        record may hold any number of events rather than exactly one.
+        """
+        seqnums = [rec["kinesis"]["sequenceNumber"] for rec in records]
+        keys = [rec["kinesis"].get("partitionKey") for rec in records]
+        if counts is not None:
+            seqnums = [seqnum for seqnum, count in zip(seqnums, counts)
+                       for _ in range(count)]
+            keys = [key for key, count in zip(keys, counts)
+                    for _ in range(count)]
+        return cls(seqnums, keys=keys)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def index(self, position):
+        """The position of the input event an event comes from."""
+        return self.indices[position]
+
+    def source(self, position):
+        """The input event and the record an event comes from."""
+        index = self.indices[position]
+        return Source(index, self.seqnums[index])
+
+    def partition_keys(self):
+        """The partition key of the record of every event, if known."""
+        if self.keys is None or not self.known:
+            return None
+        keys = self.keys
+        return [keys[index] for index in self.indices]
+
+    def derive(self, positions, count=None):
+        """The lineage of the events produced by a stage.
+
+        `positions` are the positions in this batch of the events that
+        produced every event of the stage output, or None if they are not
+        known, in which case the `count` events of the output are all
+        attributed to the first event of this batch.
+        """
+        indices = self.indices
+        if positions is None:
+            first = indices[0] if len(indices) else 0
+            return Lineage(self.seqnums, [first] * count, self.keys, False)
+        return Lineage(self.seqnums, [indices[pos] for pos in positions],
+                       self.keys, self.known)
@@ -0,0 +1,110 @@
+"""Forward unmodified events as the documents they were decoded from.
+
+Filters and mappers only ever see copy-on-write views of the input events,
+so an event that reaches a sink as the very same object it was decoded
+into has not been modified. Such an event can be written as its original
+serialized document, skipping a serializer round trip.
+
+This assumes that the records are JSON documents (Firehose sinks write
+JSON) and that kinesis_serializer is the inverse of kinesis_deserializer.
+"""
+
+from base64 import b64decode
+import json
+import logging
+import os
+
+from lambdautils.utils import BadKinesisEventError
+
+from .columnar import format_timestamp
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+
+class RawDocuments(object):
+
+    """The serialized documents that the events of a batch come from."""
+
+    def __init__(self):
+        # id of the event -> (event, document). Holding a reference to the
+        # event guarantees that its id is not reused by another object.
+        self._documents = {}
+
+    def add(self, event, document):
+        """Record the document an event was decoded from."""
+        self._documents[id(event)] = (event, document)
+
+    def get(self, event):
+        """The original document of an event, or None if there is none."""
+        entry = self._documents.get(id(event))
+        if entry is not None and entry[0] is event:
+            return entry[1]
+
+    def __len__(self):
+        return len(self._documents)
+
+
+def embed_field(document, field, value):
+    """Add a top-level field to a serialized JSON object.
+
+    Returns None if the field cannot be added without parsing the document.
+    """
+    document = document.rstrip()
+    if not document.endswith("}") or json.dumps(field) in document:
+        return None
+    body = document[:-1].rstrip()
+    separator = ", " if not body.endswith("{") else ""
+    return "{}{}{}: {}}}".format(
+        body, separator, json.dumps(field), json.dumps(value))
+
+
+def unpack_kinesis_event(kinesis_event, deserializer=None, unpacker=None,
+                         embed_timestamp=None):
+    """Extract the events of a Kinesis event and their original documents.
+
+    Decodes events exactly like lambdautils.utils.unpack_kinesis_event.
+    """
+    events, shard_ids = [], set()
+    raw = RawDocuments()
+    for rec in kinesis_event["Records"]:
+        data = rec["kinesis"]["data"]
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        payload = b64decode(data)
+        if unpacker:
+            payload = unpacker(payload)
+        shard_ids.add(rec["eventID"].split(":")[0])
+        if isinstance(payload, bytes):
+            payload = payload.decode()
+
+        document = payload
+        if deserializer:
+            try:
+                payload = deserializer(payload)
+            except ValueError:
+                try:
+                    payload = deserializer(payload.replace("\\'", "'"))
+                except Exception:
+                    logger.error("Invalid serialized payload: %s", payload)
+                    raise
+                # The document cannot be forwarded as it is
+                document = None
+
+        if isinstance(payload, dict):
+            if embed_timestamp:
+                ts = format_timestamp(
+                    rec["kinesis"].get("approximateArrivalTimestamp"))
+                payload[embed_timestamp] = ts
+                if document is not None:
+                    document = embed_field(document, embed_timestamp, ts)
+            if document is not None:
+                raw.add(payload, document)
+        events.append(payload)
+
+    if len(shard_ids) > 1:
+        raise BadKinesisEventError(
+            "Kinesis event contains records from several shards: {}".format(
+                shard_ids))
+
+    return events, shard_ids.pop(), raw
@@ -4,17 +4,40 @@ from __future__ import print_function
 # preprocessor:jinja2
 
 import copy
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import heapq
+import inspect
 import operator
 import logging
 import os
 import json
+import pickle
 import sys
+import traceback
 import uuid
 
 import lambdautils.utils as utils
 from lambdautils.exception import CriticalError, ProcessingError
-from werkzeug.utils import import_string  # noqa
+
+from . import clients
+from . import columnar
+from . import compression
+from . import executor
+from . import failures
+from . import firehose
+from . import hotkeys
+from . import kinesis
+from . import kpl
+from . import lazy
+from .lineage import Lineage
+from . import passthrough
+from . import schemas
+from . import serialization
+from . import workers
+from .firehose import FirehoseError  # noqa
+from .kinesis import KinesisError  # noqa
+from .plan import Codecs, import_string, is_true  # noqa
+from .views import isolate, materialize
 
 
 logger = logging.getLogger()
@@ -22,78 +45,204 @@ logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
 
 EventError = namedtuple("EventError", "index event error tb")
 
+# The codecs are resolved once per container
+_codecs = []
 
-class KinesisError(Exception):
+# The stages that need the events of a columnar batch as dicts
+ROW_STAGES = ("filter", "mapper", "batch_flatmapper")
 
-    """Kinesis API error."""
+# The ways per-event filters and mappers can be run
+ENGINES = ("inline", "process", "thread", "async")
 
-    pass
+# Chunks of events sent to every worker process, to even out their load
+CHUNKS_PER_WORKER = 4
 
+DEFAULT_MAPPER_CONCURRENCY = 10
 
-class FirehoseError(Exception):
 
-    """Firehose API Error."""
+def process_event(kevent, context, inputp, outputp):
+    """Process records in the incoming Kinesis event."""
+    oevents, failed, _, _ = _process(kevent, context, inputp, outputp)
+    if failed:
+        raise ProcessingError(failed)
 
-    pass
+    return oevents
 
 
-def process_event(kevent, context, inputp, outputp):
-    """Process records in the incoming Kinesis event."""
-    input_events, shard_id = _get_records(kevent)
+def process_batch(kevent, context, inputp, outputp):
+    """Process records, reporting the first failed record to Lambda.
+
+    Only the events produced by the records before the first failed record
+    are delivered. Returns the output events, the errors and the
+    BatchItemFailures response of the function.
+    """
+    oevents, failed, seqnum, _ = _process(kevent, context, inputp, outputp,
+                                          partial=True)
+    return oevents, failed, failures.response(seqnum)
+
+
+def _process(kevent, context, inputp, outputp, partial=False, buffer=None):
+    """Process records in a Kinesis event.
+
+    Returns the output events, the errors, the sequence number of the first
+    failed record if `partial` is set and the number of input events. If a
+    `buffer` is given the records to deliver are added to it instead of
+    being sent. If `partial` is set a record that cannot be decoded is
+    reported as failed, and only the records before it are processed.
+    """
+    bad = None
+    try:
+        input_events, shard_id, raw, lineage = _get_records(kevent)
+    except CriticalError:
+        raise
+    except Exception:
+        bad = partial and _find_bad_record(kevent)
+        if not bad:
+            raise
+        if not bad.index:
+            return ([[] for _ in outputp] if outputp else [], [bad],
+                    _seqnum(bad.event), 0)
+        kevent = dict(kevent, Records=kevent["Records"][:bad.index])
+        input_events, shard_id, raw, lineage = _get_records(kevent)
 
     # The humilis context to pass to filters and mappers
     hcontext = _make_humilis_context(shard_id=shard_id, lambda_context=context)
 
     nbevents = len(input_events)
     logger.info("Going to process %s events", nbevents)
-    logger.info("First event: %s", pretty(input_events[0]))
+    logger.info("First event: %s", pretty(columnar.row(input_events, 0)))
 
     # Records that threw an exception in the input or output pipelines
     failed = []
+    # Archival of the input events runs while the pipelines are processed,
+    # unless it must wait to know which events are to be delivered
+    archival = []
+    input_delivery_stream = inputp and inputp.get("firehose_delivery_stream")
+    if input_delivery_stream and not partial:
+        archival = _start_delivery(
+            (send_to_delivery_stream, (input_events, stream, raw, buffer))
+            for stream in input_delivery_stream)
+
     if inputp:
-        input_delivery_stream = inputp.get("firehose_delivery_stream")
-        if input_delivery_stream:
-            for stream in input_delivery_stream:
-                send_to_delivery_stream(input_events, stream)
-
-        # The input pipeline is enforced to be 1-to-1
-        events, ifailed = run_pipeline(
-            inputp, copy.deepcopy(input_events), hcontext, "input")
+        # Input mappers may fan out: the lineage tracks the input event of
+        # every event
+        events, positions, ifailed = _run_pipeline(
+            inputp, _copy_batch(input_events), hcontext, "input",
+            lineage.partition_keys())
         if ifailed:
             logger.error(
                 "%s events failed to be processed: %s", len(ifailed), ifailed)
         failed += ifailed
+        lineage = lineage.derive(positions, len(events))
     else:
         events = input_events
 
     if events and outputp:
-        # The original indices of the events
-        indices = [i for i in range(nbevents)
-                   if i not in {f.index for f in failed}]
-        oevents, ofailed = produce_outputs(outputp, events, hcontext)
-        # Remap the indices of the errors
-        ofailed = [EventError(indices[err.index],
-                              input_events[indices[err.index]],
-                              err.error,
-                              err.tb)
+        oevents, opositions, ofailed = _produce_outputs(
+            outputp, events, hcontext, lineage.partition_keys())
+        # Remap the indices of the errors to the input events
+        ofailed = [_remap_error(err, lineage.index(err.index), input_events)
                    for err in ofailed]
+        if ofailed and not lineage.known:
+            # The input events that failed are not known: they all did
+            ofailed = [_remap_error(ofailed[0], index, input_events)
+                       for index in range(nbevents)]
         if ofailed:
             logger.error(
                 "%s events failed to be processed: %s", len(ofailed), ofailed)
         failed += ofailed
-        # To make the processing task as atomic as possible we deliver the
-        # events to the output streams only after all outputs are produced.
-        deliver_outputs(outputp, oevents)
+    elif outputp:
+        oevents, opositions = [[] for _ in outputp], []
     else:
-        if outputp:
-            oevents = [[] for _ in outputp]
-        else:
-            oevents = []
+        oevents, opositions = [], []
 
-    if failed:
-        raise ProcessingError(sorted(failed, key=operator.attrgetter("index")))
+    failed = _first_errors(failed)
+    cutoff, seqnum = None, None
+    if partial:
+        whole = not lineage.known or None in opositions
+        cutoff, seqnum = failures.checkpoint(failed, lineage.seqnums, whole)
+    if bad is not None:
+        # After the events of the records that could be decoded
+        failed.append(bad._replace(index=nbevents))
+        if seqnum is None:
+            seqnum = _seqnum(bad.event)
+    if cutoff is not None:
+        logger.error("Reporting record %s as failed: %d events will be "
+                     "retried", seqnum, nbevents - cutoff)
+        if events and outputp:
+            # Keep the events produced by input events before the cutoff
+            oevents = [_take(output, [
+                index < cutoff for index
+                in lineage.derive(positions, len(output)).indices])
+                for output, positions in zip(oevents, opositions)]
+    if input_delivery_stream and partial:
+        archived = input_events
+        if cutoff is not None:
+            archived = _take(input_events, [i < cutoff
+                                            for i in range(nbevents)])
+        archival = _start_delivery(
+            (send_to_delivery_stream, (archived, stream, raw, buffer))
+            for stream in input_delivery_stream)
+
+    # To make the processing task as atomic as possible we deliver the
+    # events to the output streams only after all outputs are produced
+    # and the input events have been archived.
+    executor.wait(archival)
+    if events and outputp:
+        deliver_outputs(outputp, oevents, raw, buffer)
+
+    return oevents, failed, seqnum, nbevents
+
+
+def _find_bad_record(kevent):
+    """Find the first record of a Kinesis event that cannot be decoded.
+
+    Returns its error, whose index is the position of the record and whose
+    event is the record itself, or None if every record can be decoded on
+    its own.
+    """
+    for position, record in enumerate(kevent["Records"]):
+        try:
+            _get_records(dict(kevent, Records=[record]))
+        except CriticalError:
+            raise
+        except Exception as err:
+            logger.error("Record %s cannot be decoded: %s",
+                         _seqnum(record), err)
+            return _event_error(position, record, err, sys.exc_info())
+
+
+def _seqnum(record):
+    """The sequence number of a Kinesis record."""
+    return record["kinesis"]["sequenceNumber"]
+
+
+def _remap_error(err, index, input_events):
+    """Attribute an error to the input event at a given position."""
+    return EventError(index,
+                      lazy.load(columnar.row(input_events, index)),
+                      err.error,
+                      err.tb)
+
+
+def _first_errors(failed):
+    """Keep the first error of every input event, sorted by position.
+
+    An input event that fans out may fail more than once, but it must be
+    reported only once.
+    """
+    errors = {}
+    for err in failed:
+        errors.setdefault(err.index, err)
+    return [err for _, err in sorted(errors.items(),
+                                     key=operator.itemgetter(0))]
 
-    return oevents
+
+def _take(events, mask):
+    """Keep the events of a batch for which a mask is true."""
+    if columnar.is_table(events):
+        return columnar.select(events, mask)[0]
+    return [event for event, keep in zip(events, mask) if keep]
 
 
 def _make_humilis_context(**kwargs):
@@ -105,24 +254,105 @@ def _make_humilis_context(**kwargs):
         **kwargs)
 
 
+def get_codecs():
+    """The callables used to decode input and encode output records.
+
+    A codec spec from the registry (e.g. json+zstd) takes precedence over
+    the individual callables.
+    """
+    if not _codecs and _codec_spec():
+        _check_codec_spec(_codec_spec())
+        _codecs.append(serialization.get_codecs(_codec_spec()))
+    elif not _codecs:
+        _codecs.append(Codecs(
+            deserializer="{{kinesis_deserializer}}" \
+                    and "{{kinesis_desearializer}}" != "None" \
+                    and import_string("{{kinesis_deserializer}}"),
+            unpacker="{{kinesis_unpacker}}" \
+                    and "{{kinesis_unpacker}}" != "None" \
+                    and import_string("{{kinesis_unpacker}}"),
+            serializer="{{kinesis_serializer}}" \
+                    and "{{kinesis_serializer}}" != "None" \
+                    and import_string("{{kinesis_serializer}}"),
+            packer="{{kinesis_packer}}" \
+                    and "{{kinesis_packer}}" != "None" \
+                    and import_string("{{kinesis_packer}}")))
+    return _codecs[0]
+
+
+def _check_codec_spec(spec):
+    """Check that a codec spec can be used with the decoding settings.
+
+    Lazy decoding, passthrough and columnar batches parse JSON documents:
+    they cannot decode records in any other format.
+    """
+    if spec.split("+")[0].strip() == "json":
+        return
+    for setting, enabled in (("lazy_decoding", _lazy_decoding()),
+                             ("passthrough", _passthrough()),
+                             ("columnar", _columnar())):
+        if enabled:
+            raise CriticalError(
+                "kinesis_codec '{}' cannot be used with {}, which only "
+                "works with JSON records".format(spec, setting))
+
+
 def _get_records(kevent):
-    """Unpack records from a Kinesis event."""
+    """Unpack records from a Kinesis event.
+
+    Returns the events, the shard they come from, in passthrough mode the
+    documents they were decoded from (None otherwise) and the lineage of
+    the events: the record every event comes from.
+    """
+    codecs = get_codecs()
+    # Records produced with KPL aggregation or compressed in groups contain
+    # several events each
+    records = compression.decompress_records(
+        kpl.deaggregate_records(kevent["Records"]))
+    kevent = dict(kevent, Records=records)
+    if _columnar():
+        table, shard_id, counts = columnar.unpack_records(
+            kevent,
+            unpacker=codecs.unpacker,
+            embed_timestamp="{{received_at_field}}")
+        # A record may hold any number of rows
+        return table, shard_id, None, Lineage.from_records(records, counts)
+    if _lazy_decoding():
+        events, shard_id, raw = lazy.unpack_kinesis_event(
+            kevent,
+            deserializer=codecs.deserializer,
+            unpacker=codecs.unpacker,
+            embed_timestamp="{{received_at_field}}",
+            keep_raw=_passthrough())
+        return events, shard_id, raw, Lineage.from_records(records)
+    if _passthrough():
+        events, shard_id, raw = passthrough.unpack_kinesis_event(
+            kevent,
+            deserializer=codecs.deserializer,
+            unpacker=codecs.unpacker,
+            embed_timestamp="{{received_at_field}}")
+        return events, shard_id, raw, Lineage.from_records(records)
+    if _codec_spec():
+        events, shard_id = serialization.unpack_kinesis_event(
+            kevent, codecs, embed_timestamp="{{received_at_field}}")
+        return events, shard_id, None, Lineage.from_records(records)
     events, shard_id = utils.unpack_kinesis_event(
         kevent,
-        deserializer="{{kinesis_deserializer}}" \
-                and "{{kinesis_desearializer}}" != "None" \
-                and import_string("{{kinesis_deserializer}}"),
-        unpacker="{{kinesis_unpacker}}" \
-                and "{{kinesis_unpacker}}" != "None" \
-                and import_string("{{kinesis_unpacker}}"),
+        deserializer=codecs.deserializer,
+        unpacker=codecs.unpacker,
         embed_timestamp="{{received_at_field}}"
         )
 
-    return events, shard_id
+    return events, shard_id, None, Lineage.from_records(records)
+
 
+def deliver_outputs(output, oevents, raw=None, buffer=None):
+    """Deliver the output events to their corresponding streams.
 
-def deliver_outputs(output, oevents):
-    """Deliver the output events to their corresponding streams."""
+    Events found in `raw` are delivered as their original documents. If a
+    `buffer` is given the records are added to it instead of being sent.
+    """
+    calls = []
     for i, o in enumerate(output):
         logger.info("Forwarding output #{}".format(i))
         stream = o.get("kinesis_stream")
@@ -132,27 +362,72 @@ def deliver_outputs(output, oevents):
             continue
 
         if stream:
-            send_to_kinesis_stream(oevents[i], stream, o.get("partition_key"))
+            calls.append((send_to_kinesis_stream,
+                          (oevents[i], stream, o.get("partition_key"),
+                           is_true(o.get("aggregate")),
+                           is_true(o.get("columnar")), raw,
+                           is_true(o.get("compress")), buffer,
+                           is_true(o.get("ordered")))))
         else:
             logger.info("No output Kinesis stream: not forwarding to Kinesis")
 
         delivery_stream = o.get("firehose_delivery_stream")
         if delivery_stream:
             for stream in delivery_stream:
-                send_to_delivery_stream(oevents[i], stream)
+                calls.append((send_to_delivery_stream,
+                              (oevents[i], stream, raw, buffer)))
         else:
             logger.info("No FH delivery stream: not forwarding to FH")
 
+    # Any failed delivery makes the whole invocation fail
+    concurrency = _delivery_concurrency()
+    if concurrency > 1:
+        clients.setup_default_session()
+    executor.run_all(calls, concurrency, "delivery")
+
+
+def _start_delivery(calls):
+    """Start deliveries in the background, if concurrency is enabled.
+
+    Returns a list of futures to wait for. Deliveries run synchronously (and
+    no futures are returned) if concurrent delivery is disabled.
+    """
+    concurrency = _delivery_concurrency()
+    if concurrency <= 1:
+        executor.run_all(calls, concurrency)
+        return []
+    clients.setup_default_session()
+    return executor.start(calls, concurrency, "delivery")
+
 
 def produce_outputs(outputs, events, context):
     """Produces the output event streams."""
-    oevents = []
-    failed = {}
-    for oindex, output in enumerate(outputs):
+    oevents, _, failed = _produce_outputs(outputs, events, context)
+    return oevents, failed
+
+
+def _produce_outputs(outputs, events, context, keys=None):
+    """Produces the output event streams.
+
+    `keys` are the partition keys of the records of the events, if known.
+    Returns the events of every output, the position of the event that
+    produced each of them and the errors.
+    """
+
+    def produce(oindex):
+        """Run the pipeline of one output."""
         logger.info("Producing output #%s", oindex)
+        # Each output gets its own context: outputs may run concurrently
+        return _run_pipeline(outputs[oindex], _copy_batch(events),
+                             dict(context), "output {}".format(oindex), keys)
+
+    results = executor.map_ordered(
+        produce, range(len(outputs)), _output_concurrency(), "outputs")
+
+    oevents, opositions = [], []
+    failed = {}
+    for processed, positions, this_failed in results:
         # An event must succeed in all outputs to be considered successful
-        processed, this_failed = run_pipeline(
-            output, copy.deepcopy(events), context, "output {}".format(oindex))
         if this_failed:
             logger.info("%s events failed for this output", len(this_failed))
             logger.info("First failed event: %s", pretty(this_failed[0].event))
@@ -161,64 +436,466 @@ def produce_outputs(outputs, events, context):
             if err.index not in failed:
                 failed[err.index] = err
         oevents.append(processed)
+        opositions.append(positions)
 
-    return oevents, [err for idx, err in sorted(failed.items())]
+    return oevents, opositions, [err for idx, err in sorted(failed.items())]
 
 
 def run_pipeline(pipeline, events, context, name="unnamed"):
     """Apply a filter and a mapper to a list of events."""
+    processed, _, failed = _run_pipeline(pipeline, events, context, name)
+    return processed, failed
+
+
+def _run_pipeline(pipeline, events, context, name="unnamed", keys=None):
+    """Apply a pipeline to a list of events.
+
+    `keys` are the partition keys of the records of the events, if known,
+    which events are grouped by when groups are processed concurrently.
+    Returns the processed events, the position of the event that produced
+    each of them and the errors. The positions are None if a batch mapper
+    changed the number of events, in which case an error fails every
+    event of the batch.
+    """
 
     logger.info("Processing %s events with pipeline '%s'.", len(events), name)
 
     context.update(pipeline)
 
+    if columnar.is_table(events):
+        return _run_columnar_pipeline(pipeline, events, context, name, keys)
+
+    # The events of the batch if their lineage is lost
+    whole = None
     batch_mapper = pipeline.get("batch_mapper")
     if batch_mapper:
-        events = batch_mapper(copy.deepcopy(events), context)
+        mapped = [materialize(ev) for ev
+                  in batch_mapper(_isolate(lazy.loaded(events)), context)]
+        if _lost_lineage(mapped, events, name):
+            whole, keys = events, None
+        events = mapped
+
+    failed = []
+    batch_filter = pipeline.get("batch_filter")
+    if batch_filter:
+        selected, bfailed = _run_batch_filter(batch_filter, events, context)
+        failed += bfailed
+    else:
+        selected = range(len(events))
 
     pfilter = pipeline.get("filter")
     pmapper = pipeline.get("mapper")
-    failed = []
+    groups = None
+    if (pfilter or pmapper) and _group_concurrency() > 1:
+        groups, gfailed = _group_events(pipeline.get("group_by"), events,
+                                        selected, keys, context)
+        if gfailed:
+            failed += gfailed
+            excluded = {err.index for err in gfailed}
+            selected = [index for index in selected if index not in excluded]
     processed = []
-    for index, event in enumerate(events):
+    # The position of the event that produced each processed event
+    positions = []
+    for index, result in zip(selected, _map_events(
+            events, selected, pfilter, pmapper, context, groups)):
+        if isinstance(result, EventError):
+            failed.append(result)
+        else:
+            processed += result
+            positions += [index] * len(result)
+
+    flatmapper = pipeline.get("batch_flatmapper")
+    if flatmapper:
+        processed, positions, ffailed = _run_batch_flatmapper(
+            flatmapper, processed, positions, context)
+        failed += ffailed
+
+    if whole is not None:
+        return processed, None, _whole_batch_errors(failed, whole)
+    return processed, positions, sorted(failed,
+                                        key=operator.attrgetter("index"))
+
+
+def _map_event(event, index, pfilter, pmapper, context):
+    """Apply a filter and a mapper to an event.
+
+    Returns the events produced by the event, or its error.
+    """
+    try:
+        if pfilter and not executor.resolve(
+                pfilter(_filter_view(event), context)):
+            # Skip this event in this pipeline
+            return []
+        if not pmapper:
+            return [event]
+        return _mapped(executor.resolve(pmapper(_isolate(event), context)))
+    except CriticalError:
+        raise
+    except Exception as err:
+        return _event_error(index, event, err, sys.exc_info())
+
+
+async def _map_event_async(event, index, pfilter, pmapper, context):
+    """Apply a filter and a mapper that may be coroutine functions."""
+    try:
+        if pfilter and not await _awaited(
+                pfilter(_filter_view(event), context)):
+            return []
+        if not pmapper:
+            return [event]
+        return _mapped(await _awaited(pmapper(_isolate(event), context)))
+    except CriticalError:
+        raise
+    except Exception as err:
+        return _event_error(index, event, err, sys.exc_info())
+
+
+async def _awaited(value):
+    """The result of a callable that may be a coroutine function."""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+def _mapped(mapped):
+    """The events produced by a mapper."""
+    if mapped is None:
+        return []
+    if isinstance(mapped, dict):
+        # backwards compatibility
+        mapped = [mapped]
+    if not isinstance(mapped, list):
+        raise CriticalError("Mapper must return a list of dicts.")
+    return [materialize(ev) for ev in mapped]
+
+
+def _map_events(events, selected, pfilter, pmapper, context, groups=None):
+    """Apply a filter and a mapper to the selected events.
+
+    Returns the result of every selected event, in order. If the events
+    are split in `groups` (lists of positions) the groups are processed
+    concurrently, and the events of a group one after the other.
+    """
+    engine = _execution_engine(pfilter, pmapper)
+    if engine == "process":
+        return _map_in_processes(events, selected, pfilter, pmapper, context,
+                                 groups)
+    if engine in ("thread", "async"):
+        return _map_concurrently(engine, events, selected, pfilter, pmapper,
+                                 context, groups)
+    if not groups:
+        return [_map_event(events[index], index, pfilter, pmapper, context)
+                for index in selected]
+
+    def run(indices):
+        """Process the events of some groups in order."""
+        return [_map_event(events[index], index, pfilter, pmapper, context)
+                for index in indices]
+
+    concurrency = _group_concurrency()
+    buckets = _balance(groups, concurrency)
+    results = {}
+    for indices, bresults in zip(buckets, executor.map_ordered(
+            run, buckets, concurrency, "groups")):
+        results.update(zip(indices, bresults))
+    return [results[index] for index in selected]
+
+
+def _map_concurrently(engine, events, selected, pfilter, pmapper, context,
+                      groups=None):
+    """Apply a filter and a mapper to many events at the same time.
+
+    With the thread engine the events are processed by a pool of threads,
+    with the async engine by coroutines on an event loop. Either way at
+    most `mapper_concurrency` events are processed at once, and the events
+    of a group are processed one after the other.
+    """
+    units = groups or [[index] for index in selected]
+    concurrency = _mapper_concurrency()
+    if engine == "thread":
+        def run(indices):
+            """Process the events of a group in order."""
+            return [_map_event(events[index], index, pfilter, pmapper,
+                               context)
+                    for index in indices]
+        uresults = executor.map_ordered(run, units, concurrency, "mappers")
+    else:
+        async def run(indices):
+            """Process the events of a group in order."""
+            return [await _map_event_async(events[index], index, pfilter,
+                                           pmapper, context)
+                    for index in indices]
+        uresults = executor.run_async([(run, (indices,)) for indices in units],
+                                      concurrency)
+    results = {}
+    for indices, iresults in zip(units, uresults):
+        results.update(zip(indices, iresults))
+    return [results[index] for index in selected]
+
+
+def _map_in_processes(events, selected, pfilter, pmapper, context,
+                      groups=None):
+    """Apply a filter and a mapper to the selected events in worker processes.
+
+    Events are sent to the workers in chunks. Groups of events are never
+    split across chunks, so that the events of a group are processed one
+    after the other.
+    """
+    nchunks = workers.pool_size() * CHUNKS_PER_WORKER
+    if groups:
+        chunks = _balance(groups, nchunks)
+    else:
+        size = max(1, -(-len(selected) // nchunks))
+        chunks = [selected[start:start + size]
+                  for start in range(0, len(selected), size)]
+    portable = _portable_context(context)
+    calls = [(_map_chunk, ([(index, _ship(events[index])) for index in chunk],
+                           pfilter, pmapper, portable))
+             for chunk in chunks]
+    results = {}
+    for chunk, cresults in zip(chunks, workers.run(calls)):
+        for index, result in zip(chunk, cresults):
+            if isinstance(result, EventError):
+                logger.error("Event %d failed in a worker process:\n%s",
+                             index, result.tb)
+                result = result._replace(
+                    tb=(type(result.error), result.error, None))
+            results[index] = result
+    return [results[index] for index in selected]
+
+
+def _map_chunk(items, pfilter, pmapper, context):
+    """Apply a filter and a mapper to (position, event) pairs.
+
+    Runs in a worker process. Tracebacks cannot be sent back to the parent
+    process, so the errors carry the text of their traceback instead, and
+    exceptions that cannot be unpickled are sent as a WorkerError.
+    """
+    results = []
+    for index, event in items:
+        result = _map_event(event, index, pfilter, pmapper, context)
+        if isinstance(result, EventError):
+            result = result._replace(
+                error=workers.portable(result.error),
+                tb="".join(traceback.format_exception(*result.tb)))
+        results.append(result)
+    return results
+
+
+def _ship(event):
+    """An event as a plain dict, to be sent to a worker process."""
+    return materialize(lazy.load(event))
+
+
+def _portable_context(context):
+    """The entries of a context that can be sent to a worker process.
+
+    The Lambda context object and the frozen parts of the pipeline
+    specification, for instance, stay in the parent process.
+    """
+    portable = {}
+    for key, value in context.items():
         try:
-            if pfilter and not pfilter(copy.deepcopy(event), context):
-                # Skip this event in this pipeline
+            pickle.dumps(value, workers.PROTOCOL)
+        except Exception:
+            continue
+        portable[key] = value
+    return portable
+
+
+def _group_events(group_by, events, selected, keys, context):
+    """Group the selected events by key.
+
+    Events are grouped by the result of `group_by` or, without it, by the
+    partition key of their record. Returns the groups (lists of positions,
+    in order) and the errors raised by `group_by`, or no groups if there is
+    nothing to group by.
+    """
+    if not group_by and keys is None:
+        return None, []
+    groups, failed = OrderedDict(), []
+    for index in selected:
+        if group_by:
+            try:
+                key = group_by(_filter_view(events[index]), context)
+            except CriticalError:
+                raise
+            except Exception as err:
+                failed.append(_event_error(index, events[index], err,
+                                           sys.exc_info()))
                 continue
-            if pmapper:
-                mapped = pmapper(copy.deepcopy(event), context)
-                if mapped is None:
-                    continue
-                if isinstance(mapped, dict):
-                    # backwards compatibility
-                    mapped = [mapped]
-                if not isinstance(mapped, list):
-                    raise CriticalError("Mapper must return a list of dicts.")
-                if name == "input" and len(mapped) != 1:
-                    raise CriticalError("Input mappers must be 1-to-1")
-                processed += mapped
-            else:
-                processed.append(event)
-        except CriticalError:
-            raise
-        except Exception as err:
-            # Add an annotation to support error expiration
-            event = utils.annotate_error(event, err)
-            failed.append(EventError(index, event, err, sys.exc_info()))
+        else:
+            key = keys[index]
+        groups.setdefault(key, []).append(index)
+    return list(groups.values()), failed
+
+
+def _balance(groups, nbuckets):
+    """Spread groups of events over buckets of similar sizes.
+
+    A group is never split, so the events of a group are processed in
+    order. Returns the positions of the events of every bucket.
+    """
+    buckets = [[] for _ in range(min(nbuckets, len(groups)))]
+    # The largest groups first, each to the least loaded bucket
+    heap = [(0, i) for i in range(len(buckets))]
+    for group in sorted(groups, key=len, reverse=True):
+        size, i = heapq.heappop(heap)
+        buckets[i] += group
+        heapq.heappush(heap, (size + len(group), i))
+    return buckets
+
+
+def _run_columnar_pipeline(pipeline, table, context, name, keys=None):
+    """Apply a pipeline to a columnar batch of events.
+
+    Batch mappers receive and return a table (or a DataFrame or a list of
+    dicts, which are converted back) and batch filters return a boolean
+    mask. The events are only converted to dicts if the pipeline has
+    row-wise stages, in which case those run as usual after the batch
+    stages.
+    """
+    whole = None
+    batch_mapper = pipeline.get("batch_mapper")
+    if batch_mapper:
+        mapped = columnar.from_rows(batch_mapper(table, context))
+        if _lost_lineage(mapped, table, name):
+            whole, keys = table, None
+        table = mapped
+
+    positions = None
+    failed = []
+    batch_filter = pipeline.get("batch_filter")
+    if batch_filter:
+        mask = batch_filter(table, context)
+        if mask is None:
+            raise CriticalError(
+                "Batch filters must return one value per event")
+        mask = columnar.mask_values(mask)
+        for index, keep in enumerate(mask):
+            if isinstance(keep, Exception):
+                failed.append(_event_error(
+                    index, columnar.row(table, index), keep))
+                mask[index] = False
+        table, positions = columnar.select(table, mask)
+
+    row_stages = {k: pipeline[k] for k in ROW_STAGES if pipeline.get(k)}
+    if row_stages and pipeline.get("group_by"):
+        row_stages["group_by"] = pipeline["group_by"]
+    if not row_stages:
+        if whole is not None:
+            return table, None, _whole_batch_errors(failed, whole)
+        if positions is None:
+            positions = range(table.num_rows)
+        return table, positions, failed
+
+    if keys is not None and positions is not None:
+        keys = [keys[i] for i in positions]
+    processed, rpositions, rfailed = _run_pipeline(
+        row_stages, columnar.to_rows(table), context, name, keys)
+    if positions is not None:
+        # The positions of the events before the batch filter
+        rpositions = [positions[i] for i in rpositions]
+        rfailed = [err._replace(index=positions[err.index])
+                   for err in rfailed]
+    failed = sorted(failed + rfailed, key=operator.attrgetter("index"))
+    if whole is not None:
+        return processed, None, _whole_batch_errors(failed, whole)
+    return processed, rpositions, failed
+
+
+def _lost_lineage(mapped, events, name):
+    """True if a batch mapper did not produce one event per event.
+
+    The events it produced cannot then be traced back to their input
+    events: an error fails the whole batch.
+    """
+    if len(mapped) == len(events):
+        return False
+    logger.warning("The batch mapper of pipeline '%s' mapped %d events to "
+                   "%d: errors will fail the whole batch", name, len(events),
+                   len(mapped))
+    return True
+
+
+def _whole_batch_errors(failed, events):
+    """Attribute the first error of a batch to all its events."""
+    if not failed:
+        return []
+    first = failed[0]
+    return [_event_error(index, lazy.load(columnar.row(events, index)),
+                         first.error, first.tb)
+            for index in range(len(events))]
+
+
+def _event_error(index, event, err, tb=None):
+    """Produce the error record of an event that failed to be processed."""
+    # Add an annotation to support error expiration
+    event = utils.annotate_error(_isolate(event), err)
+    if tb is None:
+        tb = (type(err), err, getattr(err, "__traceback__", None))
+    return EventError(index, event, err, tb)
+
+
+def _run_batch_filter(batch_filter, events, context):
+    """Apply a batch filter to a list of events.
+
+    A batch filter returns a sequence (e.g. a list or a NumPy array) with
+    one value per event: true to keep the event, false to filter it out or
+    an exception instance if the event could not be processed. Returns the
+    indices of the selected events and the errors.
+    """
+    mask = batch_filter(_isolate(lazy.loaded(events)), context)
+    if mask is None or len(mask) != len(events):
+        raise CriticalError("Batch filters must return one value per event")
+    selected, failed = [], []
+    for index, keep in enumerate(mask):
+        if isinstance(keep, Exception):
+            failed.append(_event_error(index, events[index], keep))
+        elif keep:
+            selected.append(index)
+    return selected, failed
 
-    return processed, failed
 
+def _run_batch_flatmapper(flatmapper, events, positions, context):
+    """Apply a batch flatmapper to a list of events.
 
-def send_to_delivery_stream(events, delivery_stream):
+    A batch flatmapper produces (position, result) pairs, where position is
+    the position in the batch of the event that produced the result and
+    result is either an output event or an exception instance. An event can
+    produce any number of results, and events that produce none are
+    filtered out. `positions` are the positions of the events in the batch
+    the pipeline started from, and are returned for the output events.
+    """
+    processed, ppositions, failed = [], [], []
+    for pair in flatmapper(_isolate(lazy.loaded(events)), context):
+        try:
+            position, result = pair
+            index = positions[position]
+        except (TypeError, ValueError, IndexError):
+            raise CriticalError(
+                "Batch flatmappers must produce (position, result) pairs "
+                "with a valid position: {}".format(pair))
+        if isinstance(result, Exception):
+            failed.append(_event_error(index, events[position], result))
+            continue
+        processed.append(materialize(result))
+        ppositions.append(index)
+    return processed, ppositions, failed
+
+
+def send_to_delivery_stream(events, delivery_stream, raw=None, buffer=None):
     """Send events to a Firehose delivery stream."""
+    # Firehose (and its record format conversion) ingests JSON documents
+    events = columnar.to_rows(events)
     if events:
         logger.info("Sending %d events to delivery stream '%s' ...",
                     len(events), delivery_stream)
         stream_name = delivery_stream["stream_name"]
         if "filter" in delivery_stream:
             logger.info("Applying filter before delivery")
-            events = [copy.deepcopy(ev) for ev in events
-                      if delivery_stream["filter"](ev)]
+            events = [ev for ev in events
+                      if delivery_stream["filter"](_filter_view(ev))]
             logger.info("Selected %d events for delivery", len(events))
 
         if not events:
@@ -227,36 +904,187 @@ def send_to_delivery_stream(events, delivery_stream):
 
         if "mapper" in delivery_stream:
             logger.info("Mapping %d events before delivery", len(events))
-            events = [delivery_stream["mapper"](copy.deepcopy(ev))
+            events = [materialize(delivery_stream["mapper"](_isolate(ev)))
                       for ev in events]
 
+        events = lazy.loaded(events, raw)
         logger.info("First delivered event: %s", pretty(events[0]))
-        resp = utils.send_to_delivery_stream(events, stream_name)
-        if resp['ResponseMetadata']['HTTPStatusCode'] != 200:
-            raise FirehoseError(json.dumps(resp))
-        logger.info(resp)
+        records = firehose.make_records(
+            events, pack=is_true(delivery_stream.get("pack")), raw=raw)
+        _put(firehose.put_record_batch, records, stream_name, buffer)
+
+
+def send_to_kinesis_stream(events, stream, partition_key, aggregate=False,
+                           ship_columnar=False, raw=None, compress=False,
+                           buffer=None, ordered=False):
+    """Send events to an ouput Kinesis stream.
 
+    With `ship_columnar` a columnar batch is sent as Arrow IPC streams
+    rather than as one JSON document per event. With `compress` events are
+    compressed in groups. With `ordered` the events of a partition key are
+    never spread across shards, even if the key is hot.
+    """
+    if ship_columnar and columnar.is_table(events):
+        records = columnar.make_records(events, partition_key)
+        logger.info("Sending %d events in %d columnar records to '%s' ...",
+                    len(events), len(records), stream)
+        _put(kinesis.put_records, records, stream, buffer)
+        return
 
-def send_to_kinesis_stream(events, stream, partition_key):
-    """Send events to an ouput Kinesis stream."""
+    events = lazy.loaded(columnar.to_rows(events), raw)
     if events:
         logger.info("Sending %d events to '%s' ...", len(events), stream)
         logger.info("First sent event: %s", pretty(events[0]))
-        resp = utils.send_to_kinesis_stream(
+        codecs = get_codecs()
+        records = kinesis.make_records(
             events,
-            stream,
             partition_key=partition_key,
-            packer="{{kinesis_packer}}" \
-                    and "{{kinesis_packer}}" != "None" \
-                    and import_string("{{kinesis_packer}}"),
-            serializer="{{kinesis_serializer}}" \
-                    and "{{kinesis_serializer}}" != "None" \
-                    and import_string("{{kinesis_serializer}}"))
-        if resp['ResponseMetadata']['HTTPStatusCode'] != 200:
-            raise KinesisError(json.dumps(resp))
-        logger.info(resp)
+            packer=codecs.packer,
+            serializer=codecs.serializer,
+            raw=raw)
+        sketch = None
+        nkeys = hotkeys.top_keys()
+        if nkeys and partition_key:
+            sketch = hotkeys.track(records, stream, nkeys)
+        if aggregate:
+            # Random partition keys do not need to be preserved
+            records = kpl.aggregate_records(
+                records, group_by_key=bool(partition_key))
+            logger.info("Aggregated %d events in %d records",
+                        len(events), len(records))
+        elif compress:
+            records = compression.compress_records(
+                records, group_by_key=bool(partition_key))
+            logger.info("Compressed %d events in %d records",
+                        len(events), len(records))
+        if sketch is not None:
+            records = _balance_hot_keys(records, sketch, nkeys, ordered)
+        _put(kinesis.put_records, records, stream, buffer)
+
+
+def _balance_hot_keys(records, sketch, nkeys, ordered):
+    """Spread the records of hot partition keys, as the policy says."""
+    policy = hotkeys.policy()
+    keys = hotkeys.hot(sketch, nkeys)
+    if not keys or policy == hotkeys.REPORT:
+        return records
+    if ordered:
+        logger.info("Not spreading %d hot keys: the output is ordered",
+                    len(keys))
+        return records
+    logger.info("Spreading %d hot keys (%s)", len(keys), policy)
+    return hotkeys.balance(records, keys, policy, hotkeys.spread())
+
+
+def _put(put, records, stream, buffer=None):
+    """Send records to a stream, or add them to a buffer to send later."""
+    if buffer is not None:
+        buffer.add(put, records, stream)
+        logger.info("Buffered %d records for '%s'", len(records), stream)
+        return
+    metrics = put(records, stream)
+    logger.info("Sent %d records to '%s' in %d calls",
+                len(records), stream, len(metrics))
+
+
+def _isolation_mode():
+    """The strategy used to protect events from user callables."""
+    return os.environ.get("ISOLATION_MODE") or "cow"
+
+
+def _isolate(obj):
+    """Produce a private copy (or view) of an event for a user callable."""
+    if columnar.is_table(obj):
+        # Tables are immutable
+        return obj
+    if _isolation_mode() == "deepcopy":
+        return copy.deepcopy(obj)
+    return isolate(obj)
+
+
+def _filter_view(event):
+    """Produce the view of an event for a filter.
+
+    Lazy events are handed to filters as lazy views, so that events that
+    are filtered out are only decoded as far as the filter needs.
+    """
+    if isinstance(event, lazy.LazyEvent) and _isolation_mode() != "deepcopy":
+        return event.view()
+    return _isolate(event)
+
+
+def _copy_batch(events):
+    """Copy a batch of events before handing it to a pipeline.
+
+    With copy-on-write views every call to a user callable is already
+    isolated, so sharing the batch across pipelines is safe.
+    """
+    if columnar.is_table(events):
+        # Tables are immutable
+        return events
+    if _isolation_mode() == "deepcopy":
+        return copy.deepcopy(events)
+    return list(events)
+
+
+def _columnar():
+    """True if batches of events are decoded as columnar tables."""
+    return is_true(os.environ.get("COLUMNAR"))
+
+
+def _codec_spec():
+    """The registry codecs used for Kinesis records, if any."""
+    return os.environ.get("KINESIS_CODEC")
+
+
+def _lazy_decoding():
+    """True if events are decoded on demand."""
+    return is_true(os.environ.get("LAZY_DECODING"))
+
+
+def _passthrough():
+    """True if unmodified events are forwarded as their original documents."""
+    return is_true(os.environ.get("PASSTHROUGH"))
+
+
+def _output_concurrency():
+    """The number of output pipelines that may run at the same time."""
+    return int(os.environ.get("OUTPUT_CONCURRENCY") or 1)
+
+
+def _execution_engine(pfilter=None, pmapper=None):
+    """How per-event filters and mappers are run.
+
+    Coroutine functions are run on an event loop unless another engine
+    than inline is set.
+    """
+    engine = os.environ.get("EXECUTION_ENGINE") or "inline"
+    if engine not in ENGINES:
+        raise CriticalError("Unknown execution engine '{}': must be one of "
+                            "{}".format(engine, ", ".join(ENGINES)))
+    if engine == "inline" and any(inspect.iscoroutinefunction(func)
+                                  for func in (pfilter, pmapper)):
+        return "async"
+    return engine
+
+
+def _mapper_concurrency():
+    """The number of events the thread and async engines process at once."""
+    return int(os.environ.get("MAPPER_CONCURRENCY") or
+               DEFAULT_MAPPER_CONCURRENCY)
+
+
+def _group_concurrency():
+    """The number of groups of events that may be processed at once."""
+    return int(os.environ.get("GROUP_CONCURRENCY") or 1)
+
+
+def _delivery_concurrency():
+    """The maximum number of deliveries that can be in flight at once."""
+    return int(os.environ.get("DELIVERY_CONCURRENCY") or 1)
 
 
 def pretty(event):
     """Pretty print an event."""
-    return json.dumps(event, indent=4)
+    return json.dumps(lazy.load(event), indent=4,
+                      default=schemas.json_default)
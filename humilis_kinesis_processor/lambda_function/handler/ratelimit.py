@@ -0,0 +1,227 @@
+"""Pace the records written to the shards of an output Kinesis stream.
+
+Every shard of a stream ingests at most 1 MB and 1000 records per second.
+Kinesis routes a record to the shard whose hash key range holds the MD5
+hash of its partition key (or its explicit hash key). The rate limiter
+looks up the shard of every record and keeps a token bucket per shard and
+per limit, so that the records of a hot shard are held back before the
+shard throttles them, while the records of the other shards are sent at
+once. The records of a shard are always sent in order.
+
+Other processors may write to the same shards, so the rate of a shard is
+halved every time it throttles records, and grows back slowly as records
+are ingested.
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from . import clients
+from .plan import is_true
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+# Per-shard ingestion limits
+BYTES_PER_SECOND = 1024 * 1024
+RECORDS_PER_SECOND = 1000
+
+# How the rate of a shard adapts to throttling: it is multiplied by
+# BACKOFF_FACTOR when the shard throttles records, and increased by
+# RECOVERY_STEP after every call that the shard did not throttle
+BACKOFF_FACTOR = 0.5
+RECOVERY_STEP = 0.05
+MIN_SCALE = 0.05
+
+# The minimum time (s) records are held back, so that they are sent in
+# batches rather than one by one as tokens become available
+MIN_WAIT = 0.1
+
+# How long (in seconds) the shards of a stream are cached before being
+# listed again, to catch up with resharding. Failures to list them are
+# cached as long.
+SHARD_MAP_TTL = 300
+
+THROTTLED = "ProvisionedThroughputExceededException"
+
+# The rate limiters of this container, by stream name: (rate limiter or
+# None if the shards could not be listed, time the shards were listed)
+_limiters = {}
+_lock = threading.Lock()
+
+
+def enabled():
+    """True if the records sent to output Kinesis streams are paced."""
+    return is_true(os.environ.get("KINESIS_RATE_LIMIT"))
+
+
+def hash_key(record):
+    """The hash key Kinesis uses to route a PutRecords entry."""
+    explicit = record.get("ExplicitHashKey")
+    if explicit is not None:
+        return int(explicit)
+    return int(hashlib.md5(
+        record["PartitionKey"].encode("utf-8")).hexdigest(), 16)
+
+
+class TokenBucket(object):
+
+    """Allow `rate` units per second, in bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, amount):
+        """The time (s) until `amount` units are available."""
+        self._refill()
+        deficit = min(amount, self.capacity) - self.tokens
+        # Ignore rounding errors
+        return deficit / self.rate if deficit > 1e-6 else 0
+
+    def consume(self, amount):
+        """Take `amount` units, which may leave the bucket in debt."""
+        self._refill()
+        self.tokens -= amount
+
+
+class Shard(object):
+
+    """The byte and record budgets of a shard."""
+
+    def __init__(self, shard_id, clock=time.monotonic):
+        self.shard_id = shard_id
+        self.scale = 1.0
+        self.bytes = TokenBucket(BYTES_PER_SECOND, clock=clock)
+        self.records = TokenBucket(RECORDS_PER_SECOND, clock=clock)
+
+    def wait(self, nbytes):
+        """The time (s) until a record of `nbytes` bytes can be sent."""
+        return max(self.bytes.wait(nbytes), self.records.wait(1))
+
+    def consume(self, nbytes):
+        self.bytes.consume(nbytes)
+        self.records.consume(1)
+
+    def adapt(self, throttled):
+        """Slow down after throttling, speed up again after success."""
+        if throttled:
+            scale = max(self.scale * BACKOFF_FACTOR, MIN_SCALE)
+            logger.warning("Shard %s throttled records: pacing it at %d%% "
+                           "of its limits", self.shard_id, scale * 100)
+        else:
+            scale = min(self.scale + RECOVERY_STEP, 1.0)
+        self.scale = scale
+        self.bytes.rate = BYTES_PER_SECOND * scale
+        self.records.rate = RECORDS_PER_SECOND * scale
+
+
+class RateLimiter(object):
+
+    """Pace the records sent to the shards of a stream.
+
+    `shards` are (starting hash key, shard id) pairs of the open shards.
+    """
+
+    def __init__(self, shards, clock=time.monotonic):
+        shards = sorted(shards)
+        self.starts = [start for start, _ in shards]
+        self.shards = [Shard(shard_id, clock) for _, shard_id in shards]
+        self._lock = threading.Lock()
+
+    def shard(self, record):
+        """The shard a record is routed to."""
+        pos = bisect.bisect_right(self.starts, hash_key(record)) - 1
+        return self.shards[max(pos, 0)]
+
+    def take(self, records, size):
+        """Split records into those that can be sent now and the others.
+
+        `size` is a callable that gives the size of a record. A shard that
+        cannot take a record takes none of the records after it, so that
+        the records of every shard stay in order. Returns the records to
+        send, the records held back, and the time (s) to wait before the
+        first of these can be sent.
+        """
+        ready, held = [], []
+        blocked = {}
+        with self._lock:
+            for record in records:
+                shard = self.shard(record)
+                if shard.shard_id not in blocked:
+                    nbytes = size(record)
+                    wait = shard.wait(nbytes)
+                    if not wait:
+                        shard.consume(nbytes)
+                        ready.append(record)
+                        continue
+                    blocked[shard.shard_id] = wait
+                held.append(record)
+        if not blocked:
+            return ready, held, 0
+        return ready, held, max(min(blocked.values()), MIN_WAIT)
+
+    def feedback(self, records, results):
+        """Adapt the rates of the shards to the result of a PutRecords."""
+        throttled = {}
+        for record, result in zip(records, results):
+            shard = self.shard(record)
+            throttled[shard.shard_id] = (throttled.get(shard.shard_id) or
+                                         result.get("ErrorCode") == THROTTLED)
+        with self._lock:
+            for shard in self.shards:
+                if shard.shard_id in throttled:
+                    shard.adapt(throttled[shard.shard_id])
+
+
+def list_shards(stream_name, client):
+    """The (starting hash key, shard id) pairs of the open shards."""
+    shards, kwargs = [], {"StreamName": stream_name}
+    while True:
+        resp = client.list_shards(**kwargs)
+        for shard in resp["Shards"]:
+            if "EndingSequenceNumber" in shard["SequenceNumberRange"]:
+                # A closed shard: no longer takes records
+                continue
+            shards.append((int(shard["HashKeyRange"]["StartingHashKey"]),
+                           shard["ShardId"]))
+        if not resp.get("NextToken"):
+            return shards
+        kwargs = {"NextToken": resp["NextToken"]}
+
+
+def get_limiter(stream_name, client=None, clock=time.monotonic):
+    """Get the rate limiter of a stream, None if its shards are unknown."""
+    with _lock:
+        limiter, listed = _limiters.get(stream_name, (None, None))
+        if listed is not None and clock() - listed < SHARD_MAP_TTL:
+            return limiter
+        client = client or clients.get_client("kinesis")
+        try:
+            shards = list_shards(stream_name, client)
+        except Exception as err:
+            # E.g. not allowed to list the shards: send records unpaced
+            logger.warning("Unable to list the shards of '%s', records are "
+                           "not paced: %s", stream_name, err)
+            shards = None
+        if shards:
+            logger.info("Pacing records sent to the %d shards of '%s'",
+                        len(shards), stream_name)
+            limiter = RateLimiter(shards, clock)
+        else:
+            limiter = None
+        _limiters[stream_name] = (limiter, clock())
+        return limiter
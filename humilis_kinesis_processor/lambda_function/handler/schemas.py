@@ -0,0 +1,230 @@
+"""Avro and Protobuf records described by a schema registry.
+
+Records start with a header that identifies their schema, in the wire
+format used by the Confluent schema registry: a zero magic byte followed
+by the schema ID as a 4-byte big-endian integer. Schemas are fetched from
+a registry and compiled the first time they are seen, and the compiled
+schemas are kept in a bounded LRU cache for the life of the container.
+
+The built-in registry reads schemas from a directory, with one JSON file
+per schema ID (e.g. ``17.json``)::
+
+    {"type": "avro", "schema": {"type": "record", "name": "PageView", ...}}
+
+    {"type": "protobuf", "descriptor_set": "events.desc",
+     "message": "analytics.PageView"}
+
+where ``events.desc`` is a FileDescriptorSet produced by ``protoc
+--include_imports --descriptor_set_out``, relative to the registry
+directory. Any object with a ``fetch(schema_id)`` method returning such a
+mapping can be used as a registry instead.
+
+Avro records may decode to values that JSON cannot hold (e.g. datetime
+for timestamps, bytes): ``json_default`` encodes them when events are
+written as JSON documents (e.g. to Firehose, or in the logs).
+
+fastavro and protobuf are optional dependencies, imported when a schema of
+their type is first compiled.
+"""
+
+from base64 import b64encode
+from collections import namedtuple, OrderedDict
+import datetime
+import decimal
+import io
+import json
+import logging
+import os
+import struct
+import threading
+import uuid
+
+from lambdautils.exception import CriticalError
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+MAGIC_BYTE = 0
+HEADER = struct.Struct(">bI")
+
+# A compiled schema: callables between events and record bodies
+Schema = namedtuple("Schema", "id type encode decode")
+
+DEFAULT_CACHE_SIZE = 64
+
+
+class SchemaError(Exception):
+
+    """A record could not be encoded or decoded with its schema."""
+
+    pass
+
+
+def json_default(value):
+    """The JSON value of a decoded value json.dumps cannot encode.
+
+    Dates and times become ISO 8601 strings, bytes become base64 strings
+    (as Protobuf encodes them in JSON) and decimals and UUIDs strings.
+    """
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return b64encode(value).decode("ascii")
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(
+        type(value).__name__))
+
+
+class FileSchemaRegistry(object):
+
+    """A schema registry stored in a local directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def fetch(self, schema_id):
+        """The specification of a schema."""
+        path = os.path.join(self.directory, "{}.json".format(schema_id))
+        try:
+            with open(path) as spec:
+                return json.load(spec)
+        except (IOError, OSError):
+            raise CriticalError("Schema {} not found in {}".format(
+                schema_id, self.directory))
+
+
+class LRUCache(object):
+
+    """A thread-safe mapping that keeps the most recently used entries."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _compile_avro(schema_id, spec):
+    """Compile an Avro schema."""
+    try:
+        import fastavro
+    except ImportError:
+        raise CriticalError("Avro schemas require fastavro")
+    parsed = fastavro.parse_schema(spec["schema"])
+
+    def encode(event):
+        buf = io.BytesIO()
+        fastavro.schemaless_writer(buf, parsed, event)
+        return buf.getvalue()
+
+    def decode(body):
+        return fastavro.schemaless_reader(io.BytesIO(body), parsed)
+
+    return Schema(schema_id, "avro", encode, decode)
+
+
+def _compile_protobuf(schema_id, spec, directory):
+    """Compile a Protobuf message type from a descriptor set."""
+    try:
+        from google.protobuf import descriptor_pb2, descriptor_pool
+        from google.protobuf import json_format, message_factory
+    except ImportError:
+        raise CriticalError("Protobuf schemas require protobuf")
+    fds = descriptor_pb2.FileDescriptorSet()
+    with open(os.path.join(directory or "", spec["descriptor_set"]),
+              "rb") as desc:
+        fds.ParseFromString(desc.read())
+    pool = descriptor_pool.DescriptorPool()
+    for proto in fds.file:
+        pool.Add(proto)
+    descriptor = pool.FindMessageTypeByName(spec["message"])
+    if hasattr(message_factory, "GetMessageClass"):
+        cls = message_factory.GetMessageClass(descriptor)
+    else:
+        cls = message_factory.MessageFactory(pool).GetPrototype(descriptor)
+
+    def encode(event):
+        return json_format.ParseDict(event, cls()).SerializeToString()
+
+    def decode(body):
+        return json_format.MessageToDict(
+            cls.FromString(body), preserving_proto_field_name=True)
+
+    return Schema(schema_id, "protobuf", encode, decode)
+
+
+def compile_schema(schema_id, spec, directory=None):
+    """Compile the specification of a schema."""
+    kind = spec.get("type")
+    if kind == "avro":
+        return _compile_avro(schema_id, spec)
+    elif kind == "protobuf":
+        return _compile_protobuf(schema_id, spec, directory)
+    raise CriticalError("Schema {} has an unsupported type: {}".format(
+        schema_id, kind))
+
+
+class SchemaCodec(object):
+
+    """Encode and decode records whose header names their schema."""
+
+    def __init__(self, registry, cache_size=DEFAULT_CACHE_SIZE,
+                 output_schema_id=None):
+        self.registry = registry
+        self.cache = LRUCache(cache_size)
+        self.output_schema_id = output_schema_id
+
+    def schema(self, schema_id):
+        """A compiled schema, from the cache if possible."""
+        schema = self.cache.get(schema_id)
+        if schema is None:
+            schema = compile_schema(schema_id,
+                                    self.registry.fetch(schema_id),
+                                    getattr(self.registry, "directory", None))
+            logger.info("Compiled %s schema %s", schema.type, schema_id)
+            self.cache.put(schema_id, schema)
+        return schema
+
+    def decode(self, payload):
+        """Decode a record with the schema named in its header."""
+        if len(payload) < HEADER.size:
+            raise SchemaError("Record too short to have a schema header")
+        magic, schema_id = HEADER.unpack_from(payload)
+        if magic != MAGIC_BYTE:
+            raise SchemaError("Unknown magic byte: {}".format(magic))
+        return self.schema(schema_id).decode(payload[HEADER.size:])
+
+    def encode(self, event):
+        """Encode an event with the output schema."""
+        if self.output_schema_id is None:
+            raise CriticalError("No output schema ID has been configured")
+        schema = self.schema(self.output_schema_id)
+        return HEADER.pack(MAGIC_BYTE, schema.id) + schema.encode(event)
+
+
+def from_environment():
+    """A codec for the schema registry configured in the environment."""
+    output_schema_id = os.environ.get("OUTPUT_SCHEMA_ID")
+    return SchemaCodec(
+        FileSchemaRegistry(os.environ.get("SCHEMA_REGISTRY_PATH") or
+                           "schemas"),
+        cache_size=int(os.environ.get("SCHEMA_CACHE_SIZE") or
+                       DEFAULT_CACHE_SIZE),
+        output_schema_id=int(output_schema_id) if output_schema_id else None)
@@ -0,0 +1,275 @@
+"""A registry of codecs that work on bytes.
+
+A codec is named in a spec such as ``json``, ``msgpack+zstd`` or
+``schema+gzip`` (Avro or Protobuf, see the schemas module): the first
+codec is a format (events <-> bytes) and the rest are framings (bytes <->
+bytes), applied from left to right when encoding and from right to left
+when decoding. Every step consumes and produces
+bytes, so no str copies are made between base64, the framings and the
+format.
+
+A codec may have several implementations (e.g. orjson, ujson and json for
+JSON). If more than one can be imported they are timed on a sample event
+when the codec is first used, and the fastest is kept for the life of the
+container.
+"""
+
+from base64 import b64decode
+from collections import namedtuple, OrderedDict
+import gzip
+import json
+import logging
+import os
+import time
+import zlib
+
+from lambdautils.exception import CriticalError
+from lambdautils.utils import BadKinesisEventError
+
+from .columnar import format_timestamp
+from .plan import Codecs
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+FORMAT = "format"
+FRAMING = "framing"
+
+Implementation = namedtuple("Implementation", "name encode decode")
+
+# codec name -> (kind, candidate implementation loaders)
+_registry = OrderedDict()
+
+# codec name -> the implementation picked for this container
+_selected = {}
+
+# Used to time the implementations of a codec
+SAMPLE_EVENT = {
+    "id": "2f7c1d0a3a9e4b5c8d6e7f8091a2b3c4",
+    "event_type": "page_view",
+    "timestamp": "2016-01-22T01:45:44.235+01:00",
+    "client_id": "1628457772.1449082074",
+    "user_agent": ("Mozilla/5.0 (Linux; U; Android 4.0.4; en-gb; GT-I9300 "
+                   "Build/IMM76D) AppleWebKit/534.30 (KHTML, like Gecko)"),
+    "url": "http://www.example.com/?lang=nl-NL",
+    "position": 12,
+    "price": 129.99,
+    "tags": ["a", "b", "c"],
+    "meta": {"experiment": "b", "new_user": False, "session": None}}
+
+BENCHMARK_ROUNDS = 200
+
+
+def register(name, kind, loader):
+    """Register a candidate implementation of a codec.
+
+    `loader` is called without arguments and returns an Implementation,
+    or raises ImportError if the implementation is not available.
+    Candidates registered first win ties.
+    """
+    if kind not in (FORMAT, FRAMING):
+        raise ValueError("Unknown codec kind: {}".format(kind))
+    registered_kind, loaders = _registry.setdefault(name, (kind, []))
+    if registered_kind != kind:
+        raise ValueError("{} is a {} codec".format(name, registered_kind))
+    loaders.append(loader)
+    _selected.pop(name, None)
+
+
+def _to_bytes(data):
+    """Accept str payloads, e.g. documents forwarded as they were received."""
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, (bytearray, memoryview)):
+        return bytes(data)
+    return data.encode("utf-8")
+
+
+def _orjson():
+    import orjson
+    return Implementation("orjson", orjson.dumps, orjson.loads)
+
+
+def _ujson():
+    import ujson
+    return Implementation(
+        "ujson", lambda obj: ujson.dumps(obj).encode("utf-8"), ujson.loads)
+
+
+def _json():
+    return Implementation(
+        "json", lambda obj: json.dumps(obj).encode("utf-8"), json.loads)
+
+
+def _msgpack():
+    import msgpack
+    return Implementation(
+        "msgpack",
+        lambda obj: msgpack.packb(obj, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False))
+
+
+def _zstandard():
+    import zstandard
+    compressor = zstandard.ZstdCompressor()
+    decompressor = zstandard.ZstdDecompressor()
+    return Implementation(
+        "zstandard",
+        lambda data: compressor.compress(_to_bytes(data)),
+        decompressor.decompress)
+
+
+def _pyzstd():
+    import pyzstd
+    return Implementation(
+        "pyzstd", lambda data: pyzstd.compress(_to_bytes(data)),
+        pyzstd.decompress)
+
+
+def _schema_registry():
+    from . import schemas
+    codec = schemas.from_environment()
+    return Implementation("schema-registry", codec.encode, codec.decode)
+
+
+def _gzip():
+    return Implementation(
+        "gzip", lambda data: gzip.compress(_to_bytes(data)), gzip.decompress)
+
+
+def _zlib():
+    return Implementation(
+        "zlib", lambda data: zlib.compress(_to_bytes(data)), zlib.decompress)
+
+
+register("json", FORMAT, _orjson)
+register("json", FORMAT, _ujson)
+register("json", FORMAT, _json)
+register("msgpack", FORMAT, _msgpack)
+register("schema", FORMAT, _schema_registry)
+register("zstd", FRAMING, _zstandard)
+register("zstd", FRAMING, _pyzstd)
+register("gzip", FRAMING, _gzip)
+register("zlib", FRAMING, _zlib)
+
+
+def _sample(kind):
+    """The sample payload an implementation is timed on."""
+    if kind == FORMAT:
+        return SAMPLE_EVENT
+    return json.dumps([SAMPLE_EVENT] * 4).encode("utf-8")
+
+
+def benchmark(impl, sample, rounds=BENCHMARK_ROUNDS):
+    """Seconds taken to encode and decode a sample, or None if it is lost."""
+    start = time.time()
+    for _ in range(rounds):
+        decoded = impl.decode(impl.encode(sample))
+    duration = time.time() - start
+    if decoded != sample:
+        return None
+    return duration
+
+
+def select(name):
+    """Pick the fastest available implementation of a codec."""
+    impl = _selected.get(name)
+    if impl is not None:
+        return impl
+    if name not in _registry:
+        raise CriticalError("Unknown codec '{}': must be one of {}".format(
+            name, ", ".join(_registry)))
+
+    kind, loaders = _registry[name]
+    candidates = []
+    for loader in loaders:
+        try:
+            candidates.append(loader())
+        except ImportError:
+            continue
+    if len(candidates) == 1:
+        # Nothing to choose from
+        _selected[name] = candidates[0]
+        return candidates[0]
+
+    sample = _sample(kind)
+    timings = []
+    for candidate in candidates:
+        try:
+            duration = benchmark(candidate, sample)
+        except Exception:
+            logger.exception("Unable to benchmark an implementation of %s",
+                             name)
+            continue
+        if duration is None:
+            logger.warning("%s does not round-trip %s: ignored",
+                           candidate.name, name)
+            continue
+        timings.append((duration, len(timings), candidate))
+
+    if not timings:
+        raise CriticalError("No implementation of codec '{}' is "
+                            "available".format(name))
+    duration, _, impl = min(timings)
+    logger.info("Codec %s: using %s (%s)", name, impl.name, ", ".join(
+        "{}={:.2f}ms".format(c.name, d * 1000) for d, _, c in timings))
+    _selected[name] = impl
+    return impl
+
+
+def _compose(funcs):
+    """Chain functions that take and return bytes."""
+    if not funcs:
+        return None
+    if len(funcs) == 1:
+        return funcs[0]
+
+    def composed(data):
+        for func in funcs:
+            data = func(data)
+        return data
+    return composed
+
+
+def get_codecs(spec):
+    """Resolve a codec spec into the callables used to encode and decode."""
+    names = [name.strip() for name in spec.split("+") if name.strip()]
+    if not names:
+        raise CriticalError("Empty codec spec")
+    kinds = [_registry.get(name, (None,))[0] for name in names]
+    if kinds[0] not in (FORMAT, None) or FORMAT in kinds[1:]:
+        raise CriticalError("Codec spec '{}' must be a format optionally "
+                            "followed by framings".format(spec))
+    fmt = select(names[0])
+    framings = [select(name) for name in names[1:]]
+    return Codecs(
+        deserializer=fmt.decode,
+        unpacker=_compose([f.decode for f in reversed(framings)]),
+        serializer=fmt.encode,
+        packer=_compose([f.encode for f in framings]))
+
+
+def unpack_kinesis_event(kinesis_event, codecs, embed_timestamp=None):
+    """Extract events from a Kinesis event using registry codecs.
+
+    Like lambdautils.utils.unpack_kinesis_event, except that payloads are
+    handed to the codecs as bytes.
+    """
+    events, shard_ids = [], set()
+    for rec in kinesis_event["Records"]:
+        payload = b64decode(rec["kinesis"]["data"])
+        if codecs.unpacker:
+            payload = codecs.unpacker(payload)
+        event = codecs.deserializer(payload)
+        if isinstance(event, dict) and embed_timestamp:
+            event[embed_timestamp] = format_timestamp(
+                rec["kinesis"].get("approximateArrivalTimestamp"))
+        events.append(event)
+        shard_ids.add(rec["eventID"].split(":")[0])
+
+    if len(shard_ids) > 1:
+        raise BadKinesisEventError(
+            "Kinesis event contains records from several shards: {}".format(
+                shard_ids))
+
+    return events, shard_ids.pop()
@@ -0,0 +1,117 @@
+"""Cold start profiling and priming."""
+
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+ImportTiming = namedtuple("ImportTiming", "name depth duration")
+
+# Duration of the phases of the container initialization, in seconds
+_phases = OrderedDict()
+
+
+class ImportProfiler(object):
+
+    """Measure the time spent importing modules.
+
+    Only imports that load at least one new module are recorded. The
+    duration of an import includes the imports it triggers, which are
+    recorded as well, with a larger depth.
+    """
+
+    def __init__(self):
+        self.timings = []
+        self._depth = 0
+        self._original = None
+
+    def start(self):
+        """Start profiling imports."""
+        self._original = builtins.__import__
+        builtins.__import__ = self._import
+        return self
+
+    def stop(self):
+        """Stop profiling imports."""
+        if self._original is not None:
+            builtins.__import__ = self._original
+            self._original = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        nbmodules = len(sys.modules)
+        self._depth += 1
+        start = time.time()
+        try:
+            return self._original(name, globals, locals, fromlist, level)
+        finally:
+            duration = time.time() - start
+            self._depth -= 1
+            if len(sys.modules) > nbmodules:
+                self.timings.append(
+                    ImportTiming("." * level + name, self._depth, duration))
+
+    def breakdown(self, depth=0):
+        """The durations of the imports up to a given depth, slowest first."""
+        return sorted(((t.name, round(t.duration, 4)) for t in self.timings
+                       if t.depth <= depth),
+                      key=lambda t: -t[1])
+
+
+def profile_imports():
+    """Start an import profiler if cold start profiling is enabled."""
+    if os.environ.get("PROFILE_COLD_START", "").lower() in ("true", "yes"):
+        return ImportProfiler().start()
+
+
+@contextmanager
+def timed(phase):
+    """Record the duration of a phase of the container initialization."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        _phases[phase] = _phases.get(phase, 0) + time.time() - start
+
+
+def report(profiler=None):
+    """The cold start breakdown: phases and (if profiled) imports."""
+    result = {"phases": OrderedDict(
+        (k, round(v, 4)) for k, v in _phases.items())}
+    if profiler is not None:
+        result["imports"] = profiler.breakdown()
+    return result
+
+
+def log_report(profiler=None):
+    """Log the cold start breakdown."""
+    logger.info("Cold start breakdown: %s", json.dumps(report(profiler)))
+
+
+def prime(get_plan, clients=("kinesis", "firehose")):
+    """Do as much of the work of the first invocation as possible.
+
+    This runs during the init phase of the Lambda container, which is not
+    billed and which, with provisioned concurrency, happens before any
+    invocation is received. Errors are logged and otherwise ignored: they
+    will be raised again (and reported) by the first invocation.
+    """
+    try:
+        with timed("plan"):
+            get_plan()
+        from .clients import get_client
+        with timed("clients"):
+            for name in clients:
+                get_client(name)
+    except Exception:
+        logger.exception("Unable to prime the Lambda container")
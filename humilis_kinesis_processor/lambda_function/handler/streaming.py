@@ -0,0 +1,173 @@
+"""Process very large batches in chunks, with bounded memory.
+
+In streaming mode the records of a Kinesis event are processed in chunks
+of a fixed number of records: only the events of one chunk (and the
+events each output produces from them) are held in memory at any time.
+The outputs of a chunk are delivered in one of two ways:
+
+- ``chunked``: as soon as the chunk is processed. Memory is bounded by the
+  chunk size, but if a later chunk makes the invocation fail the records
+  delivered so far are delivered again when the batch is retried.
+
+- ``all-or-nothing`` (the default): the encoded records of every chunk are
+  held in a buffer and only sent once all chunks have been processed, so
+  that nothing is delivered unless the whole batch is. Encoded records
+  take much less memory than the events they come from, and the buffer
+  has a hard size limit: a batch that exceeds it fails.
+"""
+
+from collections import OrderedDict
+import logging
+import os
+import threading
+
+from lambdautils.exception import CriticalError
+
+from . import clients
+from . import deadline
+from . import executor
+from . import processor
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+ALL_OR_NOTHING = "all-or-nothing"
+CHUNKED = "chunked"
+DELIVERY_MODES = (ALL_OR_NOTHING, CHUNKED)
+
+DEFAULT_MEMORY_BUDGET = 256
+
+
+def chunk_size():
+    """The number of records processed at once, 0 if streaming is off."""
+    return int(os.environ.get("STREAM_CHUNK_SIZE") or 0)
+
+
+def enabled():
+    """True if the records of an event are processed in chunks."""
+    return chunk_size() > 0
+
+
+def delivery_mode():
+    """How the outputs of every chunk are delivered."""
+    mode = os.environ.get("STREAM_DELIVERY") or ALL_OR_NOTHING
+    if mode not in DELIVERY_MODES:
+        raise CriticalError("Unknown stream delivery mode '{}': must be one "
+                            "of {}".format(mode, ", ".join(DELIVERY_MODES)))
+    return mode
+
+
+def memory_budget():
+    """The maximum size of the buffered records, in bytes."""
+    return int(os.environ.get("STREAM_MEMORY_BUDGET") or
+               DEFAULT_MEMORY_BUDGET) * 1024 * 1024
+
+
+def chunks(kinesis_event, size, scheduler=None):
+    """Split a Kinesis event into events of at most `size` records.
+
+    With a deadline `scheduler` chunks are sized to fit in the time left,
+    and the last item is the remaining records if they do not fit.
+    Produces (chunk, True if it is to be processed) pairs.
+    """
+    records = kinesis_event["Records"]
+    start = 0
+    while start < len(records):
+        count = size
+        if scheduler is not None:
+            count = scheduler.next_chunk(size)
+            if not count:
+                yield dict(kinesis_event, Records=records[start:]), False
+                return
+        yield dict(kinesis_event, Records=records[start:start + count]), True
+        start += count
+
+
+def _record_size(record):
+    """The approximate number of bytes taken by an encoded record."""
+    return len(record["Data"]) + len(record.get("PartitionKey") or "")
+
+
+class RecordBuffer(object):
+
+    """Encoded records held until the whole batch has been processed."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # (put callable, stream) -> records, in the order they were added
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, put, records, stream):
+        """Add records to be sent to a stream."""
+        size = sum(_record_size(rec) for rec in records)
+        with self._lock:
+            if self.nbytes + size > self.max_bytes:
+                raise CriticalError(
+                    "The records of the batch exceed the memory budget of {} "
+                    "bytes: use chunked delivery or a smaller batch "
+                    "size".format(self.max_bytes))
+            self.nbytes += size
+            self._records.setdefault((put, stream), []).extend(records)
+
+    def flush(self, concurrency=1):
+        """Send all the buffered records."""
+        calls = [(put, (records, stream))
+                 for (put, stream), records in self._records.items()]
+        self._records = OrderedDict()
+        self.nbytes = 0
+        if concurrency > 1:
+            clients.setup_default_session()
+        for metrics in executor.run_all(calls, concurrency, "delivery"):
+            logger.info("Flushed buffered records in %d calls", len(metrics))
+
+
+def process_event(kevent, context, inputp, outputp, partial=False):
+    """Process the records of a Kinesis event in chunks.
+
+    Returns the errors and, if `partial` is set, the sequence number of
+    the first failed record: chunks after the one that holds that record
+    are not processed, as they will be retried. In deadline-aware mode
+    the first record that could not be processed in time is reported as
+    failed, too.
+    """
+    size = chunk_size() or len(kevent["Records"])
+    scheduler = None
+    if deadline.enabled():
+        scheduler = deadline.Scheduler(context)
+    buffer = None
+    # Deadline-aware processing on its own delivers every chunk as soon as
+    # it is processed: its chunks are all before the checkpoint
+    if enabled() and delivery_mode() == ALL_OR_NOTHING:
+        buffer = RecordBuffer(memory_budget())
+
+    failed, seqnum = [], None
+    # The number of input events in the chunks processed so far
+    offset = 0
+    for index, (chunk, process) in enumerate(
+            chunks(kevent, size, scheduler)):
+        if not process:
+            seqnum = chunk["Records"][0]["kinesis"]["sequenceNumber"]
+            logger.warning("Not enough time left to process %d records: "
+                           "checkpointing before record %s",
+                           len(chunk["Records"]), seqnum)
+            break
+        logger.info("Processing chunk #%d", index)
+        if scheduler is not None:
+            scheduler.start()
+        # The output events of a chunk are dropped as soon as delivered
+        _, cfailed, seqnum, nbevents = processor._process(
+            chunk, context, inputp, outputp, partial=partial, buffer=buffer)
+        if scheduler is not None:
+            scheduler.done(len(chunk["Records"]))
+        # Positions in the chunk become positions in the whole batch
+        failed += [err._replace(index=err.index + offset) for err in cfailed]
+        offset += nbevents
+        if seqnum is not None:
+            break
+
+    if buffer is not None:
+        logger.info("Delivering %d buffered bytes", buffer.nbytes)
+        buffer.flush(processor._delivery_concurrency())
+    return failed, seqnum
@@ -0,0 +1,224 @@
+"""Copy-on-write views of events passed to filters and mappers."""
+
+import copy
+
+# Values that can be safely shared between views. Any other value (e.g. a
+# set, or a tuple that may hold mutable items) is deep copied.
+_IMMUTABLE = (str, bytes, int, float, complex, bool, type(None))
+
+
+class CowDict(dict):
+
+    """A dict view that copies nested containers before handing them out.
+
+    Creating a view is a shallow copy of the top-level keys. Nested dicts and
+    lists are shared with the source until they are accessed through the
+    view, at which point they are replaced by views of their own, and other
+    mutable values by deep copies. Mutating a view can therefore never
+    modify the event it was created from.
+    """
+
+    __slots__ = ("_owned",)
+
+    def __init__(self, source=()):
+        if type(source) is CowDict:
+            source = dict.items(source)
+        dict.__init__(self, source)
+        # ids of the nested containers that are private to this view
+        self._owned = set()
+
+    def _own(self, key, value):
+        """Replace a shared nested container by a private view."""
+        if id(value) in self._owned or isinstance(value, _IMMUTABLE):
+            return value
+        value = isolate(value)
+        dict.__setitem__(self, key, value)
+        self._owned.add(id(value))
+        return value
+
+    def __getitem__(self, key):
+        return self._own(key, dict.__getitem__(self, key))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._owned.add(id(value))
+
+    def __iter__(self):
+        # Overriding __iter__ makes dict(view) go through __getitem__
+        return dict.__iter__(self)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            dict.__delitem__(self, key)
+            return value
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key = next(reversed(list(dict.keys(self))))
+        return key, self.pop(key)
+
+    def values(self):
+        return [self[key] for key in dict.keys(self)]
+
+    def items(self):
+        return [(key, self[key]) for key in dict.keys(self)]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __or__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        merged = dict(self.items())
+        merged.update(other)
+        return merged
+
+    def __ror__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        merged = dict(other)
+        merged.update(self.items())
+        return merged
+
+    def copy(self):
+        return CowDict(self)
+
+    def __copy__(self):
+        return CowDict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(materialize(self), memo)
+
+    def __reduce__(self):
+        return (dict, (materialize(self),))
+
+    def _materialize(self):
+        return {k: materialize(v) for k, v in dict.items(self)}
+
+
+class CowList(list):
+
+    """A list view that copies nested containers before handing them out."""
+
+    __slots__ = ("_owned",)
+
+    def __init__(self, source=()):
+        if type(source) is CowList:
+            source = list.__iter__(source)
+        list.__init__(self, source)
+        self._owned = set()
+
+    def _own(self, index, value):
+        """Replace a shared nested container by a private view."""
+        if id(value) in self._owned or isinstance(value, _IMMUTABLE):
+            return value
+        value = isolate(value)
+        list.__setitem__(self, index, value)
+        self._owned.add(id(value))
+        return value
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CowList(self[i] for i in range(*index.indices(len(self))))
+        return self._own(index, list.__getitem__(self, index))
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        if isinstance(index, slice):
+            self._owned.update(id(v) for v in list.__getitem__(self, index))
+        else:
+            self._owned.add(id(value))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __reversed__(self):
+        for index in reversed(range(len(self))):
+            yield self[index]
+
+    def __add__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(other) + list(self)
+
+    def __mul__(self, times):
+        return list(self) * times
+
+    __rmul__ = __mul__
+
+    def append(self, value):
+        list.append(self, value)
+        self._owned.add(id(value))
+
+    def insert(self, index, value):
+        list.insert(self, index, value)
+        self._owned.add(id(value))
+
+    def extend(self, values):
+        values = list(values)
+        list.extend(self, values)
+        self._owned.update(id(v) for v in values)
+
+    def pop(self, index=-1):
+        value = self[index]
+        list.pop(self, index)
+        return value
+
+    def copy(self):
+        return CowList(self)
+
+    def __copy__(self):
+        return CowList(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(materialize(self), memo)
+
+    def __reduce__(self):
+        return (list, (materialize(self),))
+
+
+def isolate(obj):
+    """Produce a view of an object that is safe to hand to user callables."""
+    if isinstance(obj, CowDict):
+        # Views know best how to produce a view of themselves
+        return obj.copy()
+    elif isinstance(obj, dict):
+        return CowDict(obj)
+    elif isinstance(obj, list):
+        return CowList(obj)
+    elif isinstance(obj, _IMMUTABLE):
+        return obj
+    else:
+        return copy.deepcopy(obj)
+
+
+def materialize(obj):
+    """Turn a view back into plain dicts and lists.
+
+    Nested containers that were never accessed through the view are shared
+    with the source event, so the result must be treated as read-only.
+    """
+    if isinstance(obj, CowDict):
+        return obj._materialize()
+    elif type(obj) is CowList:
+        return [materialize(v) for v in list.__iter__(obj)]
+    else:
+        return obj
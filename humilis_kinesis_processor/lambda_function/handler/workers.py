@@ -0,0 +1,208 @@
+"""A pool of worker processes for CPU-bound callables.
+
+Threads cannot run Python code on more than one core at a time, so the
+process engine hands chunks of events to worker processes instead. The
+workers are forked the first time they are needed and reused by every
+later invocation of the container.
+
+Lambda has no /dev/shm, which multiprocessing.Pool and the queues of
+concurrent.futures need for their semaphores, so every worker is a plain
+multiprocessing.Process that talks to the parent over a Pipe. A worker
+only ever has one chunk in flight, which keeps both ends of every pipe
+from blocking on each other. Requests and results are pickled with the
+highest protocol: callables must therefore be importable module-level
+functions.
+
+Forking a process that runs threads may deadlock the child, so the
+workers are forked during the init phase of the container, before any
+thread pool is started. Only one batch of calls is in flight at a time:
+concurrent callers (e.g. outputs processed concurrently) take turns.
+"""
+
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import pickle
+import threading
+import traceback
+
+from lambdautils.exception import CriticalError
+
+logger = logging.getLogger()
+logger.setLevel(getattr(logging, os.environ.get("LOGGING_LEVEL", "INFO")))
+
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+# The workers of this container: (process, connection) pairs
+_workers = []
+# Held while the workers are forked or have calls in flight
+_lock = threading.RLock()
+
+DEFAULT_TIMEOUT = 60
+
+
+def enabled():
+    """True if filters and mappers run in worker processes."""
+    return os.environ.get("EXECUTION_ENGINE") == "process"
+
+
+def pool_size():
+    """The number of worker processes."""
+    return int(os.environ.get("WORKER_PROCESSES") or
+               multiprocessing.cpu_count())
+
+
+def timeout():
+    """The time (s) a chunk of calls may take in a worker."""
+    return float(os.environ.get("WORKER_TIMEOUT") or DEFAULT_TIMEOUT)
+
+
+class WorkerError(Exception):
+
+    """A worker raised an exception that could not be sent back as is.
+
+    Holds the name of the type of the exception and its repr.
+    """
+
+    def __init__(self, name, description):
+        super(WorkerError, self).__init__(name, description)
+        self.name = name
+        self.description = description
+
+    def __str__(self):
+        return "{}: {}".format(self.name, self.description)
+
+
+def portable(err):
+    """An exception that can be sent back to the parent process.
+
+    Exceptions that cannot be both pickled and unpickled (e.g. their
+    constructor takes other arguments than their args) are replaced by a
+    WorkerError.
+    """
+    try:
+        pickle.loads(pickle.dumps(err, PROTOCOL))
+        return err
+    except Exception:
+        return WorkerError(type(err).__name__, repr(err))
+
+
+def _serve(conn):
+    """Run the calls sent by the parent process until the pipe is closed."""
+    while True:
+        try:
+            func, args = pickle.loads(conn.recv_bytes())
+        except EOFError:
+            break
+        try:
+            result = (True, func(*args))
+        except Exception as err:
+            result = (False, (portable(err), traceback.format_exc()))
+        try:
+            payload = pickle.dumps(result, PROTOCOL)
+        except Exception as err:
+            # A result that cannot be pickled
+            payload = pickle.dumps(
+                (False, (portable(err), traceback.format_exc())), PROTOCOL)
+        conn.send_bytes(payload)
+
+
+def get_workers():
+    """Fork the worker processes, once per container."""
+    with _lock:
+        if not _workers:
+            _fork()
+        return _workers
+
+
+def _fork():
+    """Fork the worker processes."""
+    if threading.active_count() > 1:
+        logger.warning("Forking worker processes while %d threads run: fork "
+                       "them on init instead", threading.active_count())
+    ctx = multiprocessing.get_context("fork")
+    for _ in range(max(pool_size(), 1)):
+        parent, child = ctx.Pipe()
+        process = ctx.Process(target=_serve, args=(child,))
+        process.daemon = True
+        process.start()
+        child.close()
+        _workers.append((process, parent))
+    logger.info("Forked %d worker processes", len(_workers))
+
+
+def shutdown():
+    """Stop the worker processes."""
+    with _lock:
+        while _workers:
+            process, conn = _workers.pop()
+            conn.close()
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+
+def run(calls):
+    """Run a list of (callable, args) pairs in the worker processes.
+
+    Returns the results in order. If a call raises an exception the
+    exception is re-raised once all calls have completed, with the
+    traceback of the worker logged. If no call completes within the
+    timeout, or the results of the workers cannot be read, the workers are
+    stopped, to be forked again next time.
+    """
+    try:
+        payloads = [pickle.dumps(call, PROTOCOL) for call in calls]
+    except (pickle.PicklingError, AttributeError, TypeError) as err:
+        raise CriticalError(
+            "Unable to send work to the worker processes (callables must be "
+            "module-level functions): {}".format(err))
+
+    with _lock:
+        results = _run(get_workers(), payloads, timeout())
+
+    for ok, result in results:
+        if not ok:
+            error, tb = result
+            logger.error("Exception in a worker process:\n%s", tb)
+            raise error
+    return [result for _, result in results]
+
+
+def _run(workers, payloads, seconds):
+    """Send pickled calls to the workers and collect their results."""
+    results = [None] * len(payloads)
+    pending = list(range(len(payloads)))
+    # connection -> index of the call it is running
+    busy = {}
+    idle = [conn for _, conn in workers]
+    try:
+        while pending or busy:
+            while pending and idle:
+                conn = idle.pop()
+                index = pending.pop(0)
+                conn.send_bytes(payloads[index])
+                busy[conn] = index
+            ready = wait(list(busy), seconds)
+            if not ready:
+                raise CriticalError("No worker process completed a call in "
+                                    "{} s".format(seconds))
+            for conn in ready:
+                results[busy.pop(conn)] = pickle.loads(conn.recv_bytes())
+                idle.append(conn)
+    except (EOFError, OSError) as err:
+        # A worker died (e.g. out of memory): start afresh next time
+        shutdown()
+        raise CriticalError("A worker process died: {}".format(err))
+    except CriticalError:
+        # Results of stuck workers would be read by the next batch
+        shutdown()
+        raise
+    except Exception as err:
+        # E.g. a result that cannot be unpickled: the results of the other
+        # busy workers would be read by the next batch
+        shutdown()
+        raise CriticalError("Unable to read the result of a worker process: "
+                            "{!r}".format(err))
+    return results
@@ -10,9 +10,9 @@ setup(
     # We often need the latest version of boto3 so we include it as a req
     install_requires=[
         "boto3",
+        "futures; python_version < '3.0'",
         "raven",
         "lambdautils>=1.4.5",
-        "werkzeug",
     ],
     classifiers=[
         "Programming Language :: Python :: 2.7"],
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""Train a zstd dictionary on sample events and add it to a directory.
+
+The samples are files with one serialized event per line, e.g. records
+exported from the output stream. Prints the ID of the new dictionary,
+which is the value of the compression_dict_id layer parameter.
+
+    train-dictionary.py <dictionary directory> <sample file>...
+"""
+
+import os
+import sys
+
+from humilis_kinesis_processor.lambda_function.handler import compression
+
+# The size of the dictionary, in bytes
+DICT_SIZE = int(os.environ.get("DICT_SIZE") or compression.DEFAULT_DICT_SIZE)
+
+
+def train(directory, *sample_files):
+    """Train a dictionary and save it as a new version."""
+    samples = []
+    for path in sample_files:
+        with open(path, "rb") as f:
+            samples += [line.rstrip(b"\n") for line in f if line.strip()]
+
+    print("Training a {} bytes dictionary on {} samples ...".format(
+        DICT_SIZE, len(samples)))
+    dictionary = compression.train_dictionary(samples, DICT_SIZE)
+    dict_id = compression.save_dictionary(
+        dictionary, directory, samples=len(samples),
+        sources=[os.path.basename(path) for path in sample_files])
+    print("Dictionary {} saved in {}".format(dict_id, directory))
+
+
+if __name__ == "__main__":
+    train(*sys.argv[1:])
@@ -104,7 +104,7 @@ def dynamodb_client():
 @pytest.fixture
 def boto3_client(kinesis_client, kms_client, dynamodb_client):
     """Mocked boto3.client."""
-    def produce_client(name):
+    def produce_client(name, **kwargs):
         """Produce boto3.client mock."""
         return {"kinesis": kinesis_client, "kms": kms_client,
                 "firehose": kinesis_client,
@@ -146,6 +146,10 @@ def import_string_mock():
 def global_patch(boto3_client, boto3_resource, import_string_mock,
                  monkeypatch):
     """Patch boto3 and import_string."""
+    # Do not reuse the clients created in other tests
+    monkeypatch.setattr(
+        "humilis_kinesis_processor.lambda_function.handler.clients._clients",
+        {})
     monkeypatch.setattr("boto3.client", boto3_client)
     monkeypatch.setattr("boto3.resource", boto3_resource)
     monkeypatch.setattr(
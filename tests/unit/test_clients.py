@@ -0,0 +1,34 @@
+"""Test the shared AWS clients."""
+
+from mock import Mock
+
+from humilis_kinesis_processor.lambda_function.handler import clients
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+
+
+def test_clients_are_reused(boto3_client, monkeypatch):
+    """A client is created once per service."""
+    monkeypatch.setenv("DELIVERY_CONCURRENCY", "32")
+    kinesis = clients.get_client("kinesis")
+    assert clients.get_client("kinesis") is kinesis
+    assert clients.get_client("firehose") is kinesis
+    assert boto3_client.call_count == 2
+    config = boto3_client.call_args[1]["config"]
+    assert config.max_pool_connections == 32
+
+
+def test_pool_size(monkeypatch):
+    """The connection pool is never smaller than botocore's default."""
+    monkeypatch.setenv("DELIVERY_CONCURRENCY", "2")
+    assert clients.pool_size() == clients.DEFAULT_POOL_SIZE
+
+
+def test_register_stand_in(boto3_client):
+    """A local stand-in can replace the client of a service."""
+    stand_in = Mock()
+    stand_in.put_records.return_value = {
+        "ResponseMetadata": {"HTTPStatusCode": 200}}
+    clients.register("kinesis", stand_in)
+    processor.send_to_kinesis_stream([{"a": 1}], "s", None)
+    assert stand_in.put_records.call_count == 1
+    assert boto3_client("kinesis").put_records.call_count == 0
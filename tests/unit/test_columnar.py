@@ -0,0 +1,118 @@
+"""Test columnar batches of events."""
+
+import json
+
+from mock import Mock
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.columnar as columnar
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+from . import make_kinesis_event
+from .. import make_records
+
+pa = pytest.importorskip("pyarrow")
+pc = pytest.importorskip("pyarrow.compute")
+
+
+@pytest.fixture
+def columnar_mode(monkeypatch):
+    """Enable the columnar mode."""
+    monkeypatch.setenv("COLUMNAR", "yes")
+
+
+def test_unpack_kinesis_event(kinesis_record_template):
+    """Records are decoded into a table with the arrival timestamp."""
+    kinesis_record_template["kinesis"]["approximateArrivalTimestamp"] = 86400
+    kevent = make_kinesis_event(kinesis_record_template, make_records(3))
+    table, shard_id = columnar.unpack_kinesis_event(
+        kevent, embed_timestamp="received_at")
+    assert shard_id == "shardId-000000000000"
+    assert table.num_rows == 3
+    assert table.column("index").to_pylist() == [0, 1, 2]
+    assert table.column("received_at").to_pylist() == \
+        ["1970-01-02 00:00:00"] * 3
+
+
+def test_ipc_round_trip():
+    """Columnar records are decoded together with JSON records."""
+    table = columnar.from_rows(make_records(10))
+    records = columnar.make_records(table, "key", max_bytes=2048)
+    assert len(records) > 1
+    assert all(len(rec["Data"]) <= 2048 for rec in records)
+    assert {rec["PartitionKey"] for rec in records} == {"key"}
+
+    payloads = [rec["Data"] for rec in records] + [b'{"index": 10}']
+    decoded, counts = columnar.decode_payloads(payloads)
+    assert decoded.column("index").to_pylist() == list(range(11))
+    assert sum(counts) == 11 and counts[-1] == 1
+
+
+def test_columnar_pipeline():
+    """Batch stages get tables, row stages get dicts."""
+    table = columnar.from_rows(make_records(4))
+
+    def batch_mapper(table, context):
+        return table.append_column(
+            "double", pc.multiply(table.column("index"), 2))
+
+    def batch_filter(table, context):
+        return pc.greater(table.column("index"), 0)
+
+    pipeline = {"batch_mapper": batch_mapper, "batch_filter": batch_filter}
+    processed, failed = processor.run_pipeline(pipeline, table, {})
+    assert columnar.is_table(processed)
+    assert processed.column("double").to_pylist() == [2, 4, 6]
+
+    def mapper(ev, context):
+        if ev["index"] == 2:
+            raise ValueError("bad event")
+        return ev
+
+    pipeline["mapper"] = mapper
+    processed, failed = processor.run_pipeline(pipeline, table, {})
+    assert [ev["double"] for ev in processed] == [2, 6]
+    # Errors refer to the position of the event in the original batch
+    assert [err.index for err in failed] == [2]
+
+
+def test_columnar_batch_filter_errors():
+    """Events a batch filter fails for are reported, not kept."""
+    table = columnar.from_rows(make_records(4))
+
+    def batch_filter(table, context):
+        return [True, ValueError("bad event"), True, False]
+
+    processed, failed = processor.run_pipeline(
+        {"batch_filter": batch_filter}, table, {})
+    assert processed.column("index").to_pylist() == [0, 2]
+    assert [err.index for err in failed] == [1]
+    assert isinstance(failed[0].error, ValueError)
+    assert failed[0].event["index"] == 1
+
+    pipeline = {"batch_filter": batch_filter, "filter": lambda ev, ctx: True}
+    processed, failed = processor.run_pipeline(pipeline, table, {})
+    assert [ev["index"] for ev in processed] == [0, 2]
+    assert [err.index for err in failed] == [1]
+
+
+def test_process_event(columnar_mode, kinesis_record_template, context,
+                       boto3_client):
+    """Columnar outputs are shipped as Arrow, others as JSON."""
+    kevent = make_kinesis_event(kinesis_record_template, make_records(3))
+    batch_filter = Mock(side_effect=lambda table, context: pc.less(
+        table.column("index"), 2))
+    outputp = [{"batch_filter": batch_filter, "kinesis_stream": "k",
+                "columnar": True},
+               {"kinesis_stream": "j",
+                "firehose_delivery_stream": [{"stream_name": "f"}]}]
+    oevents = processor.process_event(kevent, context, {}, outputp)
+    assert columnar.is_table(batch_filter.call_args[0][0])
+    assert [evs.num_rows for evs in oevents] == [2, 3]
+
+    calls = boto3_client("kinesis").put_records.call_args_list
+    streams = {call[1]["StreamName"]: call[1]["Records"] for call in calls}
+    arrow, = streams["k"]
+    assert arrow["Data"].startswith(columnar.IPC_MAGIC)
+    assert len(streams["j"]) == 3
+    assert [json.loads(rec["Data"])["index"] for rec in streams["j"]] == \
+        [0, 1, 2]
@@ -0,0 +1,115 @@
+"""Test the compression of groups of records."""
+
+from base64 import b64decode, b64encode
+import json
+import os
+
+from lambdautils.exception import CriticalError
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.compression as compression  # noqa
+from humilis_kinesis_processor.lambda_function.handler.plan import build_plan
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+from . import make_kinesis_event
+from .. import make_records
+
+pytest.importorskip("zstandard")
+
+
+@pytest.fixture(autouse=True)
+def dictionaries(tmpdir, monkeypatch):
+    """An empty dictionary directory."""
+    monkeypatch.setattr(compression, "_dictionaries", {})
+    monkeypatch.setenv("COMPRESSION_DICT_PATH", str(tmpdir))
+    return str(tmpdir)
+
+
+def _payloads(nbrecs):
+    return [json.dumps(ev).encode("utf-8") for ev in make_records(nbrecs)]
+
+
+def test_compress():
+    """Groups of payloads are compressed in a single payload."""
+    payloads = _payloads(20)
+    data = compression.compress(payloads)
+    assert compression.is_compressed(data)
+    assert len(data) < sum(len(p) for p in payloads) / 3
+    assert compression.decompress(data) == payloads
+
+
+def test_dictionary(dictionaries):
+    """Trained dictionaries are versioned and named in the header."""
+    dict_id = compression.save_dictionary(
+        compression.train_dictionary(_payloads(1000), 4096), dictionaries,
+        samples=1000)
+    assert os.path.isfile(os.path.join(dictionaries,
+                                       "{}.zdict".format(dict_id)))
+    with open(os.path.join(dictionaries, "manifest.json")) as manifest:
+        assert json.load(manifest)[str(dict_id)]["samples"] == 1000
+
+    payloads = _payloads(3)
+    data = compression.compress(payloads, dict_id)
+    assert compression.HEADER.unpack_from(data)[2] == dict_id
+    assert len(data) < len(compression.compress(payloads))
+    # Decompressed with the dictionary loaded from the directory
+    compression._dictionaries.clear()
+    assert compression.decompress(data) == payloads
+
+    with pytest.raises(CriticalError):
+        compression.get_dictionary(dict_id + 1)
+
+
+def test_compress_records():
+    """Records are grouped by partition key within the size limit."""
+    payloads = _payloads(10)
+    records = [{"Data": data, "PartitionKey": str(i % 2)}
+               for i, data in enumerate(payloads)]
+    compressed = compression.compress_records(records, max_bytes=2000)
+    keys = [rec["PartitionKey"] for rec in compressed]
+    assert len(keys) > 2 and keys == sorted(keys)
+    for key in "01":
+        assert sum(len(compression.decompress(rec["Data"]))
+                   for rec in compressed if rec["PartitionKey"] == key) == 5
+
+    kinesis_records = [{"eventID": "shardId-0:1", "kinesis": {
+        "data": b64encode(rec["Data"]).decode("utf-8"),
+        "sequenceNumber": str(i)}} for i, rec in enumerate(compressed)]
+    expanded = compression.decompress_records(kinesis_records)
+    assert [b64decode(rec["kinesis"]["data"]) for rec in expanded] == \
+        payloads[::2] + payloads[1::2]
+    assert expanded[0]["kinesis"]["subSequenceNumber"] == 0
+    assert expanded[1]["kinesis"]["subSequenceNumber"] == 1
+
+
+@pytest.mark.parametrize("payload", [
+    b"HKZ and more plain text",
+    b"HKZ\x07\x00\x00\x00\x00 binary data",
+    b"HKZ"])
+def test_plain_records(payload):
+    """Records that only look like compressed records are left as is."""
+    assert not compression.is_compressed(payload)
+    records = [{"eventID": "shardId-0:1", "kinesis": {
+        "data": b64encode(payload).decode("utf-8"), "sequenceNumber": "1"}}]
+    assert compression.decompress_records(records) == records
+
+
+def test_process_event(kinesis_record_template, context, boto3_client):
+    """Compressed output records are decompressed by the next processor."""
+    sample_records = make_records(5)
+    kinesis_event = make_kinesis_event(kinesis_record_template, sample_records)
+    outputp = [{"kinesis_stream": "k", "compress": True}]
+    processor.process_event(kinesis_event, context, {}, outputp)
+    record, = boto3_client("kinesis").put_records.call_args[1]["Records"]
+    assert compression.is_compressed(record["Data"])
+
+    kinesis_event["Records"] = kinesis_event["Records"][:1]
+    kinesis_event["Records"][0]["kinesis"]["data"] = b64encode(record["Data"])
+    oevents = processor.process_event(kinesis_event, context, {}, [{}])
+    assert [ev["id"] for ev in oevents[0]] == \
+        [ev["id"] for ev in sample_records]
+
+
+def test_aggregate_and_compress():
+    """Records cannot be both aggregated and compressed."""
+    with pytest.raises(CriticalError):
+        build_plan({}, [{"aggregate": "yes", "compress": "yes"}], None)
@@ -0,0 +1,83 @@
+"""Test the processing of batches against the invocation deadline."""
+
+import json
+
+import humilis_kinesis_processor.lambda_function.handler.deadline as deadline
+import humilis_kinesis_processor.lambda_function.handler.streaming as streaming  # noqa
+from . import make_kinesis_event
+from .. import make_records
+
+
+class Clock(object):
+
+    """A Lambda context whose time only passes when told to."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.now = 0
+
+    def get_remaining_time_in_millis(self):
+        return self.timeout - self.now
+
+
+def test_scheduler():
+    """Chunks are sized with the cost of the records processed so far."""
+    clock = Clock(10000)
+    scheduler = deadline.Scheduler(clock, reserve_ms=1000)
+    assert scheduler.next_chunk(100) == deadline.PROBE_SIZE
+    scheduler.start()
+    clock.now += 1000
+    scheduler.done(10)
+    assert scheduler.cost == 100
+    # 8000 ms left, at 150 ms per record with the safety factor
+    assert scheduler.next_chunk(100) == 53
+    assert scheduler.next_chunk(20) == 20
+    clock.now = 9500
+    assert scheduler.next_chunk(100) == 0
+
+
+def test_checkpoint(kinesis_record_template, boto3_client, monkeypatch):
+    """Records that do not fit before the deadline are retried."""
+    monkeypatch.setenv("DEADLINE_AWARE", "yes")
+    monkeypatch.setenv("DEADLINE_RESERVE", "2000")
+    kevent = make_kinesis_event(kinesis_record_template, make_records(50))
+    for seqnum, rec in enumerate(kevent["Records"]):
+        rec["kinesis"]["sequenceNumber"] = str(100 + seqnum)
+    clock = Clock(10000)
+
+    def slow_mapper(ev, *args, **kwargs):
+        clock.now += 300
+        return ev
+
+    outputp = [{"kinesis_stream": "k", "mapper": slow_mapper}]
+    failed, seqnum = streaming.process_event(kevent, clock, {}, outputp,
+                                             partial=True)
+    assert not failed and clock.get_remaining_time_in_millis() > 0
+    sent = [json.loads(rec["Data"])["index"] for call
+            in boto3_client("kinesis").put_records.call_args_list
+            for rec in call[1]["Records"]]
+    # Everything processed is delivered, and the rest is retried
+    assert 10 < len(sent) < 50
+    assert sent == list(range(len(sent)))
+    assert seqnum == str(100 + len(sent))
+
+
+def test_no_time_left():
+    """A record is processed even if the reserve exceeds the timeout."""
+    clock = Clock(2000)
+    scheduler = deadline.Scheduler(clock, reserve_ms=3000)
+    assert scheduler.next_chunk(100) == 1
+    scheduler.start()
+    scheduler.done(1)
+    assert scheduler.next_chunk(100) == 0
+
+
+def test_unbuffered(kinesis_record_template, boto3_client, monkeypatch):
+    """Without streaming, chunks are delivered as they are processed."""
+    monkeypatch.setenv("DEADLINE_AWARE", "yes")
+    monkeypatch.setattr(streaming, "RecordBuffer", None)
+    kevent = make_kinesis_event(kinesis_record_template, make_records(20))
+    failed, seqnum = streaming.process_event(
+        kevent, Clock(100000), {}, [{"kinesis_stream": "k"}], partial=True)
+    assert not failed and seqnum is None
+    assert boto3_client("kinesis").put_records.call_count == 2
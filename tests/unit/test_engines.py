@@ -0,0 +1,109 @@
+"""Test the thread and async execution engines."""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+from .. import make_records
+
+
+class Tracker(object):
+
+    """Track how many events are processed at the same time."""
+
+    def __init__(self):
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def enter(self):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+
+    def exit(self):
+        with self.lock:
+            self.running -= 1
+
+
+@pytest.fixture
+def tracker(monkeypatch):
+    """Process up to four events at the same time."""
+    monkeypatch.setenv("MAPPER_CONCURRENCY", "4")
+    return Tracker()
+
+
+def test_async_mapper(tracker):
+    """Coroutine mappers run concurrently, with results in order."""
+    async def mapper(ev, context):
+        tracker.enter()
+        # Later events complete first
+        await asyncio.sleep(0.001 * (20 - ev["index"]))
+        tracker.exit()
+        if ev["index"] == 3:
+            raise ValueError("bad event")
+        return [ev, dict(ev, copy=True)]
+
+    async def pfilter(ev, context):
+        return ev["index"] != 11
+
+    pipeline = {"filter": pfilter, "mapper": mapper}
+    processed, failed = processor.run_pipeline(pipeline, make_records(20), {})
+    assert [ev["index"] for ev in processed] == \
+        [i for i in range(20) if i not in (3, 11) for _ in range(2)]
+    assert [err.index for err in failed] == [3]
+    assert isinstance(failed[0].error, ValueError)
+    assert tracker.peak == 4
+
+
+def test_thread_engine(tracker, monkeypatch):
+    """Blocking mappers run in a pool of threads, with results in order."""
+    monkeypatch.setenv("EXECUTION_ENGINE", "thread")
+
+    def mapper(ev, context):
+        tracker.enter()
+        time.sleep(0.001 * (20 - ev["index"]))
+        tracker.exit()
+        if ev["index"] == 5:
+            raise ValueError("bad event")
+        return ev
+
+    processed, failed = processor.run_pipeline(
+        {"mapper": mapper}, make_records(20), {})
+    assert [ev["index"] for ev in processed] == \
+        [i for i in range(20) if i != 5]
+    assert [err.index for err in failed] == [5]
+    assert 1 < tracker.peak <= 4
+
+
+def test_groups_in_order(tracker, monkeypatch):
+    """The events of a group are processed one after the other."""
+    monkeypatch.setenv("GROUP_CONCURRENCY", "2")
+    calls = []
+
+    async def mapper(ev, context):
+        await asyncio.sleep(0.001 * (10 - ev["index"]))
+        calls.append(ev["index"])
+        return ev
+
+    pipeline = {"mapper": mapper, "group_by": lambda ev, ctx: ev["index"] % 2}
+    processed, _ = processor.run_pipeline(pipeline, make_records(10), {})
+    assert [ev["index"] for ev in processed] == list(range(10))
+    for parity in (0, 1):
+        indices = [index for index in calls if index % 2 == parity]
+        assert indices == sorted(indices)
+
+
+def test_coroutine_in_thread_engine(monkeypatch):
+    """Coroutine mappers also work with the other engines."""
+    monkeypatch.setenv("EXECUTION_ENGINE", "thread")
+
+    async def mapper(ev, context):
+        return dict(ev, mapped=True)
+
+    processed, _ = processor.run_pipeline(
+        {"mapper": mapper}, make_records(3), {})
+    assert all(ev["mapped"] for ev in processed)
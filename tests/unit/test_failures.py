@@ -0,0 +1,129 @@
+"""Test the reporting of the failed records of a batch."""
+
+import json
+
+from lambdautils.exception import ProcessingError
+import lambdautils.monitor as monitor
+from mock import Mock
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler as handler
+import humilis_kinesis_processor.lambda_function.handler.failures as failures
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+import humilis_kinesis_processor.lambda_function.handler.streaming as streaming  # noqa
+from . import make_kinesis_event
+from .. import make_records
+
+
+def _fail_on(*indices):
+    """A mapper that fails for the events with the given indices."""
+    def mapper(ev, *args, **kwargs):
+        if ev["index"] in indices:
+            raise ValueError("bad event")
+        return ev
+    return mapper
+
+
+@pytest.fixture
+def kinesis_event(kinesis_record_template):
+    """A Kinesis event whose records have increasing sequence numbers."""
+    kevent = make_kinesis_event(kinesis_record_template, make_records(5))
+    for seqnum, rec in enumerate(kevent["Records"]):
+        rec["kinesis"]["sequenceNumber"] = str(100 + seqnum)
+    return kevent
+
+
+def _sent(boto3_client, name):
+    """The indices of the events sent with a mocked client."""
+    method = {"kinesis": "put_records", "firehose": "put_record_batch"}[name]
+    calls = getattr(boto3_client(name), method).call_args_list
+    return [json.loads(rec["Data"])["index"] for call in calls
+            for rec in call[1]["Records"]]
+
+
+def test_checkpoint():
+    """The events of a deaggregated record are retried together."""
+    errors = [processor.EventError(index, {}, None, None) for index in (4, 2)]
+    assert failures.checkpoint(errors, ["1", "2", "2", "2", "3"]) == (1, "2")
+    assert failures.checkpoint([], ["1"]) == (None, None)
+    assert failures.response() == {"batchItemFailures": []}
+    assert failures.response("2") == {
+        "batchItemFailures": [{"itemIdentifier": "2"}]}
+
+
+def test_process_batch(kinesis_event, context, boto3_client):
+    """Only the events of the records before the first failure are sent."""
+    inputp = {"mapper": _fail_on(3),
+              "firehose_delivery_stream": [{"stream_name": "archive"}]}
+    outputp = [{"kinesis_stream": "k", "mapper": _fail_on(2)},
+               {"kinesis_stream": "k", "filter": lambda ev, ctx: True}]
+    oevents, _, response = processor.process_batch(
+        kinesis_event, context, inputp, outputp)
+    assert response == {"batchItemFailures": [{"itemIdentifier": "102"}]}
+    assert [[ev["index"] for ev in evs] for evs in oevents] == \
+        [[0, 1], [0, 1]]
+    assert _sent(boto3_client, "kinesis") == [0, 1, 0, 1]
+    assert _sent(boto3_client, "firehose") == [0, 1]
+
+    with pytest.raises(ProcessingError):
+        processor.process_event(kinesis_event, context, {}, outputp)
+
+
+def test_process_batch_filtered(kinesis_event, context, boto3_client):
+    """Events dropped by the input pipeline do not shift the checkpoint."""
+    inputp = {"filter": lambda ev, ctx: ev["index"] != 0}
+    outputp = [{"kinesis_stream": "k", "mapper": _fail_on(3)}]
+    _, _, response = processor.process_batch(
+        kinesis_event, context, inputp, outputp)
+    assert response == {"batchItemFailures": [{"itemIdentifier": "103"}]}
+    assert _sent(boto3_client, "kinesis") == [1, 2]
+
+    outputp = [{"kinesis_stream": "k"}]
+    oevents, _, response = processor.process_batch(
+        kinesis_event, context, inputp, outputp)
+    assert response == {"batchItemFailures": []}
+    assert [ev["index"] for ev in oevents[0]] == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("bad,sent", [(2, [0, 1]), (0, [])])
+def test_undecodable_record(bad, sent, kinesis_event, context, boto3_client):
+    """A record that cannot be decoded is reported as failed."""
+    kinesis_event["Records"][bad]["kinesis"]["data"] = "bm90IGpzb24="
+    oevents, failed, response = processor.process_batch(
+        kinesis_event, context, {}, [{"kinesis_stream": "k"}])
+    assert response == {
+        "batchItemFailures": [{"itemIdentifier": str(100 + bad)}]}
+    assert [ev["index"] for ev in oevents[0]] == sent
+    assert _sent(boto3_client, "kinesis") == sent
+    assert [err.index for err in failed] == [bad]
+    assert failed[0].event["kinesis"]["sequenceNumber"] == str(100 + bad)
+
+    with pytest.raises(ValueError):
+        processor.process_event(kinesis_event, context, {},
+                                [{"kinesis_stream": "k"}])
+
+
+def test_undecodable_record_streaming(kinesis_event, context, boto3_client,
+                                      monkeypatch):
+    """Chunks after the one holding a bad record are left for the retry."""
+    monkeypatch.setenv("STREAM_CHUNK_SIZE", "2")
+    kinesis_event["Records"][3]["kinesis"]["data"] = "bm90IGpzb24="
+    failed, seqnum = streaming.process_event(
+        kinesis_event, context, {}, [{"kinesis_stream": "k"}], partial=True)
+    assert seqnum == "103"
+    assert [err.index for err in failed] == [3]
+    assert _sent(boto3_client, "kinesis") == [0, 1, 2]
+
+
+def test_report_errors(kinesis_event, context, monkeypatch):
+    """Failed events are reported to Sentry without failing."""
+    client = Mock()
+    monkeypatch.setattr(monitor, "_setup_sentry_client",
+                        lambda context: client)
+    outputp = [{"kinesis_stream": "k", "mapper": _fail_on(1)}]
+    _, failed, _ = processor.process_batch(
+        kinesis_event, context, {}, outputp)
+    handler.report_errors(failed, context)
+    assert client.captureException.call_count == 1
+    handler.report_errors([], context)
+    assert client.captureException.call_count == 1
@@ -0,0 +1,69 @@
+"""Test the Firehose writer."""
+
+import json
+
+from mock import Mock
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.firehose as firehose
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    """Do not wait between retries."""
+    monkeypatch.setattr(firehose.time, "sleep", Mock())
+
+
+def test_make_records():
+    """Every event becomes one newline-delimited record."""
+    records = firehose.make_records([{"a": 1}, "x,y\n"])
+    assert records == [{"Data": b'{"a": 1}\n'}, {"Data": b"x,y\n"}]
+
+
+def test_pack_records():
+    """Packed records hold as many events as fit in a record."""
+    events = [{"index": "{:03d}".format(i)} for i in range(100)]
+    size = len(firehose.encode_event(events[0]))
+    records = firehose.make_records(events, pack=True, max_bytes=size * 30)
+    assert [len(rec["Data"]) // size for rec in records] == [30, 30, 30, 10]
+    unpacked = [json.loads(line) for rec in records
+                for line in rec["Data"].decode().splitlines()]
+    assert unpacked == events
+
+
+def test_chunk_records():
+    """Records are split by count and bytes."""
+    records = [{"Data": b"x" * 100}] * 1001
+    chunks = list(firehose.chunk_records(records))
+    assert [len(chunk) for chunk in chunks] == [500, 500, 1]
+    chunks = list(firehose.chunk_records(records[:10], max_bytes=250))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 2, 2, 2]
+
+
+def test_put_record_batch_resubmits_failed(kinesis_client):
+    """Only the records that failed are re-submitted."""
+    records = [{"Data": str(i).encode()} for i in range(3)]
+    kinesis_client.put_record_batch = Mock(side_effect=[
+        {"ResponseMetadata": {"HTTPStatusCode": 200},
+         "FailedPutCount": 1,
+         "RequestResponses": [{"RecordId": "0"},
+                              {"ErrorCode": "ServiceUnavailableException"},
+                              {"RecordId": "2"}]},
+        {"ResponseMetadata": {"HTTPStatusCode": 200},
+         "FailedPutCount": 0,
+         "RequestResponses": [{"RecordId": "1"}]}])
+    firehose.put_record_batch(records, "s", client=kinesis_client)
+    second = kinesis_client.put_record_batch.call_args_list[1][1]["Records"]
+    assert second == [{"Data": b"1"}]
+
+
+def test_put_record_batch_gives_up(kinesis_client):
+    """Records that keep failing make the delivery fail."""
+    kinesis_client.put_record_batch = Mock(return_value={
+        "ResponseMetadata": {"HTTPStatusCode": 200},
+        "FailedPutCount": 1,
+        "RequestResponses": [{"ErrorCode": "ServiceUnavailableException"}]})
+    with pytest.raises(firehose.FirehoseError):
+        firehose.put_record_batch([{"Data": b"x"}], "s",
+                                  client=kinesis_client, max_attempts=2)
+    assert kinesis_client.put_record_batch.call_count == 2
@@ -0,0 +1,78 @@
+"""Test the concurrent processing of groups of events."""
+
+import threading
+import time
+
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+from . import make_kinesis_event
+from .. import make_records
+
+
+@pytest.fixture
+def kinesis_event(kinesis_record_template, monkeypatch):
+    """A Kinesis event whose records have three partition keys."""
+    monkeypatch.setenv("GROUP_CONCURRENCY", "3")
+    kevent = make_kinesis_event(kinesis_record_template, make_records(12))
+    for index, rec in enumerate(kevent["Records"]):
+        rec["kinesis"]["partitionKey"] = "key-{}".format(index % 3)
+    return kevent
+
+
+def _recorder(calls):
+    """A mapper that records the thread every event is processed in."""
+    def mapper(ev, *args, **kwargs):
+        time.sleep(0.005)
+        calls.append((ev["index"], threading.current_thread().name))
+        if ev["index"] == 7:
+            raise ValueError("bad event")
+        return [ev, dict(ev, copy=True)]
+    return mapper
+
+
+def test_partition_key_groups(kinesis_event, context):
+    """Groups run concurrently, in order within a key and in the output."""
+    calls = []
+    outputp = [{"mapper": _recorder(calls)}]
+    with pytest.raises(processor.ProcessingError) as excinfo:
+        processor.process_event(kinesis_event, context, {}, outputp)
+    assert [err.index for err in excinfo.value.events] == [7]
+
+    order, threads = {}, {}
+    for index, thread in calls:
+        order.setdefault(index % 3, []).append(index)
+        threads.setdefault(index % 3, set()).add(thread)
+    assert all(indices == sorted(indices) for indices in order.values())
+    # Every key is processed by a single thread, and not all by the same
+    assert all(len(names) == 1 for names in threads.values())
+    assert len(set.union(*threads.values())) > 1
+
+    outputp = [{"mapper": lambda ev, ctx: ev if ev["index"] != 7 else None}]
+    oevents = processor.process_event(kinesis_event, context, {}, outputp)
+    assert [ev["index"] for ev in oevents[0]] == \
+        [i for i in range(12) if i != 7]
+
+
+def test_group_by(context, monkeypatch):
+    """Events can be grouped by a callable, whose errors are reported."""
+    monkeypatch.setenv("GROUP_CONCURRENCY", "2")
+
+    def group_by(ev, ctx):
+        if ev["index"] == 3:
+            raise ValueError("no group")
+        return ev["index"] // 2
+
+    pipeline = {"group_by": group_by, "filter": lambda ev, ctx: True}
+    processed, failed = processor.run_pipeline(pipeline, make_records(6), {})
+    assert [ev["index"] for ev in processed] == [0, 1, 2, 4, 5]
+    assert [err.index for err in failed] == [3]
+
+
+def test_balance():
+    """Groups are never split and buckets have similar sizes."""
+    groups = [[0, 3, 6, 9], [1], [2, 4], [5, 7], [8]]
+    buckets = processor._balance(groups, 3)
+    assert sorted(sum(buckets, [])) == list(range(10))
+    assert sorted(len(bucket) for bucket in buckets) == [3, 3, 4]
+    assert processor._balance([[0]], 4) == [[0]]
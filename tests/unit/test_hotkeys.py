@@ -0,0 +1,87 @@
+"""Test the detection and spreading of hot partition keys."""
+
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.hotkeys as hotkeys
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+
+
+def _events():
+    """Events of which half have the same client."""
+    return [{"client_id": "hot" if i % 2 else "cold-{}".format(i), "i": i}
+            for i in range(40)]
+
+
+def _sent(kinesis_client):
+    return kinesis_client.put_records.call_args[1]["Records"]
+
+
+def test_space_saving():
+    """Frequent items are counted, within bounded memory."""
+    sketch = hotkeys.SpaceSaving(5)
+    for i in range(1000):
+        sketch.add("hot" if i % 3 == 0 else "item-{}".format(i))
+    assert len(sketch.counts) == 5
+    item, count, error = sketch.top(1)[0]
+    assert item == "hot"
+    assert count - error <= 334 <= count
+
+
+def test_space_saving_evicts_lowest():
+    """A new item replaces an item with the lowest count."""
+    sketch = hotkeys.SpaceSaving(10)
+    for i in range(2000):
+        item = "item-{}".format((i * 7919) % 37) if i % 4 else "hot"
+        new = item not in sketch.counts
+        lowest = min(count for count, _ in sketch.counts.values()) \
+            if new and len(sketch.counts) == 10 else 0
+        sketch.add(item, weight=1 + i % 3)
+        if new:
+            assert sketch.counts[item][1] == lowest
+        assert len(sketch._heap) == len(sketch.counts) <= 10
+        assert sum(c for c, _ in sketch.counts.values()) == sketch.total
+
+
+def test_balance_salt():
+    """Salted records of a hot key cycle through the spread."""
+    records = [{"PartitionKey": key, "Data": ""} for key in "aabab"]
+    balanced = hotkeys.balance(records, {"a"}, hotkeys.SALT, 2)
+    assert [rec["PartitionKey"] for rec in balanced] == \
+        ["a#0", "a#1", "b", "a#0", "b"]
+
+
+def test_balance_explicit_hash_key():
+    """Hot keys are routed with hash keys evenly spaced over the range."""
+    records = [{"PartitionKey": "a", "Data": ""} for _ in range(4)]
+    balanced = hotkeys.balance(records, {"a"}, hotkeys.EXPLICIT_HASH_KEY, 4)
+    assert all(rec["PartitionKey"] == "a" for rec in balanced)
+    hash_keys = sorted(int(rec["ExplicitHashKey"]) for rec in balanced)
+    gaps = {b - a for a, b in zip(hash_keys, hash_keys[1:])}
+    assert gaps <= {hotkeys.HASH_KEY_RANGE // 4}
+    assert all(0 <= key < hotkeys.HASH_KEY_RANGE for key in hash_keys)
+
+
+@pytest.mark.parametrize("ordered,policy,hot_keys", [
+    [False, "report", {"hot"}],
+    [False, "salt", {"hot#0", "hot#1", "hot#2"}],
+    [True, "salt", {"hot"}]])
+def test_send_to_kinesis_stream(ordered, policy, hot_keys, kinesis_client,
+                                monkeypatch):
+    """Hot keys are spread unless the output is ordered."""
+    monkeypatch.setenv("HOT_KEYS", "3")
+    monkeypatch.setenv("HOT_KEY_POLICY", policy)
+    monkeypatch.setenv("HOT_KEY_SPREAD", "3")
+    processor.send_to_kinesis_stream(
+        _events(), "stream", lambda ev: ev["client_id"], ordered=ordered)
+    keys = {rec["PartitionKey"] for rec in _sent(kinesis_client)}
+    assert {key for key in keys if key.startswith("hot")} == hot_keys
+    assert len(keys - hot_keys) == 20
+
+
+def test_unknown_policy(kinesis_client, monkeypatch):
+    """Unknown hot key policies are critical errors."""
+    monkeypatch.setenv("HOT_KEYS", "3")
+    monkeypatch.setenv("HOT_KEY_POLICY", "shuffle")
+    with pytest.raises(processor.CriticalError):
+        processor.send_to_kinesis_stream(
+            _events(), "stream", lambda ev: ev["client_id"])
@@ -0,0 +1,77 @@
+"""Test the Kinesis writer."""
+
+from mock import Mock
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.kinesis as kinesis
+
+
+def _records(nbrecs, size=10):
+    """A list of PutRecords entries of a given size."""
+    return [{"Data": "x" * (size - 1), "PartitionKey": "k"}
+            for _ in range(nbrecs)]
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    """Do not wait between retries."""
+    monkeypatch.setattr(kinesis.time, "sleep", Mock())
+
+
+def test_make_records():
+    """Events are serialized and get a partition key."""
+    records = kinesis.make_records(
+        [{"a": 1}, "raw"], partition_key=lambda ev: "pk")
+    assert records == [{"Data": '{"a": 1}', "PartitionKey": "pk"},
+                       {"Data": "raw", "PartitionKey": "pk"}]
+    records = kinesis.make_records([{"a": 1}])
+    assert len(records[0]["PartitionKey"]) == 36
+
+
+@pytest.mark.parametrize("nbrecs,size,max_bytes,sizes", [
+    [1001, 10, kinesis.MAX_BYTES_PER_CALL, [500, 500, 1]],
+    [10, 100, 350, [3, 3, 3, 1]],
+    [0, 10, 100, []]])
+def test_chunk_records(nbrecs, size, max_bytes, sizes):
+    """Records are split by count and by bytes."""
+    chunks = list(kinesis.chunk_records(_records(nbrecs, size),
+                                        max_bytes=max_bytes))
+    assert [len(chunk) for chunk in chunks] == sizes
+
+
+def test_chunk_records_too_large():
+    """A record over the per-record limit cannot be sent."""
+    with pytest.raises(kinesis.KinesisError):
+        list(kinesis.chunk_records(
+            _records(1, kinesis.MAX_BYTES_PER_RECORD + 1)))
+
+
+def test_put_records_resubmits_failed(kinesis_client):
+    """Only the records that failed are re-submitted."""
+    records = [{"Data": str(i), "PartitionKey": "k"} for i in range(3)]
+    kinesis_client.put_records = Mock(side_effect=[
+        {"ResponseMetadata": {"HTTPStatusCode": 200},
+         "FailedRecordCount": 2,
+         "Records": [{"ErrorCode": "ProvisionedThroughputExceededException"},
+                     {"SequenceNumber": "1"},
+                     {"ErrorCode": "InternalFailure"}]},
+        {"ResponseMetadata": {"HTTPStatusCode": 200},
+         "FailedRecordCount": 0,
+         "Records": [{"SequenceNumber": "2"}, {"SequenceNumber": "3"}]}])
+    metrics = kinesis.put_records(records, "s", client=kinesis_client)
+    second = kinesis_client.put_records.call_args_list[1][1]["Records"]
+    assert [rec["Data"] for rec in second] == ["0", "2"]
+    assert [(m.records, m.failed, m.attempt) for m in metrics] == \
+        [(3, 2, 0), (2, 0, 1)]
+
+
+def test_put_records_gives_up(kinesis_client):
+    """Records that keep failing make the delivery fail."""
+    kinesis_client.put_records = Mock(return_value={
+        "ResponseMetadata": {"HTTPStatusCode": 200},
+        "FailedRecordCount": 1,
+        "Records": [{"ErrorCode": "ProvisionedThroughputExceededException"}]})
+    with pytest.raises(kinesis.KinesisError):
+        kinesis.put_records(_records(1), "s", client=kinesis_client,
+                            max_attempts=3)
+    assert kinesis_client.put_records.call_count == 3
@@ -0,0 +1,81 @@
+"""Test the KPL aggregated record format."""
+
+from base64 import b64encode
+import copy
+import json
+
+import humilis_kinesis_processor.lambda_function.handler.kpl as kpl
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+from .. import make_records
+
+
+def _lambda_record(template, data, seqno="1"):
+    """A Lambda Kinesis record holding some (raw) data."""
+    rec = copy.deepcopy(template)
+    rec["kinesis"]["data"] = b64encode(data).decode("utf-8")
+    rec["kinesis"]["sequenceNumber"] = seqno
+    return rec
+
+
+def test_aggregate_round_trip(kinesis_record_template):
+    """Aggregated records are de-aggregated to the original records."""
+    records = [{"Data": json.dumps({"index": i}), "PartitionKey": str(i % 2)}
+               for i in range(5)]
+    aggregated = kpl.aggregate_records(records)
+    assert [rec["PartitionKey"] for rec in aggregated] == ["0", "1"]
+    assert all(kpl.is_aggregated(rec["Data"]) for rec in aggregated)
+
+    lrecs = [_lambda_record(kinesis_record_template, rec["Data"], str(i))
+             for i, rec in enumerate(aggregated)]
+    subrecs = kpl.deaggregate_records(lrecs)
+    assert [(r["kinesis"]["sequenceNumber"], r["kinesis"]["subSequenceNumber"],
+             r["kinesis"]["partitionKey"]) for r in subrecs] == \
+        [("0", 0, "0"), ("0", 1, "0"), ("0", 2, "0"),
+         ("1", 0, "1"), ("1", 1, "1")]
+
+
+def test_aggregate_size_limit():
+    """Aggregated records do not exceed the given size."""
+    records = [{"Data": "x" * 100, "PartitionKey": "k"} for _ in range(50)]
+    aggregated = kpl.aggregate_records(records, group_by_key=False)
+    assert len(aggregated) == 1
+    agg = kpl.Aggregator("k", max_bytes=1000)
+    nbrecs = 0
+    while agg.add(b"x" * 100):
+        nbrecs += 1
+    assert nbrecs == 9
+    assert len(agg.serialize()["Data"]) + 1 <= 1000
+
+
+def test_deaggregate_explicit_hash_keys():
+    """Explicit hash keys of sub-records are preserved."""
+    ld = kpl._length_delimited
+    record = (kpl._varint(1 << 3) + kpl._varint(0) +
+              kpl._varint(2 << 3) + kpl._varint(0) + ld(3, b"data"))
+    message = ld(1, b"pk") + ld(2, b"12345") + ld(3, record)
+    payload = kpl.MAGIC + message + kpl.hashlib.md5(message).digest()
+    assert list(kpl.deaggregate(payload)) == [("pk", "12345", b"data")]
+
+
+def test_plain_records_are_untouched(kinesis_record_template):
+    """Records that are not aggregated are passed through."""
+    lrec = _lambda_record(kinesis_record_template, kpl.MAGIC + b"bad digest")
+    assert kpl.deaggregate_records([lrec]) == [lrec]
+
+
+def test_process_aggregated_event(kinesis_record_template, context,
+                                  boto3_client):
+    """Aggregated input events are processed and output is aggregated."""
+    sample_records = make_records(3)
+    aggregated = kpl.aggregate_records(
+        [{"Data": json.dumps(rec), "PartitionKey": "k"}
+         for rec in sample_records])
+    kevent = {"Records": [
+        _lambda_record(kinesis_record_template, aggregated[0]["Data"])]}
+    outputp = [{"kinesis_stream": "s", "aggregate": "True"}]
+    oevents = processor.process_event(kevent, context, {}, outputp)
+    assert [ev["id"] for ev in oevents[0]] == \
+        [rec["id"] for rec in sample_records]
+    put_records = boto3_client("kinesis").put_records
+    assert put_records.call_count == 1
+    assert len(put_records.call_args[1]["Records"]) == 1
@@ -181,3 +181,138 @@ def test_bad_mapper_signature(kinesis_record_template, context):
     outputp = [{"mapper": Mock(side_effect=bad_mapper)}]
     with pytest.raises(CriticalError):
         processor.process_event(kinesis_event, context, [], outputp)
+
+
+@pytest.mark.parametrize("mode", ["cow", "deepcopy"])
+def test_isolation_between_outputs(mode, kinesis_record_template, context,
+                                   monkeypatch):
+    """Mutations in one output are not visible in other outputs."""
+    monkeypatch.setenv("ISOLATION_MODE", mode)
+
+    def nested_mapper(ev, *args, **kwargs):
+        """Modify an event in place, including nested containers."""
+        ev["nested"]["mapped"] = True
+        ev["mapped"] = True
+        return ev
+
+    def nested_filter(ev, *args, **kwargs):
+        """A filter that modifies the event it receives."""
+        ev["nested"]["filtered"] = True
+        return True
+
+    sample_records = make_records(2)
+    for rec in sample_records:
+        rec["nested"] = {}
+    kinesis_event = make_kinesis_event(kinesis_record_template, sample_records)
+    outputp = [_make_output(nested_filter, nested_mapper),
+               _make_output(_all, None)]
+    oevents = processor.process_event(kinesis_event, context, {}, outputp)
+    assert all(ev["nested"] == {"mapped": True} for ev in oevents[0])
+    assert all(ev["nested"] == {} for ev in oevents[1])
+    assert all("mapped" not in ev for ev in oevents[1])
+
+
+def test_concurrent_outputs(kinesis_record_template, context, monkeypatch):
+    """Concurrent outputs keep the output order and the first error."""
+    monkeypatch.setenv("OUTPUT_CONCURRENCY", "3")
+
+    def _tagger(tag):
+        """Produce a mapper that tags events with the output index."""
+        def func(ev, *args, **kwargs):
+            ev["output"] = tag
+            return ev
+        return func
+
+    sample_records = make_records(3)
+    kinesis_event = make_kinesis_event(kinesis_record_template, sample_records)
+    outputp = [_make_output(_all, _tagger(i)) for i in range(4)]
+    oevents = processor.process_event(kinesis_event, context, {}, outputp)
+    assert [[ev["output"] for ev in evs] for evs in oevents] == \
+        [[i] * 3 for i in range(4)]
+
+    def _raiser(tag, index):
+        """Produce a mapper that fails with a tagged error."""
+        def func(ev, *args, **kwargs):
+            if ev["index"] == index:
+                raise ValueError(tag)
+            return ev
+        return func
+
+    outputp = [_make_output(_all, _raiser(0, 1)),
+               _make_output(_all, _raiser(1, 1)),
+               _make_output(_all, _raiser(2, 2))]
+    oevents, failed = processor.produce_outputs(
+        outputp, sample_records, {})
+    assert [len(evs) for evs in oevents] == [2, 2, 2]
+    # Only the error of the first output that failed is kept
+    assert [(err.index, err.error.args[0]) for err in failed] == \
+        [(1, 0), (2, 2)]
+
+
+def test_concurrent_delivery(kinesis_record_template, context, boto3_client,
+                             monkeypatch):
+    """All sinks are written to and any failed sink fails the invocation."""
+    monkeypatch.setenv("DELIVERY_CONCURRENCY", "4")
+    sample_records = make_records(2)
+    kinesis_event = make_kinesis_event(kinesis_record_template, sample_records)
+    inputp = {"firehose_delivery_stream": [{"stream_name": "a"}]}
+    outputp = [_make_output(_all, _identity, "k", "f"),
+               _make_output(_all, _identity, "k", "f")]
+    processor.process_event(kinesis_event, context, inputp, outputp)
+    assert boto3_client("kinesis").put_records.call_count == 2
+    assert boto3_client("firehose").put_record_batch.call_count == 3
+
+    boto3_client("firehose").put_record_batch.return_value = {
+        "ResponseMetadata": {"HTTPStatusCode": 500}}
+    with pytest.raises(processor.FirehoseError):
+        processor.process_event(kinesis_event, context, inputp, outputp)
+
+
+def test_batch_filter(kinesis_record_template, context):
+    """Batch filters select events with a mask and can flag errors."""
+
+    def batch_filter(events, *args, **kwargs):
+        """Keep even events and fail the last one."""
+        mask = [ev["index"] % 2 == 0 for ev in events]
+        mask[-1] = ValueError("bad event")
+        return mask
+
+    events = make_records(5)
+    processed, failed = processor.run_pipeline(
+        {"batch_filter": batch_filter}, events, {})
+    assert [ev["index"] for ev in processed] == [0, 2]
+    assert [err.index for err in failed] == [4]
+    assert "_humilis" in failed[0].event
+    assert "_humilis" not in events[4]
+
+    with pytest.raises(CriticalError):
+        processor.run_pipeline(
+            {"batch_filter": lambda evs, ctx: [True]}, events, {})
+
+
+def test_batch_flatmapper(kinesis_record_template, context):
+    """Batch flatmappers fan out and attribute errors to their inputs."""
+
+    def flatmapper(events, *args, **kwargs):
+        """Duplicate the events, fail the second one."""
+        for pos, ev in enumerate(events):
+            if ev["index"] == 1:
+                yield pos, ValueError("bad event")
+            else:
+                yield pos, ev
+                yield pos, dict(ev, copy=True)
+
+    events = make_records(4)
+    pipeline = {"filter": _filter_by_index(1), "batch_flatmapper": flatmapper}
+    processed, failed = processor.run_pipeline(pipeline, events, {})
+    assert processed == [] and [err.index for err in failed] == [1]
+
+    pipeline = {"mapper": _raise_by_index(2), "batch_flatmapper": flatmapper}
+    processed, failed = processor.run_pipeline(pipeline, events, {})
+    assert [ev["index"] for ev in processed] == [0, 0, 3, 3]
+    assert [err.index for err in failed] == [1, 2]
+
+    # Input pipelines can fan out too
+    processed, failed = processor.run_pipeline(
+        {"batch_flatmapper": flatmapper}, events, {}, "input")
+    assert len(processed) == 6 and [err.index for err in failed] == [1]
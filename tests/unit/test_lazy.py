@@ -0,0 +1,110 @@
+"""Test events decoded on demand."""
+
+from decimal import Decimal
+import functools
+import json
+import threading
+import time
+
+from mock import Mock
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.lazy as lazy
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+from . import make_kinesis_event
+from .. import make_records
+
+
+@pytest.mark.parametrize("text,key,expected", [
+    ['{"a": 1, "b": "x"}', "b", (True, "x")],
+    ['{"a": 1, "b": "x"}', "c", (False, None)],
+    ['{"a": 1, "a": 2}', "a", (True, 2)],
+    ['{"a": "b:", "b": null}', "b", (True, None)],
+    ['{"a": {"b": 1}}', "b", None],
+    ['{"a": [1]}', "a", None],
+    ['{"\\u0061": 1}', "a", None]])
+def test_lookup(text, key, expected):
+    """Top-level fields are decoded on their own only when it is safe."""
+    assert lazy.Document(text).lookup(key) == expected
+
+
+def test_custom_deserializer():
+    """Fields decode as the configured deserializer decodes them."""
+    loads = functools.partial(json.loads, parse_float=Decimal)
+    document = lazy.Document('{"a": 1.5, "b": "x"}', loads)
+    assert document.lookup("a") is None
+    view = lazy.LazyEvent(document)
+    assert view["a"] == Decimal("1.5") and isinstance(view["a"], Decimal)
+    assert view == loads('{"a": 1.5, "b": "x"}')
+
+
+def test_lazy_event():
+    """Lazy events are decoded in full only when needed."""
+    view = lazy.LazyEvent(lazy.Document('{"a": 1}', extra={"ts": "now"}))
+    assert view["a"] == 1 and view["ts"] == "now" and "c" not in view
+    assert not view._loaded
+    assert view.get("a") == 1 and not view._loaded
+    assert len(view) == 2 and view._loaded
+
+    document = lazy.Document('{"a": 1, "b": {"c": 2}}', extra={"ts": "now"})
+    event = lazy.LazyEvent(document)
+    view = event.view()
+    view["a"] = 2
+    view["b"]["c"] = 3
+    assert view._loaded and not event._loaded
+    assert event == {"a": 1, "b": {"c": 2}, "ts": "now"}
+    assert json.dumps(lazy.load(lazy.LazyEvent(document)), sort_keys=True) \
+        == '{"a": 1, "b": {"c": 2}, "ts": "now"}'
+    # Views handed to other callables are always decoded
+    assert json.loads(json.dumps(lazy.LazyEvent(document).copy()))["a"] == 1
+
+
+def test_serialized():
+    """Lazy events serialize like the dicts they stand for."""
+    document = lazy.Document('{"a": 1, "b": [2]}', extra={"ts": "now"})
+    assert json.loads(json.dumps(lazy.LazyEvent(document))) == \
+        {"a": 1, "b": [2], "ts": "now"}
+    assert json.dumps(lazy.LazyEvent(lazy.Document("{}"))) == "{}"
+
+
+def test_concurrent_load(monkeypatch):
+    """Threads reading an event being decoded see the decoded event."""
+    parsed = lazy.Document.parsed
+
+    def slow_parsed(self):
+        time.sleep(0.01)
+        return parsed(self)
+
+    monkeypatch.setattr(lazy.Document, "parsed", slow_parsed)
+    event = lazy.LazyEvent(lazy.Document('{"a": {"b": 1}}'))
+    results = []
+
+    def read():
+        results.append(event["a"]["b"])
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1] * 8
+
+
+def test_process_event(kinesis_record_template, context, boto3_client,
+                       monkeypatch):
+    """Events that are filtered out are never decoded in full."""
+    monkeypatch.setenv("LAZY_DECODING", "yes")
+    parsed = Mock(side_effect=lazy.Document.parsed)
+    monkeypatch.setattr(lazy.Document, "parsed",
+                        lambda self: parsed(self))
+    sample_records = make_records(5)
+    kinesis_event = make_kinesis_event(kinesis_record_template, sample_records)
+    outputp = [{"filter": lambda ev, context: ev["index"] == 3,
+                "kinesis_stream": "k"}]
+    oevents = processor.process_event(kinesis_event, context, {}, outputp)
+    assert oevents == [[dict(sample_records[3],
+                             **{"{{received_at_field}}": ""})]]
+    # The first event is logged and the selected one is sent
+    assert parsed.call_count == 2
+    record, = boto3_client("kinesis").put_records.call_args[1]["Records"]
+    assert json.loads(record["Data"]) == oevents[0][0]
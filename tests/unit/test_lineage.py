@@ -0,0 +1,95 @@
+"""Test the tracking of the input event every event comes from."""
+
+from lambdautils.exception import ProcessingError
+import pytest
+
+from humilis_kinesis_processor.lambda_function.handler.lineage import Lineage
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+from . import make_kinesis_event
+from .. import make_records
+
+
+def test_derive():
+    """Lineage is carried through any number of stages."""
+    lineage = Lineage(["10", "11", "12"])
+    # The second event fans out, the first one is filtered out
+    lineage = lineage.derive([1, 1, 2])
+    assert lineage.indices == [1, 1, 2]
+    lineage = lineage.derive([2, 1])
+    assert [lineage.source(i) for i in range(len(lineage))] == \
+        [(2, "12"), (1, "11")]
+
+
+def _fanout(ev, *args, **kwargs):
+    """An input mapper that produces one event per index."""
+    return [dict(ev, copy=i) for i in range(ev["index"])]
+
+
+def _fail_on_copy(copy):
+    """An output mapper that fails for a given copy of the events."""
+    def mapper(ev, *args, **kwargs):
+        if ev["copy"] == copy:
+            raise ValueError("bad event")
+        return ev
+    return mapper
+
+
+def test_fanout_input(kinesis_record_template, context):
+    """Input mappers may fan out and errors refer to their input event."""
+    sample_records = make_records(4)
+    kinesis_event = make_kinesis_event(kinesis_record_template, sample_records)
+    inputp = {"filter": lambda ev, ctx: ev["index"] != 1, "mapper": _fanout}
+    oevents = processor.process_event(kinesis_event, context, inputp, [{}])
+    assert [(ev["index"], ev["copy"]) for ev in oevents[0]] == \
+        [(2, 0), (2, 1), (3, 0), (3, 1), (3, 2)]
+
+    outputp = [{"mapper": _fail_on_copy(1)}, {"mapper": _fail_on_copy(2)}]
+    with pytest.raises(ProcessingError) as excinfo:
+        processor.process_event(kinesis_event, context, inputp, outputp)
+    # One error per failed input event, with the input event
+    failed = excinfo.value.events
+    assert [err.index for err in failed] == [2, 3]
+    assert [err.event["id"] for err in failed] == \
+        [ev["id"] for ev in sample_records[2:]]
+
+
+def test_batch_mapper_drops_events(kinesis_record_template, context):
+    """Batch mappers may drop events: errors then fail the whole batch."""
+    sample_records = make_records(4)
+    kinesis_event = make_kinesis_event(kinesis_record_template, sample_records)
+    for seqnum, rec in enumerate(kinesis_event["Records"]):
+        rec["kinesis"]["sequenceNumber"] = str(100 + seqnum)
+    inputp = {"batch_mapper": lambda evs, ctx: evs[2:]}
+    oevents = processor.process_event(kinesis_event, context, inputp, [{}])
+    assert [ev["index"] for ev in oevents[0]] == [2, 3]
+
+    outputp = [{"mapper": _fail_on_copy(None)}]
+    inputp = {"batch_mapper": lambda evs, ctx: [dict(ev, copy=None)
+                                                for ev in evs[3:]]}
+    with pytest.raises(ProcessingError) as excinfo:
+        processor.process_event(kinesis_event, context, inputp, outputp)
+    failed = excinfo.value.events
+    assert [err.event["id"] for err in failed] == \
+        [ev["id"] for ev in sample_records]
+
+    # The whole batch is retried, and nothing is delivered
+    outputp = [{"mapper": _fail_on_copy(None)},
+               {"filter": lambda ev, ctx: True}]
+    oevents, _, response = processor.process_batch(
+        kinesis_event, context, inputp, outputp)
+    assert response == {"batchItemFailures": [{"itemIdentifier": "100"}]}
+    assert oevents == [[], []]
+
+
+def test_output_batch_mapper(context):
+    """Errors after an output batch mapper fail every event of the batch."""
+    def mapper(ev, ctx):
+        raise ValueError("bad event")
+
+    pipeline = {"batch_mapper": lambda evs, ctx: evs[:1] * 3,
+                "mapper": mapper}
+    processed, positions, failed = processor._run_pipeline(
+        pipeline, make_records(2), {})
+    assert positions is None
+    assert [err.index for err in failed] == [0, 1]
+    assert all(isinstance(err.error, ValueError) for err in failed)
@@ -0,0 +1,68 @@
+"""Test forwarding unmodified events as their original documents."""
+
+from base64 import b64encode
+import json
+
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.passthrough as passthrough  # noqa
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+from . import make_kinesis_event
+from .. import make_records
+
+
+@pytest.mark.parametrize("document,expected", [
+    ['{"a": 1}', '{"a": 1, "ts": "now"}'],
+    ['{} \n', '{"ts": "now"}'],
+    ['{"ts": "before"}', None],
+    ['[1, 2]', None]])
+def test_embed_field(document, expected):
+    """Fields are added to serialized JSON objects without parsing them."""
+    assert passthrough.embed_field(document, "ts", "now") == expected
+    if expected:
+        assert json.loads(expected)["ts"] == "now"
+
+
+def test_raw_documents():
+    """Only the very same event objects have an original document."""
+    event = {"a": 1}
+    raw = passthrough.RawDocuments()
+    raw.add(event, '{"a":1}')
+    assert raw.get(event) == '{"a":1}'
+    assert raw.get(dict(event)) is None
+
+
+def test_process_event(kinesis_record_template, context, boto3_client,
+                       monkeypatch):
+    """Events no mapper has modified are sent as their original document."""
+    monkeypatch.setenv("PASSTHROUGH", "yes")
+    sample_records = make_records(2)
+    kinesis_event = make_kinesis_event(kinesis_record_template, sample_records)
+    # Whitespace that a serializer round trip would not preserve
+    documents = [json.dumps(rec, indent=1) for rec in sample_records]
+    # The documents up to the received_at field embedded at the end
+    prefixes = [doc[:-1].rstrip() for doc in documents]
+
+    def mapper(ev, context):
+        ev["mapped"] = True
+        return ev
+
+    outputp = [{"filter": lambda ev, context: ev["index"] == 0,
+                "kinesis_stream": "k"},
+               {"mapper": mapper, "kinesis_stream": "m",
+                "firehose_delivery_stream": [{"stream_name": "f"}]}]
+    inputp = {"firehose_delivery_stream": [{"stream_name": "a"}]}
+    for rec, document in zip(kinesis_event["Records"], documents):
+        rec["kinesis"]["data"] = b64encode(document.encode("utf-8"))
+    processor.process_event(kinesis_event, context, inputp, outputp)
+
+    kcalls = {call[1]["StreamName"]: call[1]["Records"] for call
+              in boto3_client("kinesis").put_records.call_args_list}
+    fcalls = {call[1]["DeliveryStreamName"]: call[1]["Records"] for call
+              in boto3_client("firehose").put_record_batch.call_args_list}
+    assert kcalls["k"][0]["Data"].startswith(prefixes[0])
+    assert json.loads(kcalls["k"][0]["Data"])["{{received_at_field}}"] == ""
+    assert all(rec["Data"].startswith(prefix.encode("utf-8"))
+               for rec, prefix in zip(fcalls["a"], prefixes))
+    assert all(json.loads(rec["Data"])["mapped"] for rec in kcalls["m"])
+    assert "\n " not in kcalls["m"][0]["Data"]
@@ -0,0 +1,64 @@
+"""Test the pipeline plan."""
+
+from lambdautils.exception import CriticalError
+from mock import Mock
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler as handler
+from humilis_kinesis_processor.lambda_function.handler.plan import build_plan
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+from . import make_kinesis_event
+from .. import make_records
+
+
+def _mapper(ev, *args, **kwargs):
+    """Tag an event."""
+    ev["mapped"] = True
+    return ev
+
+
+def test_plan_is_frozen():
+    """The pipeline specifications cannot be modified."""
+    plan = build_plan(
+        {"mapper": _mapper},
+        [{"kinesis_stream": "s", "aggregate": "True",
+          "firehose_delivery_stream": [
+              {"stream_name": "f", "pack": "False"}]}],
+        None)
+    with pytest.raises(TypeError):
+        plan.input["mapper"] = None
+    with pytest.raises(TypeError):
+        plan.output[0]["firehose_delivery_stream"][0]["pack"] = True
+    assert plan.output[0]["aggregate"] is True
+    assert plan.output[0]["firehose_delivery_stream"][0]["pack"] is False
+
+
+@pytest.mark.parametrize("inputp,outputp", [
+    [{"mapper": "not a callable"}, []],
+    [{}, [{"partition_key": 1}]],
+    [{}, [{"firehose_delivery_stream": [{"mapper": _mapper}]}]],
+    [["not a mapping"], []]])
+def test_invalid_plan(inputp, outputp):
+    """Invalid pipeline specifications are rejected."""
+    with pytest.raises(CriticalError):
+        build_plan(inputp, outputp, None)
+
+
+def test_process_with_plan(kinesis_record_template, context):
+    """A frozen plan can be processed like the raw specifications."""
+    plan = build_plan({"mapper": _mapper}, [{"filter": lambda ev, c: True}],
+                      processor.get_codecs())
+    kinesis_event = make_kinesis_event(kinesis_record_template,
+                                       make_records(2))
+    oevents = processor.process_event(
+        kinesis_event, context, plan.input, plan.output)
+    assert [ev["mapped"] for ev in oevents[0]] == [True, True]
+
+
+def test_plan_is_cached(monkeypatch):
+    """The pipeline callables are produced once per container."""
+    produce = Mock(return_value=({}, []))
+    monkeypatch.setattr(handler, "produce_io_stream_callables", produce)
+    monkeypatch.setattr(handler, "_plan", [])
+    assert handler.get_plan() is handler.get_plan()
+    assert produce.call_count == 1
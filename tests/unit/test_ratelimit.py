@@ -0,0 +1,147 @@
+"""Test the per-shard pacing of the records sent to Kinesis."""
+
+from mock import Mock
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.kinesis as kinesis
+import humilis_kinesis_processor.lambda_function.handler.ratelimit as ratelimit
+
+HALF = 2 ** 127
+
+
+class Clock(object):
+
+    """A clock that only moves when slept on."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture(autouse=True)
+def limiters(monkeypatch):
+    """No rate limiters cached by other tests."""
+    monkeypatch.setattr(ratelimit, "_limiters", {})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(kinesis.time, "sleep", clock.sleep)
+    return clock
+
+
+def _key(shard):
+    """A partition key routed to the lower (0) or upper (1) shard."""
+    for index in range(100):
+        key = "key-{}".format(index)
+        if (ratelimit.hash_key({"PartitionKey": key}) >= HALF) == shard:
+            return key
+
+
+def _records(nbrecs, shard, size=100):
+    return [{"Data": "x" * size, "PartitionKey": _key(shard), "n": index}
+            for index in range(nbrecs)]
+
+
+def test_list_shards():
+    """Closed shards are skipped and pages are followed."""
+    client = Mock()
+    client.list_shards = Mock(side_effect=[
+        {"Shards": [{"ShardId": "s0",
+                     "HashKeyRange": {"StartingHashKey": "0"},
+                     "SequenceNumberRange": {"EndingSequenceNumber": "1"}}],
+         "NextToken": "next"},
+        {"Shards": [{"ShardId": "s1",
+                     "HashKeyRange": {"StartingHashKey": "0"},
+                     "SequenceNumberRange": {}}]}])
+    assert ratelimit.list_shards("stream", client) == [(0, "s1")]
+    assert client.list_shards.call_args[1] == {"NextToken": "next"}
+
+
+def test_shard_routing():
+    """Records go to the shard whose hash key range holds their hash."""
+    limiter = ratelimit.RateLimiter([(HALF, "upper"), (0, "lower")])
+    assert limiter.shard({"PartitionKey": _key(0)}).shard_id == "lower"
+    assert limiter.shard({"PartitionKey": _key(1)}).shard_id == "upper"
+    assert limiter.shard({"PartitionKey": _key(0),
+                          "ExplicitHashKey": str(HALF)}).shard_id == "upper"
+
+
+def test_hot_shard_held_back(clock):
+    """Records of a hot shard wait, the other shards are not held up."""
+    limiter = ratelimit.RateLimiter([(0, "lower"), (HALF, "upper")], clock)
+    hot, cold = _records(1500, 0), _records(10, 1)
+    ready, held, wait = limiter.take(hot + cold, kinesis.record_size)
+    assert [rec["n"] for rec in ready] == list(range(1000)) + list(range(10))
+    assert [rec["n"] for rec in held] == list(range(1000, 1500))
+    assert wait == ratelimit.MIN_WAIT
+
+
+def test_put_records_paced(clock, kinesis_client, monkeypatch):
+    """Paced records are all sent, in order per shard, within the limits."""
+    monkeypatch.setenv("KINESIS_RATE_LIMIT", "yes")
+    limiter = ratelimit.RateLimiter([(0, "lower"), (HALF, "upper")], clock)
+    monkeypatch.setattr(ratelimit, "get_limiter", lambda *args: limiter)
+    sent = []
+    kinesis_client.put_records = Mock(side_effect=lambda **kwargs: (
+        sent.extend(kwargs["Records"]) or
+        {"ResponseMetadata": {"HTTPStatusCode": 200},
+         "Records": [{"SequenceNumber": "1"}] * len(kwargs["Records"])}))
+    kinesis.put_records(_records(2500, 0), "stream", client=kinesis_client)
+    assert [rec["n"] for rec in sent] == list(range(2500))
+    # 1000 records at once, then 1000 per second
+    assert clock.now == pytest.approx(1.5, rel=0.01)
+
+
+def test_adapts_to_throttling(clock):
+    """A shard that throttles records is paced more slowly for a while."""
+    limiter = ratelimit.RateLimiter([(0, "lower"), (HALF, "upper")], clock)
+    records = _records(2, 0)
+    limiter.feedback(records, [{"ErrorCode": ratelimit.THROTTLED}, {}])
+    shard = limiter.shard(records[0])
+    assert shard.scale == 0.5
+    assert shard.records.rate == ratelimit.RECORDS_PER_SECOND / 2
+    assert limiter.shard(_records(1, 1)[0]).scale == 1.0
+    limiter.feedback(records, [{}, {}])
+    assert shard.scale == 0.5 + ratelimit.RECOVERY_STEP
+
+
+def test_unknown_shards(kinesis_client, monkeypatch):
+    """Records are sent unpaced if the shards cannot be listed."""
+    monkeypatch.setenv("KINESIS_RATE_LIMIT", "yes")
+    kinesis_client.list_shards = Mock(side_effect=ValueError("denied"))
+    assert ratelimit.get_limiter("denied-stream", kinesis_client) is None
+    # The failure is cached
+    assert ratelimit.get_limiter("denied-stream", kinesis_client) is None
+    assert kinesis_client.list_shards.call_count == 1
+    metrics = kinesis.put_records(_records(3, 0), "denied-stream",
+                                  client=kinesis_client)
+    assert [m.records for m in metrics] == [3]
+
+
+def test_retries_paced(clock, kinesis_client, monkeypatch):
+    """Records re-submitted after throttling wait for their shard."""
+    monkeypatch.setenv("KINESIS_RATE_LIMIT", "yes")
+    limiter = ratelimit.RateLimiter([(0, "lower")], clock)
+    monkeypatch.setattr(ratelimit, "get_limiter", lambda *args: limiter)
+    monkeypatch.setattr(kinesis, "backoff", lambda attempt: None)
+    ok = {"SequenceNumber": "1"}
+    throttled = {"ErrorCode": ratelimit.THROTTLED}
+    kinesis_client.put_records = Mock(side_effect=[
+        {"ResponseMetadata": {"HTTPStatusCode": 200},
+         "Records": [ok] * 250 + [throttled] * 250},
+        {"ResponseMetadata": {"HTTPStatusCode": 200},
+         "Records": [ok] * 250},
+        {"ResponseMetadata": {"HTTPStatusCode": 200},
+         "Records": [ok] * 500}])
+    kinesis.put_records(_records(1000, 0), "stream", client=kinesis_client)
+    # The shard budget was spent by the first take: the 250 throttled
+    # records wait for it to refill at the halved rate
+    assert clock.now == pytest.approx(0.5, rel=0.01)
+    assert kinesis_client.put_records.call_count == 3
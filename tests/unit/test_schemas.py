@@ -0,0 +1,139 @@
+"""Test the Avro and Protobuf codecs backed by a schema registry."""
+
+from base64 import b64decode, b64encode
+import datetime
+import json
+
+from lambdautils.exception import CriticalError
+from mock import Mock
+import pytest
+
+from . import make_kinesis_event
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+import humilis_kinesis_processor.lambda_function.handler.schemas as schemas
+import humilis_kinesis_processor.lambda_function.handler.serialization as serialization  # noqa
+
+AVRO_SCHEMA = {
+    "type": "record", "name": "PageView",
+    "fields": [{"name": "id", "type": "string"},
+               {"name": "index", "type": "int"}]}
+
+
+@pytest.fixture
+def registry(tmpdir):
+    """A file-based registry with an Avro schema."""
+    tmpdir.join("1.json").write(json.dumps(
+        {"type": "avro", "schema": AVRO_SCHEMA}))
+    return schemas.FileSchemaRegistry(str(tmpdir))
+
+
+def test_lru_cache():
+    """The least recently used entries are evicted."""
+    cache = schemas.LRUCache(2)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    assert cache.get(1) == "a"
+    cache.put(3, "c")
+    assert cache.get(2) is None and cache.get(1) == "a" and len(cache) == 2
+
+
+def test_avro(registry):
+    """Avro records are decoded with the schema named in their header."""
+    pytest.importorskip("fastavro")
+    registry.fetch = Mock(side_effect=registry.fetch)
+    codec = schemas.SchemaCodec(registry, output_schema_id=1)
+    events = [{"id": "a", "index": i} for i in range(3)]
+    records = [codec.encode(ev) for ev in events]
+    assert records[0][:5] == b"\x00\x00\x00\x00\x01"
+    assert len(records[0]) < len(json.dumps(events[0]))
+    assert [codec.decode(rec) for rec in records] == events
+    # The schema is fetched and compiled only once
+    assert registry.fetch.call_count == 1
+
+    with pytest.raises(schemas.SchemaError):
+        codec.decode(b"\x01" + records[0][1:])
+    with pytest.raises(CriticalError):
+        codec.decode(b"\x00\x00\x00\x00\x02")
+
+
+def test_protobuf(tmpdir):
+    """Protobuf records are decoded with a compiled descriptor set."""
+    descriptor_pb2 = pytest.importorskip("google.protobuf.descriptor_pb2")
+    proto = descriptor_pb2.FileDescriptorProto(
+        name="events.proto", package="analytics", syntax="proto3")
+    message = proto.message_type.add(name="PageView")
+    message.field.add(name="id", number=1, type=9, label=1)
+    message.field.add(name="index", number=2, type=5, label=1)
+    fds = descriptor_pb2.FileDescriptorSet(file=[proto])
+    tmpdir.join("events.desc").write_binary(fds.SerializeToString())
+    tmpdir.join("7.json").write(json.dumps(
+        {"type": "protobuf", "descriptor_set": "events.desc",
+         "message": "analytics.PageView"}))
+
+    codec = schemas.SchemaCodec(schemas.FileSchemaRegistry(str(tmpdir)),
+                                output_schema_id=7)
+    event = {"id": "a", "index": 3}
+    record = codec.encode(event)
+    assert record[:5] == b"\x00\x00\x00\x00\x07"
+    assert codec.decode(record) == event
+
+
+def test_registry_codec(registry, monkeypatch):
+    """The schema codec can be composed with framings."""
+    pytest.importorskip("fastavro")
+    monkeypatch.setenv("SCHEMA_REGISTRY_PATH", registry.directory)
+    monkeypatch.setenv("OUTPUT_SCHEMA_ID", "1")
+    monkeypatch.setattr(serialization, "_selected", {})
+    codecs = serialization.get_codecs("schema+gzip")
+    event = {"id": "a", "index": 1}
+    data = codecs.packer(codecs.serializer(event))
+    assert codecs.deserializer(codecs.unpacker(data)) == event
+
+    with pytest.raises(CriticalError):
+        schemas.FileSchemaRegistry(registry.directory).fetch(2)
+
+
+def test_logical_types(tmpdir, kinesis_record_template, context,
+                       boto3_client, monkeypatch):
+    """Values decoded from Avro that JSON cannot hold are encoded."""
+    pytest.importorskip("fastavro")
+    tmpdir.join("3.json").write(json.dumps({"type": "avro", "schema": {
+        "type": "record", "name": "Payment",
+        "fields": [{"name": "id", "type": "string"},
+                   {"name": "paid_at", "type": {
+                       "type": "long", "logicalType": "timestamp-millis"}},
+                   {"name": "token", "type": "bytes"}]}}))
+    monkeypatch.setenv("KINESIS_CODEC", "schema")
+    monkeypatch.setenv("SCHEMA_REGISTRY_PATH", str(tmpdir))
+    monkeypatch.setenv("OUTPUT_SCHEMA_ID", "3")
+    monkeypatch.setattr(serialization, "_selected", {})
+    monkeypatch.setattr(processor, "_codecs", [])
+    codec = schemas.from_environment()
+    paid_at = datetime.datetime(2016, 1, 22, 1, 45, 44, 235000,
+                                tzinfo=datetime.timezone.utc)
+    event = {"id": "a", "paid_at": paid_at, "token": b"\x00\xff"}
+    kinesis_event = make_kinesis_event(kinesis_record_template, [{}])
+    kinesis_event["Records"][0]["kinesis"]["data"] = b64encode(
+        codec.encode(event))
+
+    oevents = processor.process_event(
+        kinesis_event, context,
+        {"firehose_delivery_stream": [{"stream_name": "f"}]},
+        [{"kinesis_stream": "k"}])
+    assert oevents[0][0]["paid_at"] == paid_at
+    client = boto3_client("kinesis")
+    archived = json.loads(
+        client.put_record_batch.call_args[1]["Records"][0]["Data"])
+    assert archived["paid_at"] == "2016-01-22T01:45:44.235000+00:00"
+    assert b64decode(archived["token"]) == b"\x00\xff"
+    # Kinesis outputs are encoded with the output schema
+    sent = codec.decode(client.put_records.call_args[1]["Records"][0]["Data"])
+    assert sent["paid_at"] == paid_at and sent["token"] == b"\x00\xff"
+
+
+def test_json_default():
+    """Only the values decoded from records are encoded."""
+    assert json.dumps({"at": datetime.date(2016, 1, 22)},
+                      default=schemas.json_default) == '{"at": "2016-01-22"}'
+    with pytest.raises(TypeError):
+        json.dumps({"obj": object()}, default=schemas.json_default)
@@ -0,0 +1,113 @@
+"""Test the codec registry."""
+
+from base64 import b64encode
+import gzip
+import json
+import time
+
+from lambdautils.exception import CriticalError
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+import humilis_kinesis_processor.lambda_function.handler.serialization as serialization  # noqa
+from . import make_kinesis_event
+from .. import make_records
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """A registry that can be modified by a test."""
+    monkeypatch.setattr(serialization, "_registry",
+                        serialization._registry.copy())
+    monkeypatch.setattr(serialization, "_selected", {})
+
+
+def test_select_fastest(registry):
+    """The fastest implementation that round-trips is selected."""
+    def slow_encode(obj):
+        time.sleep(0.0001)
+        return json.dumps(obj).encode("utf-8")
+
+    def lossy_decode(data):
+        return {}
+
+    def missing():
+        raise ImportError()
+
+    impls = [serialization.Implementation("slow", slow_encode, json.loads),
+             serialization.Implementation("lossy", json.dumps, lossy_decode),
+             serialization.Implementation("fast", json.dumps, json.loads)]
+    for impl in impls:
+        serialization.register("fake", serialization.FORMAT,
+                               lambda impl=impl: impl)
+    serialization.register("fake", serialization.FORMAT, missing)
+    assert serialization.select("fake").name == "fast"
+
+    with pytest.raises(ValueError):
+        serialization.register("fake", serialization.FRAMING, missing)
+
+
+@pytest.mark.parametrize("spec", ["json", "json+gzip", "json+zlib+gzip",
+                                  "json+zstd"])
+def test_get_codecs(spec):
+    """Composed codecs round-trip events."""
+    if "zstd" in spec:
+        pytest.importorskip("zstandard")
+    codecs = serialization.get_codecs(spec)
+    event = make_records(1)[0]
+    data = codecs.serializer(event)
+    if codecs.packer:
+        data = codecs.packer(data)
+    assert isinstance(data, bytes)
+    if codecs.unpacker:
+        data = codecs.unpacker(data)
+    assert codecs.deserializer(data) == event
+
+
+@pytest.mark.parametrize("spec", ["", "gzip", "gzip+json", "json+json",
+                                  "yaml"])
+def test_bad_spec(spec):
+    """Specs must be a known format optionally followed by framings."""
+    with pytest.raises(CriticalError):
+        serialization.get_codecs(spec)
+
+
+def test_process_event(kinesis_record_template, context, boto3_client,
+                       monkeypatch):
+    """Registry codecs decode input and encode output records."""
+    monkeypatch.setenv("KINESIS_CODEC", "json+gzip")
+    monkeypatch.setattr(processor, "_codecs", [])
+    sample_records = make_records(2)
+    kinesis_event = make_kinesis_event(kinesis_record_template, sample_records)
+    for rec, event in zip(kinesis_event["Records"], sample_records):
+        rec["kinesis"]["data"] = b64encode(
+            gzip.compress(json.dumps(event).encode("utf-8")))
+    oevents = processor.process_event(
+        kinesis_event, context, {}, [{"kinesis_stream": "k"}])
+    assert [ev["id"] for ev in oevents[0]] == \
+        [ev["id"] for ev in sample_records]
+    records = boto3_client("kinesis").put_records.call_args[1]["Records"]
+    assert [json.loads(gzip.decompress(rec["Data"])) for rec in records] == \
+        oevents[0]
+
+
+@pytest.mark.parametrize("setting", ["LAZY_DECODING", "PASSTHROUGH",
+                                     "COLUMNAR"])
+def test_codec_with_json_settings(setting, kinesis_record_template, context,
+                                  boto3_client, monkeypatch):
+    """Settings that parse JSON documents only accept the JSON format."""
+    monkeypatch.setenv(setting, "yes")
+    monkeypatch.setenv("KINESIS_CODEC", "msgpack")
+    monkeypatch.setattr(processor, "_codecs", [])
+    with pytest.raises(CriticalError):
+        processor.get_codecs()
+
+    monkeypatch.setenv("KINESIS_CODEC", "json+gzip")
+    sample_records = make_records(2)
+    kinesis_event = make_kinesis_event(kinesis_record_template, sample_records)
+    for rec, event in zip(kinesis_event["Records"], sample_records):
+        rec["kinesis"]["data"] = b64encode(
+            gzip.compress(json.dumps(event).encode("utf-8")))
+    oevents = processor.process_event(kinesis_event, context, {}, [{}])
+    assert [ev["id"] for ev in processor.columnar.to_rows(oevents[0])] == \
+        [ev["id"] for ev in sample_records]
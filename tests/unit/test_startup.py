@@ -0,0 +1,67 @@
+"""Test the cold start profiling and priming."""
+
+import json
+import os
+import subprocess
+import sys
+
+from mock import Mock
+
+from humilis_kinesis_processor.lambda_function.handler import startup
+from humilis_kinesis_processor.lambda_function.handler.plan import (
+    import_string)
+
+
+def _import_handler(**env):
+    """Import the handler in a fresh interpreter and inspect it."""
+    code = (
+        "import json, sys\n"
+        "import humilis_kinesis_processor.lambda_function.handler as h\n"
+        "print(json.dumps({'modules': sorted(sys.modules), "
+        "'report': h.startup.report(h._profiler)}))\n")
+    out = subprocess.check_output(
+        [sys.executable, "-c", code], env=dict(os.environ, **env),
+        stderr=subprocess.STDOUT)
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def test_cold_start_imports():
+    """Modules off the hot path are not imported at cold start."""
+    result = _import_handler(PROFILE_COLD_START="")
+    assert "werkzeug" not in result["modules"]
+    assert "imports" not in result["report"]
+
+
+def test_import_breakdown():
+    """The time spent importing modules can be profiled."""
+    result = _import_handler(PROFILE_COLD_START="yes")
+    imported = [name for name, duration in result["report"]["imports"]]
+    assert "lambdautils.utils" in imported
+
+
+def test_import_profiler():
+    """Nested imports are recorded with their depth."""
+    sys.modules.pop("colorsys", None)
+    profiler = startup.ImportProfiler().start()
+    try:
+        __import__("colorsys")
+    finally:
+        profiler.stop()
+    assert [(t.name, t.depth) for t in profiler.timings] == [("colorsys", 0)]
+
+
+def test_prime(boto3_client):
+    """Priming builds the plan and the clients, and never raises."""
+    get_plan = Mock()
+    startup.prime(get_plan)
+    assert get_plan.call_count == 1
+    assert boto3_client.call_count == 2
+    startup.prime(Mock(side_effect=ValueError))
+    assert "plan" in startup.report()["phases"]
+
+
+def test_import_string():
+    """Objects can be imported with either notation."""
+    assert import_string("json:dumps") is json.dumps
+    assert import_string("json.dumps") is json.dumps
+    assert import_string("os.path") is os.path
@@ -0,0 +1,73 @@
+"""Test the processing of batches in chunks."""
+
+import json
+
+from lambdautils.exception import CriticalError
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.streaming as streaming  # noqa
+from . import make_kinesis_event
+from .. import make_records
+
+
+@pytest.fixture
+def kinesis_event(kinesis_record_template, monkeypatch):
+    """A Kinesis event processed in chunks of two records."""
+    monkeypatch.setenv("STREAM_CHUNK_SIZE", "2")
+    kevent = make_kinesis_event(kinesis_record_template, make_records(5))
+    for seqnum, rec in enumerate(kevent["Records"]):
+        rec["kinesis"]["sequenceNumber"] = str(100 + seqnum)
+    return kevent
+
+
+def _fail_on(index, error=ValueError):
+    """A mapper that fails for the event with a given index."""
+    def mapper(ev, *args, **kwargs):
+        if ev["index"] == index:
+            raise error("bad event")
+        return ev
+    return mapper
+
+
+def _puts(boto3_client):
+    """The indices of the events sent in every PutRecords call."""
+    return [[json.loads(rec["Data"])["index"] for rec in call[1]["Records"]]
+            for call in boto3_client("kinesis").put_records.call_args_list]
+
+
+@pytest.mark.parametrize("mode,puts", [
+    ("chunked", [[0, 1], [2, 3], [4]]),
+    ("all-or-nothing", [[0, 1, 2, 3, 4]])])
+def test_delivery(mode, puts, kinesis_event, context, boto3_client,
+                  monkeypatch):
+    """Outputs are sent after every chunk or once at the end."""
+    monkeypatch.setenv("STREAM_DELIVERY", mode)
+    outputp = [{"kinesis_stream": "k", "mapper": _fail_on(3)}]
+    failed, seqnum = streaming.process_event(kinesis_event, context, {},
+                                             outputp)
+    assert seqnum is None
+    # Errors refer to the position of the event in the whole batch
+    assert [err.index for err in failed] == [3]
+    assert _puts(boto3_client) == [[i for i in put if i != 3] for put in puts]
+
+
+def test_all_or_nothing(kinesis_event, context, boto3_client):
+    """Nothing is delivered if a chunk makes the invocation fail."""
+    outputp = [{"kinesis_stream": "k", "mapper": _fail_on(4, CriticalError)}]
+    with pytest.raises(CriticalError):
+        streaming.process_event(kinesis_event, context, {}, outputp)
+    assert _puts(boto3_client) == []
+
+    buffer = streaming.RecordBuffer(100)
+    buffer.add(None, [{"Data": b"x" * 60, "PartitionKey": "a"}], "k")
+    with pytest.raises(CriticalError):
+        buffer.add(None, [{"Data": b"x" * 60, "PartitionKey": "a"}], "k")
+
+
+def test_partial(kinesis_event, context, boto3_client):
+    """Chunks after the first failed record are not processed."""
+    outputp = [{"kinesis_stream": "k", "mapper": _fail_on(3)}]
+    failed, seqnum = streaming.process_event(
+        kinesis_event, context, {}, outputp, partial=True)
+    assert seqnum == "103"
+    assert _puts(boto3_client) == [[0, 1, 2]]
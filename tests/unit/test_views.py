@@ -0,0 +1,138 @@
+"""Test the copy-on-write event views."""
+
+import copy
+import json
+import pickle
+
+from humilis_kinesis_processor.lambda_function.handler.views import (
+    CowDict, CowList, isolate, materialize)
+
+
+def _nested_event():
+    """An event with nested containers."""
+    return {"a": 1, "b": {"c": [1, 2, {"d": 3}]}, "e": [{"f": 4}]}
+
+
+def test_top_level_mutation_is_isolated():
+    """Setting and deleting keys in a view does not modify the source."""
+    event = _nested_event()
+    view = isolate(event)
+    view["a"] = 2
+    view["new"] = True
+    del view["e"]
+    assert event == _nested_event()
+    assert view["a"] == 2
+
+
+def test_nested_mutation_is_isolated():
+    """Nested containers are copied when accessed through the view."""
+    event = _nested_event()
+    view = isolate(event)
+    view["b"]["c"][2]["d"] = 30
+    view["b"]["c"].append(5)
+    view.get("e")[0]["f"] = 40
+    for value in view.values():
+        if isinstance(value, dict):
+            value["touched"] = True
+    assert event == _nested_event()
+    assert view["b"]["c"][2]["d"] == 30
+    assert view["b"]["touched"]
+
+
+def test_unaccessed_containers_are_shared():
+    """Containers are only copied once they are accessed."""
+    event = _nested_event()
+    view = isolate(event)
+    assert dict.__getitem__(view, "b") is event["b"]
+    view["b"]
+    assert dict.__getitem__(view, "b") is not event["b"]
+
+
+def test_view_of_view():
+    """Mutating a view of a view does not modify the parent view."""
+    event = _nested_event()
+    parent = isolate(event)
+    parent["b"]["c"].append(5)
+    child = isolate(parent)
+    child["b"]["c"].append(6)
+    assert parent["b"]["c"] == [1, 2, {"d": 3}, 5]
+    assert event == _nested_event()
+
+
+def test_view_is_a_plain_event():
+    """Views look like regular dicts to serializers and callers."""
+    event = _nested_event()
+    view = isolate(event)
+    assert isinstance(view, dict)
+    assert isinstance(view["e"], list)
+    assert json.loads(json.dumps(view)) == event
+    assert view == event
+    assert type(materialize(view)) is dict
+    assert materialize(view) == event
+    assert copy.deepcopy(view) == event
+    assert pickle.loads(pickle.dumps(view)) == event
+
+
+def test_list_views():
+    """List views isolate their items."""
+    events = [_nested_event(), _nested_event()]
+    view = isolate(events)
+    assert isinstance(view, CowList)
+    for ev in view:
+        assert isinstance(ev, CowDict)
+        ev["b"]["c"].pop()
+    assert events == [_nested_event(), _nested_event()]
+    assert materialize(view)[0]["b"]["c"] == [1, 2]
+
+
+class Counter(object):
+
+    """A mutable object that is not a container."""
+
+    def __init__(self):
+        self.count = 0
+
+
+def _mixed_event():
+    """An event with mutable values that are not dicts or lists."""
+    return {"tags": {"a"}, "blob": bytearray(b"ab"), "counter": Counter(),
+            "pair": ([1], {"b": 2}), "frozen": frozenset([("c", 3)])}
+
+
+def test_other_values_are_isolated():
+    """Sets, bytearrays, objects and tuples are copied when accessed."""
+    event = _mixed_event()
+    view = isolate(event)
+    view["tags"].add("b")
+    view["blob"].extend(b"c")
+    view["counter"].count += 1
+    view["pair"][0].append(2)
+    view["pair"][1]["b"] = 20
+    assert event["tags"] == {"a"} and event["blob"] == b"ab"
+    assert event["counter"].count == 0
+    assert event["pair"] == ([1], {"b": 2})
+    assert view["tags"] == {"a", "b"} and view["counter"].count == 1
+    assert view["pair"] == ([1, 2], {"b": 20})
+    assert view["frozen"] == event["frozen"]
+
+    values = isolate([{"a"}, Counter()])
+    values[0].add("b")
+    for value in values:
+        if isinstance(value, Counter):
+            value.count += 1
+    assert values[0] == {"a", "b"} and values[1].count == 1
+
+
+def test_operators_are_isolated():
+    """Merged and concatenated views hold private containers."""
+    event = _nested_event()
+    view = isolate(event)
+    (view | {"x": 1})["b"]["c"].append(5)
+    ({"x": 1} | view)["e"][0]["f"] = 40
+    (view["e"] + [])[0]["f"] = 41
+    ([] + view["e"])[0]["g"] = 42
+    (view["e"] * 2)[1]["h"] = 43
+    next(reversed(view["e"]))["i"] = 44
+    assert event == _nested_event()
+    assert (view | {"a": 2})["a"] == 2 and ({"a": 2} | view)["a"] == 1
+    assert view["e"] + [5] == [{"f": 41, "g": 42, "h": 43, "i": 44}, 5]
@@ -0,0 +1,161 @@
+"""Test running filters and mappers in worker processes."""
+
+import os
+import time
+
+import pytest
+
+import humilis_kinesis_processor.lambda_function.handler.executor as executor
+import humilis_kinesis_processor.lambda_function.handler.processor as processor
+import humilis_kinesis_processor.lambda_function.handler.workers as workers
+from .. import make_records
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    """Run filters and mappers in two worker processes."""
+    monkeypatch.setenv("EXECUTION_ENGINE", "process")
+    monkeypatch.setenv("WORKER_PROCESSES", "2")
+    yield
+    workers.shutdown()
+
+
+def square(ev, context):
+    """A mapper that fails on one event."""
+    if ev["index"] == 5:
+        raise ValueError("bad event")
+    return [dict(ev, square=ev["index"] ** 2, pid=os.getpid())]
+
+
+def even(ev, context):
+    """A filter that keeps events with an even index."""
+    return ev["index"] % 2 == 0
+
+
+def test_process_engine(engine):
+    """Results are in order and errors point at their event."""
+    pipeline = {"mapper": square}
+    processed, failed = processor.run_pipeline(pipeline, make_records(40), {})
+    assert [ev["index"] for ev in processed] == \
+        [i for i in range(40) if i != 5]
+    assert all(ev["square"] == ev["index"] ** 2 for ev in processed)
+    assert {ev["pid"] for ev in processed} <= \
+        {process.pid for process, _ in workers.get_workers()}
+    assert [err.index for err in failed] == [5]
+    assert isinstance(failed[0].error, ValueError)
+
+    pipeline = {"filter": even}
+    processed, failed = processor.run_pipeline(pipeline, make_records(10), {})
+    assert [ev["index"] for ev in processed] == [0, 2, 4, 6, 8]
+
+
+def test_workers_reused(engine):
+    """Workers are forked once and reused by later batches."""
+    pids = {process.pid for process, _ in workers.get_workers()}
+    for _ in range(2):
+        processor.run_pipeline({"filter": even}, make_records(10), {})
+    assert {process.pid for process, _ in workers.get_workers()} == pids
+
+
+def test_unpicklable_mapper(engine):
+    """Callables that cannot be sent to the workers are critical errors."""
+    pipeline = {"mapper": lambda ev, ctx: ev}
+    with pytest.raises(processor.CriticalError):
+        processor.run_pipeline(pipeline, make_records(3), {})
+
+
+def test_unknown_engine(monkeypatch):
+    """Unknown execution engines are critical errors."""
+    monkeypatch.setenv("EXECUTION_ENGINE", "gpu")
+    with pytest.raises(processor.CriticalError):
+        processor.run_pipeline({"filter": even}, make_records(3), {})
+
+
+def double(ev, context):
+    """A mapper that doubles the index of an event."""
+    return dict(ev, value=ev["index"] * 2)
+
+
+def negate(ev, context):
+    """A mapper that negates the index of an event."""
+    return dict(ev, value=-ev["index"])
+
+
+def stuck(ev, context):
+    """A mapper that never completes in time."""
+    time.sleep(5)
+    return ev
+
+
+def test_concurrent_callers(engine):
+    """Concurrent pipelines never get each other's results."""
+    mappers = [double, negate] * 4
+    results = executor.run_all(
+        [(processor.run_pipeline, ({"mapper": mapper}, make_records(50), {}))
+         for mapper in mappers], len(mappers), "test-workers")
+    for mapper, (processed, _) in zip(mappers, results):
+        assert [ev["value"] for ev in processed] == \
+            [mapper({"index": i}, None)["value"] for i in range(50)]
+
+
+def test_timeout(engine, monkeypatch):
+    """A worker that takes too long fails the batch and is replaced."""
+    monkeypatch.setenv("WORKER_TIMEOUT", "0.2")
+    pids = {process.pid for process, _ in workers.get_workers()}
+    with pytest.raises(processor.CriticalError):
+        processor.run_pipeline({"mapper": stuck}, make_records(2), {})
+    processed, _ = processor.run_pipeline(
+        {"mapper": double}, make_records(2), {})
+    assert [ev["value"] for ev in processed] == [0, 2]
+    assert not pids & {process.pid for process, _ in workers.get_workers()}
+
+
+class PairError(Exception):
+
+    """An exception that cannot be unpickled: its args are not enough."""
+
+    def __init__(self, code, reason):
+        super(PairError, self).__init__("{}: {}".format(code, reason))
+
+
+def pair_error(ev, context):
+    """A mapper that fails with an exception that cannot be unpickled."""
+    if ev["index"] % 2:
+        raise PairError(ev["index"], "odd event")
+    return dict(ev, value=ev["index"])
+
+
+class Unreadable(object):
+
+    """A value that is pickled but cannot be unpickled."""
+
+    def __reduce__(self):
+        return (PairError, ("only one argument",))
+
+
+def unreadable(value):
+    return Unreadable() if value == 1 else value
+
+
+def test_unpicklable_error(engine):
+    """Exceptions that cannot be unpickled are sent back as WorkerError."""
+    processed, failed = processor.run_pipeline(
+        {"mapper": pair_error}, make_records(6), {})
+    assert [ev["value"] for ev in processed] == [0, 2, 4]
+    assert [err.index for err in failed] == [1, 3, 5]
+    assert all(isinstance(err.error, workers.WorkerError) for err in failed)
+    assert failed[0].error.name == "PairError"
+    assert "odd event" in str(failed[0].error)
+    processed, _ = processor.run_pipeline(
+        {"mapper": double}, make_records(4), {})
+    assert [ev["value"] for ev in processed] == [0, 2, 4, 6]
+
+
+def test_unreadable_result(engine):
+    """Results that cannot be unpickled fail the batch, not the next one."""
+    pids = {process.pid for process, _ in workers.get_workers()}
+    with pytest.raises(processor.CriticalError):
+        workers.run([(unreadable, (value,)) for value in range(4)])
+    assert workers.run([(abs, (-value,)) for value in range(8)]) == \
+        list(range(8))
+    assert not pids & {process.pid for process, _ in workers.get_workers()}